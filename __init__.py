@@ -11,6 +11,7 @@ class VIEW_MT_electron_orbitals_menu_add(Menu):
         layout = self.layout
         layout.operator_context = 'INVOKE_REGION_WIN'
         layout.operator("mesh.generate_electron_orbitals",text="Generate Electron Orbitals")
+        layout.operator("mesh.generate_electron_orbitals_modal",text="Generate Electron Orbitals in Background")
 
 # Register all operators and panels
 
@@ -21,9 +22,12 @@ def menu_func(self, context):
     layout.separator()
     layout.operator("mesh.generate_electron_orbitals",
                     text="Generate Electron Orbitals", icon="PACKAGE")
+    layout.operator("mesh.generate_electron_orbitals_modal",
+                    text="Generate Electron Orbitals in Background", icon="PACKAGE")
 
 # Register
-classes = [VIEW_MT_electron_orbitals_menu_add,electron_orbitals_new_3D.Electron_orbitals_input]
+classes = [VIEW_MT_electron_orbitals_menu_add,electron_orbitals_new_3D.Electron_orbitals_input,
+           electron_orbitals_new_3D.Electron_orbitals_modal]
 
 def register():
     from bpy.utils import register_class
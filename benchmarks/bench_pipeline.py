@@ -0,0 +1,182 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import itertools
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Benchmark of the whole orbital pipeline without Blender, run from the extension directory:
+#   python benchmarks/bench_pipeline.py --states 3,1,1 6,3,-2 --resolutions 100 200 --levels 1 5 \
+#       --output bench.json --compare baseline.json
+#
+# Every (state, resolution, levels, evaluation) case runs in a fresh process, so the peak
+# resident set size of a case is not inherited from the ones before it. A case records
+# every stage of generate_orbital plus the weld and mesh ingestion of create_mesh_for (on
+# the bpy stand-in of bpy_stub.py) with its wall time, traced memory peak and process peak RSS.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# stages slower than this factor of the baseline are reported as regressions
+REGRESSION = 1.1
+
+def load_extension():
+    """ Import the extension as a package on the bpy stand-in and return its operator module. """
+    import bpy_stub
+    bpy_stub.install()
+    spec = importlib.util.spec_from_file_location("electron_orbitals", os.path.join(ROOT, "__init__.py"),
+                                                  submodule_search_locations=[ROOT])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules["electron_orbitals"] = package
+    spec.loader.exec_module(package)
+    return sys.modules["electron_orbitals.electron_orbitals_new_3D"]
+
+def _quiet(*args):
+    pass
+
+def run_case(case):
+    """ Run one benchmark case and return its instrument report. Runs in a fresh process. """
+    addon = load_extension()
+    from electron_orbitals.orbital_engine import generate_orbital, Instrument
+
+    # a tiny warm-up run, so lazy imports (skimage.measure) are not timed as part of a stage
+    generate_orbital(1, 0, 0, case["sf"], case["grid_extent"], 8, 1, case["evaluation"], target_resolution=15,
+                     log=_quiet)
+
+    instrument = Instrument()
+    result = generate_orbital(case["n"], case["l"], case["m"], case["sf"], case["grid_extent"],
+                              case["grid_resolution"], case["levels"], case["evaluation"],
+                              memory_budget_mb=case["memory_budget_mb"], workers=case["workers"],
+                              target_resolution=case.get("target_resolution") or 1600,
+                              instrument=instrument, log=_quiet)
+    for (isostep, iso, color_value, alpha_value), (verts, faces, normals) in zip(result.levels, result.surfaces):
+        addon.create_mesh_for("orb_bench_" + str(isostep), verts, faces, normals, instrument)
+    instrument.stop()
+    return instrument.report(case=case)
+
+def case_key(case):
+    # target_resolution is None for the dense evaluations and missing from older result files
+    return tuple(case.get(name) for name in ("n", "l", "m", "grid_resolution", "levels", "evaluation",
+                                             "target_resolution"))
+
+def case_label(case):
+    label = "n,l,m=%d,%d,%d res=%d levels=%d %s" % case_key(case)[:6]
+    if case.get("target_resolution"):
+        label = label + " target=%d" % case["target_resolution"]
+    return label
+
+def target_resolution(resolution, target):
+    """ Effective resolution of an ADAPTIVE case, target or the grid resolution refined once if it is 0. """
+    return target if target > 0 else 2 * (resolution - 1) + 1
+
+def environment():
+    """ Versions and machine of the run, stored with the results. """
+    import numpy, scipy, skimage
+    return {
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "scipy": scipy.__version__,
+        "skimage": skimage.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+    }
+
+def best_totals(runs):
+    """ Fastest time per stage name over the repeats of a case, plus the fastest total. """
+    best = {}
+    for run in runs:
+        for name, seconds in list(run["totals"].items()) + [("total", run["total_seconds"])]:
+            best[name] = min(best.get(name, float("inf")), seconds)
+    return best
+
+def compare(results, baseline):
+    """ Print the stage times of results relative to a baseline run of the same cases.
+
+    Returns:
+        int: number of stages slower than REGRESSION times their baseline
+    """
+    reference = {case_key(entry["case"]): entry for entry in baseline["cases"]}
+    regressions = 0
+    for entry in results["cases"]:
+        old = reference.get(case_key(entry["case"]))
+        if old is None:
+            continue
+        print(case_label(entry["case"]))
+        for name, seconds in entry["best"].items():
+            if name not in old["best"] or old["best"][name] <= 0:
+                continue
+            ratio = seconds / old["best"][name]
+            flag = ""
+            if ratio > REGRESSION and seconds - old["best"][name] > 0.01:
+                flag = "  <- regression"
+                regressions = regressions + 1
+            print("    %-16s %9.3f s  baseline %9.3f s  x%.2f%s" % (name, seconds, old["best"][name], ratio, flag))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the orbital pipeline stages.")
+    parser.add_argument("--states", nargs="+", default=["3,1,1", "6,3,-2"], help="quantum states n,l,m")
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[100, 200], help="grid resolutions")
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 5], help="numbers of iso levels")
+    parser.add_argument("--evaluations", nargs="+", default=["SYMMETRIC"],
+                        choices=("DENSE", "SLABS", "SYMMETRIC", "ADAPTIVE"), help="density evaluations")
+    parser.add_argument("--target-resolution", type=int, default=0,
+                        help="effective resolution of the ADAPTIVE cases, 0 refines the grid resolution once")
+    parser.add_argument("--extent", type=int, default=480, help="grid extent")
+    parser.add_argument("--sf", type=float, default=0.4, help="Bohr radius scale factor")
+    parser.add_argument("--memory-budget", type=int, default=512, help="scratch memory per slab in MiB")
+    parser.add_argument("--workers", type=int, default=0, help="isosurface extraction workers")
+    parser.add_argument("--repeats", type=int, default=1, help="runs per case, the fastest stage times are kept")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--load", help="read results from this JSON file instead of running the benchmark")
+    parser.add_argument("--compare", help="baseline JSON file to compare the results with")
+    args = parser.parse_args(argv)
+
+    if args.load:
+        with open(args.load) as f:
+            results = json.load(f)
+    else:
+        cases = []
+        for state, resolution, levels, evaluation in itertools.product(args.states, args.resolutions, args.levels,
+                                                                       args.evaluations):
+            n, l, m = (int(value) for value in state.split(","))
+            cases.append({"n": n, "l": l, "m": m, "sf": args.sf, "grid_extent": args.extent,
+                          "grid_resolution": resolution, "levels": levels, "evaluation": evaluation,
+                          "memory_budget_mb": args.memory_budget, "workers": args.workers,
+                          "target_resolution": (target_resolution(resolution, args.target_resolution)
+                                                if evaluation == "ADAPTIVE" else None)})
+
+        results = {"format": 1, "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "environment": environment(),
+                   "cases": []}
+        context = multiprocessing.get_context("spawn")
+        for case in cases:
+            runs = []
+            for repeat in range(args.repeats):
+                with ProcessPoolExecutor(1, mp_context=context) as pool:
+                    runs.append(pool.submit(run_case, case).result())
+            best = best_totals(runs)
+            results["cases"].append({"case": case, "best": best, "runs": runs})
+            print(case_label(case), " ".join(
+                "%s=%.3f" % (name, seconds) for name, seconds in best.items()),
+                "peak_rss=%.0fMiB" % (max(run["peak_rss_bytes"] or 0 for run in runs) / (1024 * 1024)))
+
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=1, default=str)
+            print("results written to", args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline)
+        print(regressions, "stage(s) slower than", REGRESSION, "x the baseline")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
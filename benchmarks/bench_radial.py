@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+import argparse
+from decimal import Decimal, getcontext
+from math import comb, factorial
+import numpy as np
+
+# Speed and accuracy of the radial function evaluators, run from the extension directory:
+#   python benchmarks/bench_radial.py --states 3,1 20,3 50,10 50,49
+#
+# radial_function (Laguerre recurrence, log-space normalization) is compared with
+# radial_function_poly1d (the original sp.genlaguerre / sp.factorial implementation).
+# The accuracy reference is the explicit Laguerre sum evaluated with 80 significant
+# digits in decimal arithmetic. Errors are relative to the largest |R| of the samples.
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from orbital_engine.wavefunction import radial_function, radial_function_poly1d, scaled_bohr_radius
+
+def reference_radial(n, l, r, a0):
+    """ Radial function of the original normalization in 80 digit decimal arithmetic. """
+    getcontext().prec = 80
+    k = n - l - 1
+    alpha = 2 * l + 1
+    constant = (Decimal(2 / n * a0) ** 3 * factorial(k) / (2 * n * Decimal(factorial(n + l)))).sqrt()
+    values = []
+    for radius in r:
+        p = 2 * Decimal(float(radius)) / (n * Decimal(a0))
+        power = [Decimal(1)]
+        for i in range(max(k, l)):
+            power.append(power[-1] * p)
+        laguerre = sum(Decimal((-1) ** i * comb(k + alpha, k - i)) * power[i] / factorial(i) for i in range(k + 1))
+        values.append(float(constant * (-p / 2).exp() * power[l] * laguerre))
+    return np.array(values)
+
+def best_time(function, repeats):
+    best = float("inf")
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the radial function evaluators.")
+    parser.add_argument("--states", nargs="+", default=["3,1", "10,2", "20,3", "30,5", "40,0", "50,10", "50,49"],
+                        help="(n,l) pairs")
+    parser.add_argument("--sf", type=float, default=0.4, help="Bohr radius scale factor")
+    parser.add_argument("--samples", type=int, default=400, help="radii compared with the decimal reference")
+    parser.add_argument("--grid", type=int, default=2_000_000, help="radii of the large timing array")
+    parser.add_argument("--block", type=int, default=17 ** 3, help="radii of the small (adaptive block) timing array")
+    parser.add_argument("--repeats", type=int, default=3, help="timing repeats, the best is reported")
+    args = parser.parse_args(argv)
+
+    a0 = scaled_bohr_radius(args.sf)
+    rng = np.random.default_rng(0)
+    print("%6s %6s | %10s %10s | %12s %12s | %12s %12s" % ("n", "l", "err new", "err old", "grid new s",
+                                                          "grid old s", "block new ms", "block old ms"))
+    for state in args.states:
+        n, l = (int(value) for value in state.split(","))
+
+        # the oscillating part of R(r) and its decay lie within a few n^2 Bohr radii
+        r = np.linspace(0, 2.5 * n * n * a0, args.samples)
+        exact = reference_radial(n, l, r, a0)
+        scale = np.abs(exact).max()
+        with np.errstate(all="ignore"):
+            error_new = np.abs(radial_function(n, l, r, a0) - exact).max() / scale
+            error_old = np.abs(radial_function_poly1d(n, l, r, a0) - exact).max() / scale
+
+        grid = rng.uniform(0, 2.5 * n * n * a0, args.grid)
+        block = rng.uniform(0, 2.5 * n * n * a0, args.block)
+        with np.errstate(all="ignore"):
+            grid_new = best_time(lambda: radial_function(n, l, grid, a0), args.repeats)
+            grid_old = best_time(lambda: radial_function_poly1d(n, l, grid, a0), args.repeats)
+            block_new = best_time(lambda: radial_function(n, l, block, a0), args.repeats * 10)
+            block_old = best_time(lambda: radial_function_poly1d(n, l, block, a0), args.repeats * 10)
+
+        print("%6d %6d | %10.2e %10.2e | %12.3f %12.3f | %12.3f %12.3f" % (n, l, error_new, error_old, grid_new,
+                                                                          grid_old, 1000 * block_new,
+                                                                          1000 * block_old))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+# Scaling of the threaded slab evaluation of the density volume, run from the extension directory:
+#   python benchmarks/bench_scaling.py --state 6,3,-2 --resolution 300 --workers 1 2 4 8 16 32 \
+#       --output scaling.json
+#
+# Every evaluation is timed with 1 to N workers. The volumes of all worker counts are
+# compared with the one of a single worker and must be bit-identical. The speedup and
+# parallel efficiency are relative to the single worker time.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from orbital_engine.wavefunction import compute_probability_density_slabs
+from orbital_engine.factors import FactorCache
+from bench_pipeline import environment
+
+def default_workers():
+    """ 1, 2, 4, ... up to the number of CPU cores, which is always included. """
+    count = os.cpu_count() or 1
+    workers = [1]
+    while workers[-1] * 2 < count:
+        workers.append(workers[-1] * 2)
+    if count > 1:
+        workers.append(count)
+    return workers
+
+def evaluate(evaluation, n, l, m, sf, grid_extent, grid_resolution, memory_budget_mb, workers):
+    """ Evaluate the density volume once and return it with its wall time. """
+    # a fresh factor cache, so the factors are computed in every run
+    factors = FactorCache() if evaluation == 'FACTORS' else None
+    start = time.perf_counter()
+    density, report = compute_probability_density_slabs(n, l, m, sf, grid_extent, grid_resolution, memory_budget_mb,
+                                                        measure_memory=False, symmetric=evaluation == 'SYMMETRIC',
+                                                        factors=factors, workers=workers)
+    return density, time.perf_counter() - start
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the scaling of the slab evaluation with workers.")
+    parser.add_argument("--state", default="6,3,-2", help="quantum state n,l,m")
+    parser.add_argument("--resolution", type=int, default=200, help="grid resolution")
+    parser.add_argument("--extent", type=int, default=480, help="grid extent")
+    parser.add_argument("--sf", type=float, default=0.4, help="Bohr radius scale factor")
+    parser.add_argument("--memory-budget", type=int, default=512, help="scratch memory of all workers in MiB")
+    parser.add_argument("--workers", type=int, nargs="+", default=default_workers(), help="worker counts")
+    parser.add_argument("--evaluations", nargs="+", default=["SLABS", "SYMMETRIC"],
+                        choices=("SLABS", "SYMMETRIC", "FACTORS"), help="density evaluations")
+    parser.add_argument("--repeats", type=int, default=3, help="runs per worker count, the fastest is kept")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    n, l, m = (int(value) for value in args.state.split(","))
+    results = {"format": 1, "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "environment": environment(),
+               "state": [n, l, m], "grid_resolution": args.resolution, "grid_extent": args.extent, "sf": args.sf,
+               "memory_budget_mb": args.memory_budget, "evaluations": {}}
+    mismatches = 0
+    for evaluation in args.evaluations:
+        reference = None
+        single = None
+        rows = []
+        print("%s n,l,m=%d,%d,%d res=%d" % (evaluation, n, l, m, args.resolution))
+        for workers in sorted(set([1] + args.workers)):
+            best = float("inf")
+            identical = True
+            for repeat in range(args.repeats):
+                density, seconds = evaluate(evaluation, n, l, m, args.sf, args.extent, args.resolution,
+                                            args.memory_budget, workers)
+                best = min(best, seconds)
+                if reference is None:
+                    reference = density
+                identical = identical and np.array_equal(density, reference)
+                del density
+            if single is None:
+                single = best
+            mismatches = mismatches + (not identical)
+            rows.append({"workers": workers, "seconds": best, "speedup": single / best,
+                         "efficiency": single / best / workers, "identical": identical})
+            print("    workers=%3d %9.3f s  speedup x%5.2f  efficiency %3.0f%%%s" % (
+                workers, best, single / best, 100 * single / best / workers, "" if identical else "  <- differs"))
+        results["evaluations"][evaluation] = rows
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1, default=str)
+        print("results written to", args.output)
+    if mismatches:
+        print(mismatches, "worker count(s) gave a volume different from a single worker")
+    return 1 if mismatches else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
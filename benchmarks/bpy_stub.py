@@ -0,0 +1,103 @@
+import sys
+import types
+import numpy as np
+
+# Minimal stand-in for the bpy module, enough to import the extension outside Blender
+# and to run create_mesh_for. Mesh data is copied into numpy arrays the way foreach_set
+# copies it into Blender's buffers, so mesh ingestion costs about what it costs in
+# Blender minus the work Blender itself does in update().
+
+class _Anything:
+    """ Accepts any attribute access or call, for the parts of bpy only touched at import. """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __call__(self, *args, **kwargs):
+        return _Anything()
+
+    def __getattr__(self, name):
+        return _Anything()
+
+class StubCollection:
+    """ Mesh element collection (vertices, loops, polygons) with add and foreach_set. """
+
+    def __init__(self):
+        self.length = 0
+        self.attributes = {}
+
+    def __len__(self):
+        return self.length
+
+    def add(self, count):
+        self.length = self.length + count
+
+    def foreach_set(self, attribute, values):
+        self.attributes[attribute] = np.array(values, copy=True)
+
+    def foreach_get(self, attribute, values):
+        values[:] = self.attributes[attribute]
+
+class StubMesh:
+    def __init__(self, name):
+        self.name = name
+        self.vertices = StubCollection()
+        self.loops = StubCollection()
+        self.polygons = StubCollection()
+        self.materials = []
+        self.custom_normals = None
+
+    def update(self, calc_edges=False):
+        pass
+
+    def shade_smooth(self):
+        pass
+
+    def normals_split_custom_set_from_vertices(self, normals):
+        self.custom_normals = np.array(normals, copy=True)
+
+class StubObject:
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+        self.location = [0, 0, 0]
+        self.hide_viewport = False
+        self.hide_render = False
+
+class StubIDCollection(dict):
+    """ bpy.data.meshes / objects: new() creates and keeps a datablock by name. """
+
+    def __init__(self, factory):
+        super().__init__()
+        self.factory = factory
+
+    def new(self, name, *args):
+        block = self.factory(name, *args)
+        self[name] = block
+        return block
+
+def _property(*args, **kwargs):
+    return None
+
+def install():
+    """ Register the stub as the bpy module (and bpy.types / bpy.props). """
+    bpy = types.ModuleType("bpy")
+    bpy.types = types.ModuleType("bpy.types")
+    bpy.types.Operator = object
+    bpy.types.Menu = object
+    bpy.types.Panel = object
+    bpy.props = types.ModuleType("bpy.props")
+    for name in ("StringProperty", "IntProperty", "FloatProperty", "BoolProperty", "EnumProperty",
+                 "FloatVectorProperty", "CollectionProperty", "PointerProperty"):
+        setattr(bpy.props, name, _property)
+    bpy.data = types.SimpleNamespace(meshes=StubIDCollection(StubMesh), objects=StubIDCollection(StubObject),
+                                     materials=StubIDCollection(lambda name: _Anything()),
+                                     collections=StubIDCollection(lambda name: _Anything()))
+    bpy.context = _Anything()
+    bpy.ops = _Anything()
+    bpy.utils = _Anything()
+    bpy.app = _Anything()
+    sys.modules["bpy"] = bpy
+    sys.modules["bpy.types"] = bpy.types
+    sys.modules["bpy.props"] = bpy.props
+    return bpy
@@ -1,279 +1,312 @@
+import os
 import time
 import datetime
-import bpy, bmesh
-from scipy.constants import physical_constants
-import scipy.special as sp
-import numpy as np
+import cProfile
+import pstats
+import queue
+import threading
+import bpy
 # from numpy import interp 
 from bpy.types import Operator
-from bpy.props import (StringProperty,IntProperty,FloatProperty,BoolProperty)
+from bpy.props import (StringProperty,IntProperty,FloatProperty,BoolProperty,EnumProperty,FloatVectorProperty)
 from itertools import chain
 import math
 import colorsys
+import numpy as np
 # import mcubes
-from skimage import measure
-
-def asSpherical(x,y,z,eps):
-    #takes list xyz (single coord)
-    r       =  np.sqrt(x*x + y*y + z*z)
-    theta   =  np.arccos(z/(r + eps))
-    phi     =  np.arctan2(y,x)
-    return [r,theta,phi]
-
-# Normalized radial function Rnl(r)
-def radial_function(n, l, r, a0):
-    """ Compute the normalized radial part of the wavefunction using
-    Laguerre polynomials and an exponential decay factor.
-
-    Args:
-        n (int): principal quantum number
-        l (int): azimuthal quantum number
-        r (numpy.ndarray): radial coordinate
-        a0 (float): scaled Bohr radius
-    Returns:
-        numpy.ndarray: wavefunction radial component
-    """
-
-    # Laguerre polynomials describe how the electron density
-    # changes as the distance from the nucleus increases
-    laguerre = sp.genlaguerre(n - l - 1, 2 * l + 1)
-
-    # Normalized radial distance from the nucleus
-    p = 2 * r / (n * a0)
-
-    # This factor ensures the radial wavefunction is normalized
-    constant_factor = np.sqrt(
-        ((2 / n * a0) ** 3 * (sp.factorial(n - l - 1))) /
-        (2 * n * (sp.factorial(n + l)))
-    )
-
-    # The radial part of the wavefunction is constructed by the product of:
-    # - Constant factor:
-    #   Normalizes the radial wavefunction
-
-    # - Exponential decay factor: np.exp(-p / 2)
-    #   Reflects the decrease in probability of finding an
-    #   electron as it moves away from the nucleus
+from .orbital_engine import (generate_orbital, orbital_name, DensityCache, weld_vertices, default_factor_cache,
+                             Instrument, maybe_stage, write_report, prune_reports, GenerationCancelled,
+                             OrbitalSession, sample_orbital, parse_superposition, beat_period,
+                             animate_superposition, merge_result, parse_probabilities, auto_grid_extent)
 
-    # - Power-law dependence on radial distance: p ** l
-    #   Introduces a dependency based on the azimuthal quantum number 'l',
-    #   indicating different radial behaviors for different orbitals
+# density volume, surfaces and levels of detail of the last generation; the redo panel
+# runs execute again after every change, and only the results depending on the changed
+# inputs are computed again
+session = OrbitalSession()
 
-    # - Laguerre polynomial: laguerre(p)
-    #   Captures oscillations in the electron density
-    #   as a function of radial distance
-    return constant_factor * np.exp(-p / 2) * (p ** l) * laguerre(p)
+def create_mesh_for(objname,verts,faces,normals=None,instrument=None,weld=True):
+    """ Create an object with a new mesh from marching cubes output.
 
-
-# Normalized angular function Ylm(θ,φ)
-def angular_function(m, l, theta, phi):
-    """ Compute the normalized angular part of the wavefunction using
-    Legendre polynomials and a phase-shifting exponential factor.
+    The arrays are welded in numpy (like bmesh remove_doubles with dist=0.01) and then
+    copied into the mesh in bulk with foreach_set, without a bmesh round trip. The
+    marching cubes normals are applied as custom normals.
 
     Args:
-        m (int): magnetic quantum number
-        l (int): azimuthal quantum number
-        theta (numpy.ndarray): polar angle
-        phi (int): azimuthal angle
+        objname (str): name of the object and its mesh
+        verts (numpy.ndarray): (V, 3) vertices
+        faces (numpy.ndarray): (F, 3) triangles
+        normals (numpy.ndarray): (V, 3) vertex normals, None to let Blender compute them
+        instrument (orbital_engine.Instrument): records the weld and mesh ingestion stages
+        weld (bool): weld the vertices first, off for arrays that are already welded
     Returns:
-        numpy.ndarray: wavefunction angular component
+        bpy.types.Object: the new object
     """
+    verts = np.asarray(verts, dtype=np.float32)
+    faces = np.asarray(faces, dtype=np.int32)
+    if weld:
+        with maybe_stage(instrument, "weld", vertices=len(verts)) as stage:
+            if normals is None:
+                verts, faces, _ = weld_vertices(verts, faces, verts, 0.01)
+            else:
+                verts, faces, normals = weld_vertices(verts, faces, np.asarray(normals, dtype=np.float32), 0.01)
+            stage["welded_vertices"] = len(verts)
+
+    with maybe_stage(instrument, "mesh_ingestion", vertices=len(verts), faces=len(faces)):
+        me = bpy.data.meshes.new(objname)  # create a new mesh
+        me.vertices.add(len(verts))
+        me.vertices.foreach_set("co", verts.ravel())
+        me.loops.add(faces.size)
+        me.loops.foreach_set("vertex_index", faces.ravel())
+        me.polygons.add(len(faces))
+        me.polygons.foreach_set("loop_start", np.arange(0, faces.size, 3, dtype=np.int32))
+        me.update(calc_edges=True)      # update the mesh with the new data
+
+        if normals is not None and len(verts):
+            # custom normals are only used on smooth shaded faces
+            me.shade_smooth()
+            me.normals_split_custom_set_from_vertices(normals)
 
-    # Legendre polynomials describe the spatial arrangement and directional
-    # characteristics of electron probability densities
-    legendre = sp.lpmv(m, l, np.cos(theta))
-
-    # This factor ensures that the angular wavefunction is normalized
-    constant_factor = ((-1) ** m) * np.sqrt(
-        ((2 * l + 1) * sp.factorial(l - np.abs(m))) /
-        (4 * np.pi * sp.factorial(l + np.abs(m)))
-    )
-
-    # The angular part of the wavefunction is constructed by the product of:
-    # - Constant factor:
-    #   Normalizes the angular wavefunction
+    ob = bpy.data.objects.new(objname,me) # create a new object
+    ob.data = me          # link the mesh data to the object
+    return ob
+   
+def make_object_in_scene(object_name,verts,faces,normals=None,instrument=None,collection=None,weld=True):
 
-    # - Legendre polynomial:
-    #   Describes the angular dependence of the wavefunction based on the quantum numbers.
-    #   Providing insight into the orientation and shape of electron orbitals
-    #   around the nucleus for given quantum numbers
+    block=create_mesh_for(object_name,verts,faces,normals,instrument,weld)
 
-    # - Exponential factor: np.real(np.exp(1.j * m * phi))
-    #   Introduces a phase shift dependent on the magnetic quantum
-    #   number 'm' and the azimuthal angle 'phi'
-    return constant_factor * legendre * np.real(np.exp(1.j * m * phi))
+    (collection or bpy.context.collection).objects.link(block)
+    selectobj(block)
+    register_datablock(bpy.context.scene, "objects", block)
+    register_datablock(bpy.context.scene, "meshes", block.data)
+    
+    return block
 
+def make_object(object_name, mesh, collection=None):
+    """ Link a new object of mesh into the scene, select and register it. """
+    block = bpy.data.objects.new(object_name, mesh)
+    (collection or bpy.context.collection).objects.link(block)
+    selectobj(block)
+    register_datablock(bpy.context.scene, "objects", block)
+    register_datablock(bpy.context.scene, "meshes", mesh)
+    return block
 
-# Normalized wavefunction Ψnlm(r,θ,φ) as a product of Rnl(r).Ylm(θ,φ)
-def compute_wavefunction(n, l, m, a0_scale_factor,grid_extent,grid_resolution):
-    """ Compute the normalized wavefunction as a product
-    of its radial and angular components.
+def points_node_group(name, radius, material):
+    """ Geometry nodes group drawing the vertices of a mesh as points of material.
 
-    Args:
-        n (int): principal quantum number
-        l (int): azimuthal quantum number
-        m (int): magnetic quantum number
-        a0_scale_factor (float): Bohr radius scale factor
-    Returns:
-        numpy.ndarray: wavefunction
+    Every point cloud gets its own group, so that its radius is part of the group.
     """
+    group = bpy.data.node_groups.new(name, 'GeometryNodeTree')
+    register_datablock(bpy.context.scene, "node_groups", group)
+    group.interface.new_socket(name="Geometry", in_out='INPUT', socket_type='NodeSocketGeometry')
+    group.interface.new_socket(name="Geometry", in_out='OUTPUT', socket_type='NodeSocketGeometry')
+    nodes = group.nodes
+    links = group.links
+
+    group_input = nodes.new("NodeGroupInput")
+    group_input.location = (-400, 0)
+    to_points = nodes.new("GeometryNodeMeshToPoints")
+    to_points.location = (-200, 0)
+    to_points.mode = 'VERTICES'
+    to_points.inputs["Radius"].default_value = radius
+    set_material = nodes.new("GeometryNodeSetMaterial")
+    set_material.location = (0, 0)
+    set_material.inputs["Material"].default_value = material
+    group_output = nodes.new("NodeGroupOutput")
+    group_output.location = (200, 0)
+
+    links.new(to_points.inputs["Mesh"], group_input.outputs[0])
+    links.new(set_material.inputs["Geometry"], to_points.outputs["Points"])
+    links.new(group_output.inputs[0], set_material.outputs["Geometry"])
+    return group
 
-    # The Bohr radius sets the scale of the wavefunction and determines the size of the atom.
-    # By scaling it, we adapt the wavefunction's spatial extent for effective visualization
-    global a0
-    a0 = a0_scale_factor * physical_constants['Bohr radius'][0] * 1e+12
-
-    # Establish a grid in the z-x plane, allowing the wavefunction to assign a probability
-    # value to each point. This grid aids in visualizing the electron's spatial distribution
-    # grid_extent = 480
-    # grid_resolution = 100
-    z = x = y = np.linspace(-grid_extent, grid_extent, grid_resolution)
-    z, x, y= np.meshgrid(z, x, y)
-
-    # Using an epsilon value to prevent division by zero during the calculation of angles
-    eps = np.finfo(float).eps
+def selectobj(obj):
+    obj.select_set(state=True)
 
-    # Compute the wavefunction by multiplying the radial and angular parts.
-    # The radial part considers the distance from the nucleus, whereas the angular part
-    # looks into the spatial orientation. Together, they define the electron's behavior
-    # in the atom's vicinity
-    r,theta,phi = asSpherical(x,y,z,eps)
+# the material shared by all iso levels, and the object custom properties it reads
+ISO_MATERIAL = "orb_iso_material"
+ISO_MATERIAL_VERSION = 1
+ISO_PROPERTIES = ("orb_color_value", "orb_alpha", "orb_color_low", "orb_color_high", "orb_emission")
 
-    psi = radial_function(n, l, r, a0) * angular_function(m, l, theta, phi)
+# material of the meshes holding all levels, which carry the color value and alpha
+# per vertex instead of per object
+MERGED_MATERIAL = "orb_merged_material"
 
-    # Return the computed wavefunction, which encapsulates the quantum state
-    # of an electron in a hydrogen atom. The wavefunction contains complex amplitudes
-    # that provide information about the quantum state's magnitude and phase
-    return psi
+def iso_material(name=ISO_MATERIAL, level_attributes='OBJECT'):
+    """ Return the material shared by all iso levels, created on first use.
 
+    The node tree reads the settings of a level from custom properties of the object
+    (see set_iso_properties) through Attribute nodes, so a single material serves every
+    level of every run and no node tree is built per level.
 
-# Probability density |Ψ|^2
-def compute_probability_density(psi):
-    """ Compute the probability density of a given wavefunction.
     Args:
-        psi (numpy.ndarray): wavefunction
-    Returns:
-        numpy.ndarray: wavefunction probability density
+        name (str): name of the material
+        level_attributes (str): attribute type of orb_color_value and orb_alpha, 'OBJECT'
+            for one level per object or 'GEOMETRY' for the per-vertex attributes of a
+            mesh holding all levels
     """
-
-    # Return the computed probability density, which gives the likelihood of finding
-    # the electron at a specific point in space for the given quantum state. The
-    # values represent the square magnitude of the wavefunction, encapsulating the
-    # probability of the electron's presence in different regions of the atom
-    return np.abs(psi) ** 2
-
-def create_mesh_for(objname,verts,faces):
-    me = bpy.data.meshes.new(objname)  # create a new mesh
-    me.from_pydata(verts,[],faces)
-    me.update()      # update the mesh with the new data
-
-
-    bm = bmesh.new()
-    bm.from_mesh(me)
-    bmesh.ops.remove_doubles(bm, verts=bm.verts, dist=0.01)
-    bm.to_mesh(me)
-
-    ob = bpy.data.objects.new(objname,me) # create a new object
-    ob.data = me          # link the mesh data to the object
-    return ob
-   
-def make_object_in_scene(object_name,verts,faces):
-
-    block=create_mesh_for(object_name,verts,faces)
-
-    bpy.context.collection.objects.link(block)
-    selectobj(block)
-    
-    #recalculate normals to outside
-    # block.select_set(state=True)
-    # bpy.context.view_layer.objects.active = block    # go edit mode
-    # bpy.ops.object.mode_set(mode='EDIT')
-    # # select al faces
-    # bpy.ops.mesh.select_all(action='SELECT')
-    # # recalculate outside normals 
-    # bpy.ops.mesh.normals_make_consistent(inside=False)
-    # # go object mode again
-    # bpy.ops.object.editmode_toggle()
-    
-    return block
-
-def selectobj(obj):
-    for o2 in bpy.context.scene.objects:
-        if o2==obj: 
-            o2.select_set(state=True)
-
-def create_material(obj,name,color_value,alpha_value):
-    mat = bpy.data.materials.new(name)
+    mat = bpy.data.materials.get(name)
+    if mat is not None and mat.get("orb_material_version") == ISO_MATERIAL_VERSION:
+        return mat
+    if mat is None:
+        mat = bpy.data.materials.new(name)
     mat.use_nodes = True
     mat_nodes = mat.node_tree.nodes
     mat_links = mat.node_tree.links
-    # a new material node tree already has a diffuse and material output node
-    #output = mat_nodes['Material Output']
-    diffuse = mat_nodes['Principled BSDF']
-
-    # obj = bpy.context.active_object
-    #add new material to object
-    obj.data.materials.append(mat)
-    #added material will be last in material slots
-    #so make last slot active
-    obj.active_material_index = len(obj.data.materials) - 1 
-
-    # add new Color Ramp and set location
-    ramp = mat_nodes.new("ShaderNodeValToRGB")
+    mat_nodes.clear()
+
+    output = mat_nodes.new("ShaderNodeOutputMaterial")
+    output.location=(300,0)
+    diffuse = mat_nodes.new("ShaderNodeBsdfPrincipled")
+    diffuse.location=(0,0)
+    mat_links.new(output.inputs["Surface"], diffuse.outputs["BSDF"])
+
+    def attribute(name, y, attribute_type='OBJECT'):
+        node = mat_nodes.new("ShaderNodeAttribute")
+        node.attribute_type = attribute_type
+        node.attribute_name = name
+        node.location = (-700, y)
+        return node
+
+    value = attribute("orb_color_value", 250, level_attributes)
+    color_low = attribute("orb_color_low", 50)
+    color_high = attribute("orb_color_high", -150)
+    emission = attribute("orb_emission", -350)
+    alpha = attribute("orb_alpha", -550, level_attributes)
+
+    # color ramp from the low to the high color, as a color mix; in RGBA mode the
+    # inputs 6 and 7 are the colors and the output 2 is the mixed color
+    ramp = mat_nodes.new("ShaderNodeMix")
+    ramp.data_type = 'RGBA'
     ramp.location=(-300,170)
-    # add new Value node and set location
-    value = mat_nodes.new("ShaderNodeValue")
-    value.location=(-500,95)
-    # add Math node
+    mat_links.new(ramp.inputs[0], value.outputs["Fac"])
+    mat_links.new(ramp.inputs[6], color_low.outputs["Color"])
+    mat_links.new(ramp.inputs[7], color_high.outputs["Color"])
+    mat_links.new(diffuse.inputs["Base Color"], ramp.outputs[2])
+    mat_links.new(diffuse.inputs["Emission Color"], ramp.outputs[2])
+
+    # emission strength is the color value times the emission of the run
     math = mat_nodes.new("ShaderNodeMath")
-    math.location=(-250,-50)
+    math.location=(-250,-250)
     math.operation="MULTIPLY"
+    mat_links.new(math.inputs[0], value.outputs["Fac"])
+    mat_links.new(math.inputs[1], emission.outputs["Fac"])
+    mat_links.new(diffuse.inputs["Emission Strength"], math.outputs[0])
 
-    # link Color Ramp to Principled BSDF
-    mat_links.new(diffuse.inputs[0], ramp.outputs[0])
-    # link Value node to Color Ramp
-    mat_links.new(ramp.inputs[0], value.outputs[0])
-    # link Math node to Principled BSDF Emission Strenght 
-    mat_links.new(diffuse.inputs[28], math.outputs[0])
-    # link Value node to Math node
-    mat_links.new(math.inputs[0], value.outputs[0])
-    # link Color Ranp node to Principled BSDF Emission Color
-    mat_links.new(diffuse.inputs[27], ramp.outputs[0])
-
-    # set Value node value
-    value.outputs["Value"].default_value=color_value
-    # set math node multiply value
-    math.inputs[1].default_value=10
-
-    ramp.color_ramp.elements[0].color=[1,0,0,1]
-    ramp.color_ramp.elements[1].color=[1,1,0,1]
-
+    mat_links.new(diffuse.inputs["Alpha"], alpha.outputs["Fac"])
     diffuse.inputs.get("Metallic").default_value=0
-    diffuse.inputs.get("Alpha").default_value=alpha_value
 
-def plot_wf_probability_density(n, l, m, a0_scale_factor,grid_extent,grid_resolution):
-    """ Plot the probability density of the hydrogen
-    atom's wavefunction for a given quantum state (n,l,m).
+    mat["orb_material_version"] = ISO_MATERIAL_VERSION
+    return mat
 
-    Args:
-        n (int): principal quantum number, determines the energy level and size of the orbital
-        l (int): azimuthal quantum number, defines the shape of the orbital
-        m (int): magnetic quantum number, defines the orientation of the orbital
-        a0_scale_factor (float): Bohr radius scale factor
+def set_iso_properties(obj,color_value,alpha_value,color_low=(1,0,0,1),color_high=(1,1,0,1),
+                       emission_strength=10):
+    """ Store the material settings of an iso level on its object, read by iso_material.
+
+    The color goes from color_low at the lowest iso level to color_high at the highest
+    one, and the emission is emission_strength times the level's color value.
     """
+    obj["orb_color_value"] = float(color_value)
+    obj["orb_alpha"] = float(alpha_value)
+    obj["orb_color_low"] = [float(channel) for channel in color_low]
+    obj["orb_color_high"] = [float(channel) for channel in color_high]
+    obj["orb_emission"] = float(emission_strength)
+
+def create_material(obj,color_value,alpha_value,color_low=(1,0,0,1),color_high=(1,1,0,1),
+                    emission_strength=10):
+    """ Give obj the shared iso material with the settings of its level and return the material. """
+    mat = iso_material()
+    obj.data.materials.append(mat)
+    #added material will be last in material slots
+    #so make last slot active
+    obj.active_material_index = len(obj.data.materials) - 1 
+    set_iso_properties(obj,color_value,alpha_value,color_low,color_high,emission_strength)
+    return mat
 
-    # Quantum numbers validation
-    if not isinstance(n, int) or n < 1:
-        raise ValueError('n should be an integer satisfying the condition: n >= 1')
-    if not isinstance(l, int) or not (0 <= l < n):
-        raise ValueError('l should be an integer satisfying the condition: 0 <= l < n')
-    if not isinstance(m, int) or not (-l <= m <= l):
-        raise ValueError('m should be an integer satisfying the condition: -l <= m <= l')
+# Datablocks created by the add-on are tagged with OWNER_PROPERTY and their names are
+# kept per bpy.data collection in the REGISTRY_PROPERTY group of the scene. Both are
+# ID properties, so they are saved with the file and follow undo. The previous
+# orbitals are removed by name through bpy.data, without scanning the file.
+OWNER_PROPERTY = "orb_owner"
+REGISTRY_PROPERTY = "orb_datablocks"
 
-    psi = compute_wavefunction(n, l, m, a0_scale_factor,grid_extent,grid_resolution)
-    # print("psi shape: ",psi.shape)
+def register_datablock(scene, kind, block):
+    """ Remember a datablock created by the add-on.
 
-    return psi
+    Args:
+        scene (bpy.types.Scene): scene holding the registry
+        kind (str): name of the bpy.data collection of the block, like "objects"
+        block (bpy.types.ID): the datablock
+    """
+    block[OWNER_PROPERTY] = True
+    if REGISTRY_PROPERTY not in scene:
+        scene[REGISTRY_PROPERTY] = {}
+    registry = scene[REGISTRY_PROPERTY]
+    if kind not in registry:
+        registry[kind] = {}
+    registry[kind][block.name] = 1
+
+def registered_datablocks(scene, kind):
+    """ The datablocks of one kind registered in scene that still exist. """
+    registry = scene.get(REGISTRY_PROPERTY)
+    if registry is None or kind not in registry:
+        return []
+    collection = getattr(bpy.data, kind)
+    blocks = []
+    for name in registry[kind].keys():
+        block = collection.get(name)
+        # a block of the same name the add-on did not create is left alone
+        if block is not None and block.get(OWNER_PROPERTY):
+            blocks.append(block)
+    return blocks
+
+def adopt_legacy_orbitals(scene):
+    """ Register the orb_ mesh objects of a scene made before the registry existed.
+
+    Runs once per scene; afterwards the registry exists and no scan is needed.
+    """
+    if REGISTRY_PROPERTY in scene:
+        return
+    scene[REGISTRY_PROPERTY] = {}
+    for ob in scene.objects:
+        if ob.type == 'MESH' and ob.name.startswith("orb_"):
+            register_datablock(scene, "objects", ob)
+            register_datablock(scene, "meshes", ob.data)
+
+def remove_object(obj):
+    """ Remove an object and its mesh if nothing else uses the mesh. """
+    mesh = obj.data
+    bpy.data.objects.remove(obj, do_unlink=True)
+    if mesh is not None and mesh.users == 0:
+        bpy.data.meshes.remove(mesh)
+
+def remove_registered_datablocks(scene):
+    """ Remove the objects, meshes, node groups, actions and emptied collections registered in scene. """
+    for obj in registered_datablocks(scene, "objects"):
+        remove_object(obj)
+    for mesh in registered_datablocks(scene, "meshes"):
+        if mesh.users == 0:
+            bpy.data.meshes.remove(mesh)
+    for group in registered_datablocks(scene, "node_groups"):
+        if group.users == 0:
+            bpy.data.node_groups.remove(group)
+    for action in registered_datablocks(scene, "actions"):
+        if action.users == 0:
+            bpy.data.actions.remove(action)
+    for collection in registered_datablocks(scene, "collections"):
+        if not collection.objects and not collection.children:
+            bpy.data.collections.remove(collection)
+    scene[REGISTRY_PROPERTY] = {}
+
+def cache_directory():
+    """ Directory of the on-disk density volume cache, inside the extension's user directory. """
+    return bpy.utils.extension_path_user(__package__, path="density_cache", create=True)
+
+# stage reports and profiles kept in the report directory, the oldest ones are deleted
+KEPT_REPORTS = 20
+
+def report_directory():
+    """ Directory of the stage reports and profiles, inside the extension's user directory. """
+    return bpy.utils.extension_path_user(__package__, path="reports", create=True)
 
 def collection_add(col_name,obj):
 
@@ -291,6 +324,52 @@ def collection_add(col_name,obj):
     # add the object into the collection 
     collection.objects.link(obj)
 
+def orbital_collection(col_name):
+    """ Return the collection col_name, created, linked to the scene and made active if it is new. """
+    try:
+        collection = bpy.data.collections[col_name]
+    except:
+        collection = bpy.data.collections.new(name=col_name)
+        register_datablock(bpy.context.scene, "collections", collection)
+
+        # retrieve the scene collection
+        scene_collection = bpy.context.scene.collection
+
+        # link the new collection into the scene
+        try:
+            scene_collection.children.link(collection)
+        except:
+            bla=1
+
+        bpy.context.view_layer.active_layer_collection = bpy.context.view_layer.layer_collection.children[collection.name]
+    return collection
+
+def frame_selected():
+    """ Frame the selected objects in the first 3D viewport. """
+    area_type = 'VIEW_3D'
+    areas  = [area for area in bpy.context.window.screen.areas if area.type == area_type]
+    if not areas:
+        return
+    with bpy.context.temp_override(
+        window=bpy.context.window,
+        area=areas[0],
+        region=[region for region in areas[0].regions if region.type == 'WINDOW'][0],
+        screen=bpy.context.window.screen):
+        bpy.ops.view3d.view_selected()
+
+def keyframe_visibility(obj, frame, first_frame, last_frame):
+    """ Key obj to be shown in the viewport and in renders on frame only.
+
+    Visibility keys hold their value until the next key, so a hidden key on the
+    frames before and after is enough, within first_frame and last_frame.
+    """
+    for data_path in ("hide_viewport", "hide_render"):
+        for key_frame, hidden in ((frame - 1, True), (frame, False), (frame + 1, True)):
+            if first_frame <= key_frame <= last_frame:
+                setattr(obj, data_path, hidden)
+                obj.keyframe_insert(data_path=data_path, frame=key_frame)
+    register_datablock(bpy.context.scene, "actions", obj.animation_data.action)
+
     ##################################################################################################
 # Define UI and execute
 
@@ -337,6 +416,20 @@ class Electron_orbitals_input(Operator):
                 default=480
                 )
     
+    auto_extent: BoolProperty(
+                name="Automatic grid extent",
+                description="Size the grid extent to the radius of the lowest iso level, or of the "
+                            "largest enclosed probability, computed before the grid is built",
+                default=False
+                )
+
+    voxel_size: FloatProperty(
+                name="Voxel size",
+                description="Grid spacing implied by the grid extent and resolution",
+                options={'SKIP_SAVE'},
+                default=0.0
+                )
+
     grid_resolution: IntProperty(
                 name="Grid resolution >= 1",
                 description="The resolution of the grid",
@@ -344,6 +437,19 @@ class Electron_orbitals_input(Operator):
                 default=400
                 )
     
+    level_mode: EnumProperty(
+                name="Iso levels",
+                description="How the iso values of the levels are chosen",
+                items=(
+                    ('GEOMETRIC', "Geometric",
+                     "Space the iso values geometrically between the maximum and the minimum of the density"),
+                    ('PROBABILITY', "Enclosed probability",
+                     "Choose the iso values whose isosurfaces enclose the given percentages of "
+                     "the probability of finding the electron on the grid"),
+                ),
+                default='GEOMETRIC'
+                )
+
     levels: IntProperty(
                 name="Number of iso levels <= 30, >=1",
                 description="Number of isosurfaces to generate",
@@ -352,6 +458,20 @@ class Electron_orbitals_input(Operator):
                 max=30
                 )
 
+    probabilities: StringProperty(
+                name="Enclosed probabilities (%)",
+                description="Percentages of the electron enclosed by the isosurfaces, one level each, "
+                "separated by spaces or commas",
+                default="50 90 99"
+                )
+
+    threshold_report: StringProperty(
+                name="Iso values",
+                description="Iso values of the enclosed probabilities of the last generation",
+                options={'SKIP_SAVE'},
+                default=""
+                )
+
     sf: FloatProperty(
                 name="Bohr radius scale Factor <= 3, >= 0",
                 description="The Bohr radius sets the scale of the wavefunction "
@@ -362,6 +482,235 @@ class Electron_orbitals_input(Operator):
                 default=0.4
                 )
 
+    point_cloud: BoolProperty(
+                name="Monte-Carlo point cloud",
+                default=False,
+                description="Instead of isosurfaces, draw electron positions distributed like the "
+                "probability density, without any density grid or marching cubes; the cost "
+                "grows with the number of points only, which suits high quantum numbers"
+                )
+
+    point_count: IntProperty(
+                name="Points",
+                description="Number of sampled electron positions",
+                min=1000,
+                max=100000000,
+                default=1000000
+                )
+
+    point_seed: IntProperty(
+                name="Seed",
+                description="Seed of the random positions, the same seed gives the same points",
+                min=0,
+                default=0
+                )
+
+    point_radius: FloatProperty(
+                name="Point radius",
+                description="Radius of the rendered points in grid spacings",
+                min=0.001,
+                max=100.0,
+                default=0.5
+                )
+
+    superposition: StringProperty(
+                name="Superposition",
+                description="Animate a superposition of states instead of n, l, m, like "
+                "\"2,1,0 1,0,0\": every term is n,l,m with an optional :amplitude and "
+                "@phase in degrees. Leave empty for a single state",
+                default=""
+                )
+
+    animation_frames: IntProperty(
+                name="Frames",
+                description="Number of animation frames of the superposition",
+                min=1,
+                max=1000,
+                default=48
+                )
+
+    frames_per_beat: IntProperty(
+                name="Frames per beat",
+                description="Frames of one period of the fastest beat between the energies "
+                "of the states",
+                min=2,
+                max=1000,
+                default=24
+                )
+
+    evaluation: EnumProperty(
+                name="Evaluation",
+                description="How the probability density volume is evaluated",
+                items=(
+                    ('DENSE', "Dense grid",
+                     "Evaluate the whole grid at once (fast, needs the most memory)"),
+                    ('SLABS', "Memory-bounded slabs",
+                     "Evaluate the grid slab by slab into one float32 volume, "
+                     "keeping the scratch memory within the memory budget"),
+                    ('SYMMETRIC', "Mirror symmetric octant",
+                     "Evaluate and extract isosurfaces on one octant only and "
+                     "mirror the result into the other seven octants"),
+                    ('ADAPTIVE', "Adaptive refinement",
+                     "Evaluate a coarse grid of the grid resolution and refine only the blocks "
+                     "the isosurfaces pass through, up to the target resolution"),
+                ),
+                default='DENSE'
+                )
+
+    target_resolution: IntProperty(
+                name="Target resolution",
+                description="Effective grid resolution reached by adaptive refinement",
+                min=2,
+                default=1600
+                )
+
+    memory_budget: IntProperty(
+                name="Memory budget (MiB)",
+                description="Scratch memory allowed when evaluating in slabs, shared by the slabs "
+                            "evaluated at the same time, and by the superposition frames processed at the same time. "
+                            "The float32 density volume comes on top of it",
+                min=16,
+                default=512
+                )
+
+    use_cache: BoolProperty(
+                name="Cache density volumes on disk",
+                description="Keep computed probability density volumes in an on-disk cache "
+                            "and memory-map them on the next run with the same quantum state and grid",
+                default=False
+                )
+
+    cache_size: IntProperty(
+                name="Cache size (MiB)",
+                description="Size of the density volume cache, the least recently used "
+                            "volumes are removed when it is exceeded",
+                min=64,
+                default=4096
+                )
+
+    use_factor_cache: BoolProperty(
+                name="Reuse radial and angular factors",
+                description="Keep the radial and angular factors of the density in memory, so that "
+                            "changing n or m only recomputes the factor that changed "
+                            "(memory-bounded slabs and mirror symmetric octant evaluations)",
+                default=True
+                )
+
+    workers: IntProperty(
+                name="Workers (0 = all cores)",
+                description="Number of density slabs evaluated and iso levels extracted at the same time",
+                min=0,
+                default=0
+                )
+
+    parallel_backend: EnumProperty(
+                name="Workers",
+                description="How the iso levels are extracted in parallel",
+                items=(
+                    ('PROCESS', "Processes",
+                     "Extract in worker processes reading the density volume from shared memory, "
+                     "when the levels scan enough voxels to be worth starting them"),
+                    ('THREAD', "Threads",
+                     "Extract in threads sharing the density volume. Marching cubes holds the GIL, "
+                     "so the levels are extracted one after the other"),
+                ),
+                default='PROCESS'
+                )
+
+    crop : BoolProperty(
+            name="Crop marching cubes to active boxes",
+            default=True,
+            description="Run marching cubes only on the bounding box of the voxels "
+            "reaching each iso value, searched inside the box of the level below it"
+            )
+
+    keep_session : BoolProperty(
+            name="Reuse results between runs",
+            default=True,
+            description="Keep the density volume, isosurfaces and levels of detail in memory: "
+            "a new run only computes what depends on the inputs that changed, "
+            "e.g. material changes reuse all geometry and extra levels only extract the new iso values"
+            )
+
+    merge_levels : BoolProperty(
+            name="Single mesh for all levels",
+            default=False,
+            description="Put all iso levels into one object and mesh with the per-vertex attributes "
+            "orb_level, orb_psi (signed wavefunction) and orb_density, colored by one shared material, "
+            "instead of one object per level"
+            )
+
+    viewport_lod : BoolProperty(
+            name="Light viewport meshes",
+            default=True,
+            description="Show a decimated copy of iso surfaces above the viewport face budget "
+            "in the viewport and keep the full mesh for rendering only"
+            )
+
+    viewport_faces : IntProperty(
+                name="Viewport face budget",
+                description="Maximum number of triangles of the viewport copy of an iso surface",
+                min=1000,
+                default=250000
+                )
+
+    color_low : FloatVectorProperty(
+                name="Low density color",
+                subtype='COLOR',
+                size=4,
+                min=0.0,
+                max=1.0,
+                default=(1.0, 0.0, 0.0, 1.0),
+                description="Color of the lowest iso level, changing it reuses all geometry"
+                )
+
+    color_high : FloatVectorProperty(
+                name="High density color",
+                subtype='COLOR',
+                size=4,
+                min=0.0,
+                max=1.0,
+                default=(1.0, 1.0, 0.0, 1.0),
+                description="Color of the highest iso level, changing it reuses all geometry"
+                )
+
+    emission_strength : FloatProperty(
+                name="Emission strength",
+                min=0.0,
+                max=100.0,
+                default=10.0,
+                description="Emission of an iso level is this times its color value"
+                )
+
+    record_stages : BoolProperty(
+            name="Record stage report",
+            default=True,
+            description="Time every stage of the generation and write a JSON report "
+            "to the extension's user directory, summarized in this panel. Only the last "
+            + str(KEPT_REPORTS) + " reports are kept"
+            )
+
+    trace_memory : BoolProperty(
+            name="Trace memory per stage",
+            default=False,
+            description="Record the memory high-water mark of every stage (slows down "
+            "allocation heavy stages a little)"
+            )
+
+    use_cprofile : BoolProperty(
+            name="Profile with cProfile",
+            default=False,
+            description="Run the generation under cProfile, print the slowest functions "
+            "and save the profile next to the stage report"
+            )
+
+    stage_report : StringProperty(
+            name="Stage report",
+            default="",
+            options={'SKIP_SAVE'},
+            description="Summary of the stages of the last generation"
+            )
+
     delete_orbs : BoolProperty(
             name="Delete all generated iso surfaces objects?",
             default=True,
@@ -381,170 +730,646 @@ class Electron_orbitals_input(Operator):
         layout.operator("wm.operator_defaults")
         # layout.operator_context = 'INVOKE_REGION_WIN'
 
+        self.draw_inputs(layout)
+        box = layout.box()
+        box.prop(self, "ok", toggle=True)
+        if self.stage_report:
+            box = layout.box()
+            box.label(text="Last generation:")
+            for line in self.stage_report.splitlines():
+                box.label(text=line)
+
+    def draw_inputs(self, layout):
         box = layout.box()
         #box.label(text="Input")
         col = box.column(align=True)
         col.prop(self, "n")
         col.prop(self, "l")
         col.prop(self, "m")
-        col.prop(self, "grid_extent")
+        row = col.row()
+        row.enabled = not self.auto_extent
+        row.prop(self, "grid_extent")
+        col.prop(self, "auto_extent")
+        if self.auto_extent:
+            col.label(text="Voxel size: " + str(round(self.voxel_size, 3)))
         col.prop(self, "grid_resolution")
-        col.prop(self, "levels")
+        col.prop(self, "level_mode")
+        if self.level_mode == 'PROBABILITY':
+            col.prop(self, "probabilities")
+            for line in self.threshold_report.splitlines():
+                col.label(text=line)
+        else:
+            col.prop(self, "levels")
         col.prop(self, "sf")
+        col.prop(self, "point_cloud")
+        if self.point_cloud:
+            col.prop(self, "point_count")
+            col.prop(self, "point_seed")
+            col.prop(self, "point_radius")
+        col.prop(self, "superposition")
+        if self.superposition.strip():
+            col.prop(self, "animation_frames")
+            col.prop(self, "frames_per_beat")
+        col.prop(self, "evaluation")
+        if self.evaluation == 'ADAPTIVE':
+            col.prop(self, "target_resolution")
+        if self.evaluation in {'SLABS', 'SYMMETRIC', 'ADAPTIVE'}:
+            col.prop(self, "memory_budget")
+        if self.evaluation in {'SLABS', 'SYMMETRIC'}:
+            col.prop(self, "use_factor_cache")
+        col.prop(self, "use_cache")
+        if self.use_cache:
+            col.prop(self, "cache_size")
+        col.prop(self, "parallel_backend")
+        col.prop(self, "workers")
+        col.prop(self, "crop")
+        col.prop(self, "keep_session")
+        col.prop(self, "merge_levels")
+        col.prop(self, "viewport_lod")
+        if self.viewport_lod:
+            col.prop(self, "viewport_faces")
+        col.prop(self, "color_low")
+        col.prop(self, "color_high")
+        col.prop(self, "emission_strength")
+        col.prop(self, "record_stages")
+        if self.record_stages:
+            col.prop(self, "trace_memory")
+        col.prop(self, "use_cprofile")
         col.prop(self, "delete_orbs")
-        box = layout.box()
-        box.prop(self, "ok", toggle=True)
+
+    def show_thresholds(self, result):
+        """ Keep the iso values of the enclosed probability levels of result for the redo panel. """
+        self.threshold_report = "\n".join(str(round(100 * probability, 3)) + " %: iso " + "%.4g" % iso
+                                           for probability, iso in result.report.get("thresholds", []))
+        if self.threshold_report:
+            print("enclosed probability iso values:", self.threshold_report.replace("\n", ", "))
+
+    def write_reports(self, result, instrument, profiler):
+        """ Save the stage report and profile of a generation and summarize them in the redo panel. """
+        base = os.path.join(report_directory(), result.name + "_" + datetime.datetime.now().strftime("%Y%m%d_%H%M%S"))
+        lines = []
+        if instrument is not None:
+            instrument.stop()
+            parameters = {name: getattr(self, name) for name in
+                          ("n", "l", "m", "sf", "grid_extent", "grid_resolution", "levels", "level_mode",
+                           "probabilities", "evaluation",
+                           "memory_budget", "target_resolution", "workers", "parallel_backend", "crop")}
+            report = instrument.report(parameters=parameters, name=result.name, engine=result.report)
+            write_report(base + ".json", report)
+            lines = instrument.summary()
+            lines.append("total " + str(round(report["total_seconds"], 2)) + " s")
+            if result.report.get("session_hit"):
+                lines.append("density reused, " + str(result.report.get("reused_levels", len(result.levels))) +
+                             " of " + str(len(result.levels)) + " levels reused")
+            print("stage report written to", base + ".json")
+            for line in lines:
+                print("   ", line)
+        if profiler is not None:
+            profiler.dump_stats(base + ".prof")
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+            lines.append("profile: " + os.path.basename(base) + ".prof")
+        prune_reports(report_directory(), KEPT_REPORTS)
+        self.stage_report = "\n".join(lines)
 
     def invoke(self,context,event):
         return self.execute(context)
         # return context.window_manager.invoke_props_dialog(self)
     
-    def execute(self, context):
-
-        #start time recording
-        if self.ok==True:
-            start_time = time.time()
-
-        if bpy.context.mode!='OBJECT': # if not in OBJECT mode, set OBJECT mode
-            bpy.ops.object.mode_set(mode='OBJECT')
-            bpy.ops.object.select_all(action='DESELECT')
+    def cleanup_scene(self, instrument=None):
+        """ Leave edit mode and remove (or show again) the orbitals of previous runs.
+
+        Only the datablocks in the registry of the scene are touched, so the cost does not
+        grow with the rest of the file.
+        """
+        with maybe_stage(instrument, "scene_cleanup"):
+            if bpy.context.mode!='OBJECT': # if not in OBJECT mode, set OBJECT mode
+                bpy.ops.object.mode_set(mode='OBJECT')
+                bpy.ops.object.select_all(action='DESELECT')
+
+            scene = bpy.context.scene
+            adopt_legacy_orbitals(scene)
+
+            #delete all objects from previous run if applicable 
+            if self.delete_orbs:
+                remove_registered_datablocks(scene)
+            else:
+                #unhide the objects of previous runs
+                for obj in registered_datablocks(scene, "objects"):
+                    obj.hide_set(False)
+                    obj.hide_viewport=False
         
-        #unhide all hidden objects
-        for obj in bpy.data.objects:
-            obj.hide_set(False)
-            obj.hide_viewport=False
-
-        #delete all objects from previous run if applicable 
-        if self.delete_orbs:
-            #Delete previous generated Blender MESH objects
-            bpy.ops.object.select_all(action='DESELECT')
-            for ob in bpy.context.scene.objects:
-                if ob.type == 'MESH' and ob.name.startswith("orb_"):
-                    #Select the object
-                    ob.select_set(state=True)
-            #Delete all objects selected above 
-            bpy.ops.object.delete()
- 
-        # remove unsused blocks
-        for block in bpy.data.meshes:
-            if block.users == 0:
-                bpy.data.meshes.remove(block)
-        for block in bpy.data.texts:
-            if block.users == 0:
-                bpy.data.texts.remove(block)
-        for block in bpy.data.node_groups:
-            if block.users == 0:
-                bpy.data.node_groups.remove(block)
-        for block in bpy.data.actions:
-            if block.users == 0:
-                bpy.data.actions.remove(block)
-        for block in bpy.data.curves:
-            if block.users == 0:
-                bpy.data.curves.remove(block)
-        for block in bpy.data.cameras:
-            if block.users == 0:
-                bpy.data.cameras.remove(block)
-        for block in bpy.data.materials:
-            if block.users == 0:
-                bpy.data.materials.remove(block)
+            bpy.context.scene.cursor.location = (0,0,0) #put curser in world center
+            bpy.context.scene.cursor.rotation_euler = (0,0,0) #put curser in world center
+
+    def engine_arguments(self, instrument=None):
+        """ Keyword arguments of generate_orbital for the current settings.
+
+        Raises:
+            ValueError: the enclosed probabilities cannot be parsed
+        """
+        cache = None
+        if self.use_cache:
+            cache = DensityCache(cache_directory(), self.cache_size * 1024 * 1024)
+        probabilities = ()
+        if self.level_mode == 'PROBABILITY':
+            probabilities = parse_probabilities(self.probabilities)
+        if not self.keep_session:
+            session.clear()
+        return dict(n=self.n, l=self.l, m=self.m, sf=self.sf, grid_extent=self.grid_extent,
+                    grid_resolution=self.grid_resolution, levels=self.levels, evaluation=self.evaluation,
+                    memory_budget_mb=self.memory_budget, target_resolution=self.target_resolution,
+                    auto_extent=self.auto_extent, cache=cache, workers=self.workers,
+                    backend=self.parallel_backend, crop=self.crop,
+                    lod_budgets=[self.viewport_faces] if self.viewport_lod else [],
+                    factors=default_factor_cache if self.use_factor_cache else None, instrument=instrument,
+                    session=session if self.keep_session else None, probabilities=probabilities)
+
+    def add_level(self, col_name, level, surface, instrument=None, collection=None):
+        """ Create the object and material of one iso level.
+
+        Args:
+            col_name (str): name of the orbital collection, the object names start with it
+            level (tuple): (isostep, iso, color_value, alpha_value) of the level
+            surface (tuple): (vertices, faces, normals) of the level
+            instrument (orbital_engine.Instrument): records the mesh and material stages
+            collection (bpy.types.Collection): collection to link the object to, None for
+                the active one
+        Returns:
+            tuple: (object, material, numpy.ndarray offset the vertices were moved by)
+        """
+        isostep, iso, color_value, alpha_value = level
+        verts, faces, normals = surface
+
+        obj_name=col_name +"_" + str(isostep)
+
+        obj = make_object_in_scene(obj_name,verts,faces,normals,instrument,collection)
+
+        print(obj_name + " created")
         
-        bpy.context.scene.cursor.location = (0,0,0) #put curser in world center
-        bpy.context.scene.cursor.rotation_euler = (0,0,0) #put curser in world center
+        bpy.ops.object.origin_set(type='ORIGIN_GEOMETRY', center='MEDIAN')
+
+        # the viewport copy is moved by the same offset as the full mesh
+        center = np.array(obj.location, dtype=np.float32)
+        obj.location = [0,0,0]
+
+        print("alpha_value: ", alpha_value)
+        print("color_value: ", color_value)
+        with maybe_stage(instrument, "material", isostep=int(isostep)):
+            mat = create_material(obj,color_value,alpha_value,
+                                  self.color_low,self.color_high,self.emission_strength)
+        return obj, mat, center
+
+    def add_viewport_lod(self, obj, mat, center, lods, instrument=None, collection=None):
+        """ Show the lightest level of detail of lods in the viewport instead of obj.
+
+        Returns:
+            bpy.types.Object: the viewport object, None if there is no level of detail
+        """
+        if not lods:
+            return None
+        # the lightest level of detail within the face budget is shown in the viewport,
+        # the full mesh is only rendered
+        lod_verts, lod_faces, lod_normals = lods[-1]
+        viewport_obj = create_mesh_for(obj.name + "_viewport", lod_verts - center, lod_faces, lod_normals,
+                                       instrument)
+        (collection or bpy.context.collection).objects.link(viewport_obj)
+        register_datablock(bpy.context.scene, "objects", viewport_obj)
+        register_datablock(bpy.context.scene, "meshes", viewport_obj.data)
+        viewport_obj.data.materials.append(mat)
+        # the shared material reads the level settings from the object
+        for key in ISO_PROPERTIES:
+            viewport_obj[key] = obj[key]
+        viewport_obj.hide_render = True
+        obj.hide_viewport = True
+        print(obj.name + "_viewport created with", len(lod_faces), "of", len(obj.data.polygons), "faces")
+        return viewport_obj
+
+    def add_merged_mesh(self, obj_name, merged, levels, mesh_resolution, instrument=None, collection=None):
+        """ Create the object of a MergedSurface with its per-vertex attributes.
+
+        Args:
+            obj_name (str): name of the object and its mesh
+            merged (orbital_engine.MergedSurface): all levels in one mesh
+            levels (list): (isostep, iso, color_value, alpha_value) per level
+            mesh_resolution (int): grid points along each axis of the vertex index space
+            instrument (orbital_engine.Instrument): records the mesh, attribute and material stages
+            collection (bpy.types.Collection): collection to link the object to, None for
+                the active one
+        Returns:
+            bpy.types.Object: the new object
+        """
+        # the grid center is the nucleus, so no origin_set is needed to center the mesh
+        center = np.float32((mesh_resolution - 1) / 2)
+        obj = make_object_in_scene(obj_name, merged.vertices - center, merged.faces, merged.normals, instrument,
+                                   collection, weld=False)
+        color_values = np.array([level[2] for level in levels], dtype=np.float32)
+        alpha_values = np.array([level[3] for level in levels], dtype=np.float32)
+        with maybe_stage(instrument, "attributes", vertices=len(merged.level)):
+            for name, data_type, values in (("orb_level", 'INT', merged.level),
+                                            ("orb_psi", 'FLOAT', merged.psi),
+                                            ("orb_density", 'FLOAT', merged.density),
+                                            ("orb_color_value", 'FLOAT', color_values[merged.level]),
+                                            ("orb_alpha", 'FLOAT', alpha_values[merged.level])):
+                obj.data.attributes.new(name, data_type, 'POINT').data.foreach_set("value", values)
+        with maybe_stage(instrument, "material", levels=len(levels)):
+            mat = iso_material(MERGED_MATERIAL, 'GEOMETRY')
+            obj.data.materials.append(mat)
+            # the color value and alpha come from the vertices, the colors and emission from the object
+            set_iso_properties(obj, 1.0, 1.0, self.color_low, self.color_high, self.emission_strength)
+        print(obj_name + " created with", len(levels), "levels and", len(merged.faces), "faces")
+        return obj
+
+    def add_merged(self, result, instrument=None, collection=None):
+        """ Create one object holding all levels of result, plus its viewport level of detail.
+
+        Returns:
+            list: the new objects
+        """
+        obj = self.add_merged_mesh(result.name + "_levels", merge_result(result, instrument=instrument),
+                                   result.levels, result.mesh_resolution, instrument, collection)
+        if not any(result.lods):
+            return [obj]
+        # the lightest level of detail of every level, merged the same way
+        lightest = [chain[-1] if chain else surface for chain, surface in zip(result.lods, result.surfaces)]
+        viewport_obj = self.add_merged_mesh(obj.name + "_viewport", merge_result(result, lightest, instrument),
+                                            result.levels, result.mesh_resolution, instrument, collection)
+        viewport_obj.hide_render = True
+        obj.hide_viewport = True
+        return [obj, viewport_obj]
+
+    def add_point_cloud(self, result, instrument=None):
+        """ Create the object of a sampled point cloud.
+
+        The positions become the vertices of a mesh without edges or faces, which a
+        geometry nodes modifier turns into points with the shared iso material.
+
+        Args:
+            result (orbital_engine.PointCloudResult): sampled positions
+            instrument (orbital_engine.Instrument): records the mesh ingestion stage
+        Returns:
+            bpy.types.Object: the new object
+        """
+        obj_name = result.name + "_points"
+        with maybe_stage(instrument, "mesh_ingestion", vertices=len(result.points)):
+            me = bpy.data.meshes.new(obj_name)
+            me.vertices.add(len(result.points))
+            me.vertices.foreach_set("co", result.points.ravel())
+            me.update()
+        obj = make_object(obj_name, me)
+
+        mat = iso_material()
+        obj.data.materials.append(mat)
+        # the points take the color of the densest level
+        set_iso_properties(obj, 1.0, 1.0, self.color_low, self.color_high, self.emission_strength)
+
+        group = points_node_group(obj_name, self.point_radius, mat)
+        modifier = obj.modifiers.new("orb_points", 'NODES')
+        modifier.node_group = group
+        print(obj_name + " created with", len(result.points), "points")
+        return obj
+
+    def add_animation(self, result, instrument=None):
+        """ Create the objects of an animated superposition, one per frame and level.
+
+        The isosurfaces change their topology from frame to frame, so every frame gets
+        its own meshes and only the objects of the current frame are visible. All
+        meshes are moved by the grid center instead of their own, so the frames stay in
+        place relative to each other.
+
+        Args:
+            result (orbital_engine.SuperpositionResult): isosurfaces of every frame
+            instrument (orbital_engine.Instrument): records the mesh and material stages
+        """
+        scene = bpy.context.scene
+        first_frame = scene.frame_start
+        last_frame = first_frame + len(result.frames) - 1
+        center = np.float32((result.mesh_resolution - 1) / 2)
+        for k, surfaces in enumerate(result.frames):
+            for (isostep, iso, color_value, alpha_value), (verts, faces, normals) in zip(result.levels, surfaces):
+                obj_name = result.name + "_f" + str(k).zfill(3) + "_" + str(isostep)
+                obj = make_object_in_scene(obj_name, verts - center, faces, normals, instrument)
+                with maybe_stage(instrument, "material", isostep=int(isostep)):
+                    create_material(obj, color_value, alpha_value,
+                                    self.color_low, self.color_high, self.emission_strength)
+                keyframe_visibility(obj, first_frame + k, first_frame, last_frame)
+        scene.frame_end = last_frame
+        scene.frame_set(first_frame)
+        print(result.name + " created with", len(result.frames), "frames")
+
+    @classmethod
+    def poll(cls, context):
+        # the background run shares the session and the factor cache, which are not
+        # thread safe, and fills a collection cleanup_scene would delete
+        return not Electron_orbitals_modal.running
+
+    def execute(self, context):
 
         if self.ok==False:
+            self.cleanup_scene()
             return {'FINISHED'}  #return to operator screen if execute button is not pressed
 
-        psi = plot_wf_probability_density(self.n,self.l, self.m, self.sf, self.grid_extent,self.grid_resolution)
-        prob_density = compute_probability_density(psi)
-        min = prob_density.min()
-        max = prob_density.max()
-
-        if self.levels < 10:
-            nivos=10
-        else:
-            nivos=self.levels
-
-        isostep = 0
-        width=(max-min)/nivos
-        old_min=min+(width/10)
-        old_max=max-(width/10)
-
-        print("min=",min," max=",max)
-        print("old_min=",old_min," old_max=",old_max)
-        print("a0=",a0)
+        #start time recording
+        start_time = time.time()
+
+        # stage report and profiler of this generation, only started once the execute
+        # button is pressed and always stopped, also when the generation fails
+        instrument = None
+        if self.record_stages:
+            instrument = Instrument(trace_memory=self.trace_memory)
+        profiler = None
+        if self.use_cprofile:
+            profiler = cProfile.Profile()
+            profiler.enable()
 
-        col_name="orb_" + str(self.n) + "_" + str(self.l) + "_" + str(self.m) + "_" + str(round(self.sf,2)) + "_" + str(self.grid_extent) + "_" + str(self.grid_resolution)
         try:
-            collection = bpy.data.collections[col_name]
-        except:
-            collection = bpy.data.collections.new(name=col_name)
-
-            # retrieve the scene collection
-            scene_collection = bpy.context.scene.collection
+            self.cleanup_scene(instrument)
+
+            if self.point_cloud:
+                result = sample_orbital(self.n, self.l, self.m, self.sf, self.grid_extent, self.grid_resolution,
+                                        self.point_count, self.levels, self.auto_extent, self.point_seed,
+                                        instrument=instrument)
+                if self.auto_extent:
+                    self.grid_extent = result.grid_extent
+                orbital_collection(result.name)
+                self.add_point_cloud(result, instrument)
+            elif self.superposition.strip():
+                try:
+                    states = parse_superposition(self.superposition)
+                except ValueError as error:
+                    self.report({'ERROR'}, "Superposition: " + str(error))
+                    self.ok = False
+                    return {'CANCELLED'}
+                # one beat of the fastest energy difference takes frames_per_beat frames,
+                # a superposition of one energy does not move
+                period = beat_period(states)
+                step = 0.0 if period is None else period / self.frames_per_beat
+                result = animate_superposition(states, self.sf, self.grid_extent, self.grid_resolution, self.levels,
+                                               [k * step for k in range(self.animation_frames)],
+                                               self.memory_budget, self.workers, self.crop, self.auto_extent,
+                                               default_factor_cache if self.use_factor_cache else None, instrument)
+                if self.auto_extent:
+                    self.grid_extent = result.grid_extent
+                orbital_collection(result.name)
+                self.add_animation(result, instrument)
+            else:
+                try:
+                    arguments = self.engine_arguments(instrument)
+                except ValueError as error:
+                    self.report({'ERROR'}, "Enclosed probabilities: " + str(error))
+                    self.ok = False
+                    return {'CANCELLED'}
+                result = generate_orbital(**arguments)
+                if self.auto_extent:
+                    self.grid_extent = result.grid_extent
+                    self.voxel_size = result.report["voxel_size"]
+                self.show_thresholds(result)
+
+                col_name = result.name
+                orbital_collection(col_name)
+
+                if self.merge_levels:
+                    self.add_merged(result, instrument)
+                else:
+                    # meshes and materials are created in level order so the result is deterministic
+                    for k, (level, surface) in enumerate(zip(result.levels, result.surfaces)):
+                        obj, mat, center = self.add_level(col_name, level, surface, instrument)
+                        if result.lods:
+                            self.add_viewport_lod(obj, mat, center, result.lods[k], instrument)
+
+            frame_selected()
 
-            # link the new collection into the scene
-            try:
-                scene_collection.children.link(collection)
-            except:
-                bla=1
+            bpy.ops.object.select_all(action='DESELECT')
 
-            bpy.context.view_layer.active_layer_collection = bpy.context.view_layer.layer_collection.children[collection.name]
+            elapsed = time.time()-start_time
+            elapsed =round(elapsed)
+            conversion = datetime.timedelta(seconds=elapsed)
+            converted_time = str(conversion)
+            print("Elapsed Time %r"%converted_time)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            if instrument is not None:
+                instrument.stop()
+
+        if instrument is not None or profiler is not None:
+            self.write_reports(result, instrument, profiler)
+        
+        self.ok=False
+        
+        return {'FINISHED'}
 
-        for iso in np.geomspace(max-(width/10),min+(width/20),nivos,endpoint=False):
+# share of the progress bar (start, end in percent) of every stage reported by generate_orbital
+STAGE_PROGRESS = {"density": (0, 60), "marching_cubes": (60, 95), "lod": (95, 100)}
 
-            isostep = isostep + 1
+def run_engine(arguments, events, cancel, profiler=None):
+    """ Run generate_orbital in a background thread.
 
-            # if self.levels less than 10 -> only create the number of iso mesh levels equal as specified in self.levels  
-            if nivos != self.levels:
-                if (10 - self.levels) >= isostep:
-                    continue 
-            
-            obj_name="orb_" + str(self.n) + "_" + str(self.l) + "_" + str(self.m) + "_" + str(round(self.sf,2)) + "_" + str(self.grid_extent) + "_" + str(self.grid_resolution) +"_" + str(isostep)
+    The thread never touches bpy: progress, every finished level and the outcome are
+    put on the events queue as tuples and turned into Blender data by the modal
+    operator on the main thread.
 
-            verts, faces, normals, values = measure.marching_cubes(prob_density,iso,gradient_direction="ascent")
+    Args:
+        arguments (dict): keyword arguments of generate_orbital
+        events (queue.Queue): receives ("progress", stage, fraction), ("level", index,
+            level, surface) and finally one of ("done", result), ("cancelled",) or
+            ("error", exception)
+        cancel (threading.Event): stops the engine once set
+        profiler (cProfile.Profile): profiles the engine run, None to skip
+    """
+    def progress(stage, fraction):
+        events.put(("progress", stage, fraction))
 
-            obj = make_object_in_scene(obj_name,verts,faces)
+    def on_level(index, level, surface):
+        events.put(("level", index, level, surface))
 
-            print(obj_name + " created")
-            
-            bpy.ops.object.origin_set(type='ORIGIN_GEOMETRY', center='MEDIAN')
+    arguments = dict(arguments, progress=progress, on_level=on_level, cancel=cancel)
+    try:
+        if profiler is not None:
+            result = profiler.runcall(generate_orbital, **arguments)
+        else:
+            result = generate_orbital(**arguments)
+        events.put(("done", result))
+    except GenerationCancelled:
+        events.put(("cancelled",))
+    except Exception as error:
+        events.put(("error", error))
+
+class Electron_orbitals_modal(Electron_orbitals_input):
+    """ Generate the orbital in a background thread while Blender stays responsive.
+
+    Every iso level is linked into its orb_ collection as soon as its surface is
+    extracted, the progress bar and status bar follow the engine stages, and Esc
+    cancels the run and removes the levels created so far.
+    """
+    bl_idname = "mesh.generate_electron_orbitals_modal"
+    bl_label = "generate electron orbitals in the background"
+    bl_description = ("Generate electron orbitals in the background, \n"
+                      "levels appear as they are ready, Esc cancels.")
+    # a modal run cannot be redone from the redo panel
+    bl_options = {'REGISTER'}
 
-            obj.location = [0,0,0]
+    # set while a background generation runs; poll, inherited from Electron_orbitals_input,
+    # then keeps both operators from starting another one
+    running = False
 
-            color_value = (( (iso - old_min) / (old_max - old_min) ))
-            
-            #if last loop make alpha value a fixed value for better visualization
-            if isostep == nivos: 
-                alpha_value=0.174
-            else:
-                alpha_value=color_value
+    def draw(self, context):
+        self.draw_inputs(self.layout)
 
-            print("alpha_value: ", alpha_value)
-            print("color_value: ", color_value)
-            create_material(obj,"mat_iso_" + str(isostep),color_value,alpha_value)
+    def invoke(self, context, event):
+        return context.window_manager.invoke_props_dialog(self, width=400)
 
+    def execute(self, context):
+        if self.point_cloud or self.superposition.strip():
+            # sampling takes seconds and has no levels to show one by one, an animation
+            # only has its levels once the densities of all frames are known
+            self.ok = True
+            return Electron_orbitals_input.execute(self, context)
+        self._start_time = time.time()
+
+        # the engine stages are recorded by the worker thread, the scene stages by the
+        # main thread; an instrument only follows one thread
+        self._instrument = None
+        self._scene_instrument = None
+        if self.record_stages:
+            self._instrument = Instrument(trace_memory=self.trace_memory)
+            self._scene_instrument = Instrument(trace_memory=False)
+        self._profiler = cProfile.Profile() if self.use_cprofile else None
 
-        #Frame Viewport to Object 
-        area_type = 'VIEW_3D'
-        areas  = [area for area in bpy.context.window.screen.areas if area.type == area_type]
-        with bpy.context.temp_override(
-            window=bpy.context.window,
-            area=areas[0],
-            region=[region for region in areas[0].regions if region.type == 'WINDOW'][0],
-            screen=bpy.context.window.screen):
-            bpy.ops.view3d.view_selected()
+        try:
+            arguments = self.engine_arguments(self._instrument)
+        except ValueError as error:
+            self.report({'ERROR'}, "Enclosed probabilities: " + str(error))
+            return {'CANCELLED'}
+        if self.auto_extent:
+            # the collection and objects are named after the grid extent, so it is fitted
+            # here rather than by the worker, before the first level arrives
+            self.grid_extent, iso_radius, self.voxel_size = auto_grid_extent(
+                self.n, self.l, self.m, self.sf, self.grid_resolution, self.levels,
+                probabilities=arguments["probabilities"])
+            arguments.update(grid_extent=self.grid_extent, auto_extent=False)
+
+        self.cleanup_scene(self._scene_instrument)
+
+        self._col_name = orbital_name(self.n, self.l, self.m, self.sf, self.grid_extent, self.grid_resolution)
+        self._collection = None
+        self._created = []
+        self._levels = {}
+        self._events = queue.Queue()
+        self._cancel = threading.Event()
+        self._thread = threading.Thread(target=run_engine, args=(arguments, self._events, self._cancel,
+                                                                 self._profiler), daemon=True)
+
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(0.1, window=context.window)
+        wm.progress_begin(0, 100)
+        wm.modal_handler_add(self)
+        Electron_orbitals_modal.running = True
+        self._thread.start()
+        self.show_status(context, "density", 0.0)
+        return {'RUNNING_MODAL'}
+
+    def show_status(self, context, stage, fraction):
+        start, end = STAGE_PROGRESS[stage]
+        percent = start + (end - start) * fraction
+        context.window_manager.progress_update(percent)
+        text = "Electron orbital " + self._col_name + ": " + stage.replace("_", " ") + " " + str(round(percent)) + "%"
+        if self._cancel.is_set():
+            text = text + ", cancelling"
+        else:
+            text = text + ", Esc to cancel"
+        context.workspace.status_text_set(text)
+
+    def modal(self, context, event):
+        if event.type == 'ESC' and event.value == 'PRESS':
+            # the worker stops at its next slab or level and answers with "cancelled"
+            self._cancel.set()
+            context.workspace.status_text_set("Electron orbital " + self._col_name + ": cancelling")
+            return {'RUNNING_MODAL'}
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        while True:
+            try:
+                message = self._events.get_nowait()
+            except queue.Empty:
+                break
+            if message[0] == "progress":
+                self.show_status(context, message[1], message[2])
+            elif message[0] == "level" and not self._cancel.is_set() and not self.merge_levels:
+                self.level_ready(context, *message[1:])
+            elif message[0] == "done" and not self._cancel.is_set():
+                return self.finish(context, message[1])
+            elif message[0] == "error":
+                self.report({'ERROR'}, "Electron orbital generation failed: " + str(message[1]))
+                return self.abort(context)
+            elif message[0] in {"done", "cancelled"}:
+                self.report({'INFO'}, "Electron orbital generation cancelled")
+                return self.abort(context)
+        return {'PASS_THROUGH'}
+
+    def level_ready(self, context, index, level, surface):
+        """ Link the object of a freshly extracted level into the orbital collection. """
+        if self._collection is None:
+            self._collection = orbital_collection(self._col_name)
+        # origin_set works on the selection, so only the new object may be selected
+        bpy.ops.object.select_all(action='DESELECT')
+        obj, mat, center = self.add_level(self._col_name, level, surface, self._scene_instrument,
+                                          self._collection)
+        self._created.append(obj)
+        self._levels[index] = (obj, mat, center)
+
+    def finish(self, context, result):
+        self.show_thresholds(result)
+        if self._collection is None:
+            self._collection = orbital_collection(self._col_name)
+
+        if self.merge_levels:
+            # one mesh needs all levels, so it is only built once the whole run is done
+            self._created.extend(self.add_merged(result, self._scene_instrument, self._collection))
+
+        # the levels of detail are only known once the whole run is done
+        for k, lods in enumerate(result.lods):
+            if k in self._levels:
+                obj, mat, center = self._levels[k]
+                viewport_obj = self.add_viewport_lod(obj, mat, center, lods, self._scene_instrument,
+                                                     self._collection)
+                if viewport_obj is not None:
+                    self._created.append(viewport_obj)
 
         bpy.ops.object.select_all(action='DESELECT')
+        for obj in self._created:
+            obj.select_set(state=True)
+        frame_selected()
+        bpy.ops.object.select_all(action='DESELECT')
 
-        elapsed = time.time()-start_time
-        elapsed =round(elapsed)
-        conversion = datetime.timedelta(seconds=elapsed)
-        converted_time = str(conversion)
-        print("Elapsed Time %r"%converted_time)  
-        
-        self.ok=False
-        
+        print("Elapsed Time %r" % str(datetime.timedelta(seconds=round(time.time() - self._start_time))))
+        if self._instrument is not None:
+            self._instrument.stages.extend(self._scene_instrument.stages)
+        if self._instrument is not None or self._profiler is not None:
+            self.write_reports(result, self._instrument, self._profiler)
+        self.stop(context)
         return {'FINISHED'}
-        
-        
-      
+
+    def abort(self, context):
+        """ Remove the levels created so far and stop. """
+        self._thread.join()
+        for obj in self._created:
+            remove_object(obj)
+        self._created = []
+        if self._instrument is not None:
+            self._instrument.stop()
+        self.stop(context)
+        return {'CANCELLED'}
+
+    def stop(self, context):
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        wm.progress_end()
+        context.workspace.status_text_set(None)
+        Electron_orbitals_modal.running = False
+
+    def cancel(self, context):
+        # Blender is closing the window or file while the run is going on
+        self._cancel.set()
+        self._thread.join()
+        self.stop(context)
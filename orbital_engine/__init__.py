@@ -0,0 +1,25 @@
+# Numerical engine of the hydrogen orbitals extension.
+#
+# Nothing in this package imports bpy, so it runs inside Blender as well as from a
+# plain Python interpreter (see __main__.py for the batch command line).
+
+from .wavefunction import (asSpherical, radial_function, radial_function_poly1d, laguerre_recurrence,
+                           scaled_radial_function, angular_function, wavefunction_cartesian, compute_wavefunction,
+                           compute_wavefunction_slabs, compute_probability_density,
+                           compute_probability_density_slabs, plot_wf_probability_density, check_quantum_numbers,
+                           scaled_bohr_radius, auto_grid_extent, probability_iso)
+from .levels import iso_levels, parse_probabilities, enclosed_probability_isos, probability_levels
+from .isosurface import (extract_isosurface, extract_isosurfaces, adaptive_isosurfaces, weld_vertices,
+                         empty_surface)
+from .lod import decimate_vertex_clustering, decimate_to_budget, lod_chain
+from .cache import DensityCache, make_key
+from .factors import FactorCache, default_factor_cache
+from .instrument import Instrument, maybe_stage, peak_rss_bytes, write_report, prune_reports
+from .session import OrbitalSession
+from .pipeline import EVALUATIONS, OrbitalResult, GenerationCancelled, generate_orbital, orbital_name
+from .sampling import PointCloudResult, sample_positions, sample_orbital
+from .superposition import (SuperpositionResult, parse_superposition, beat_period, superposition_density,
+                            animate_superposition)
+from .merge import MergedSurface, merge_surfaces, vertex_wavefunction, merge_result
+from .export import write_ply, write_npz, write_result
+from .batch import parse_states, run_batch
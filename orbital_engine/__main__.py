@@ -0,0 +1,55 @@
+import argparse
+from .batch import parse_states, run_batch
+from .pipeline import EVALUATIONS
+from .levels import parse_probabilities
+
+# Command line batch generation, run from the extension directory:
+#   python -m orbital_engine 1-4 5,3,2 --resolution 100 200 --levels 3 --output library
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m orbital_engine",
+                                     description="Generate hydrogen orbital isosurfaces without Blender.")
+    parser.add_argument("states", nargs="+",
+                        help="quantum states as n,l,m, or n / n1-n2 for every state of those shells")
+    parser.add_argument("--resolution", type=int, nargs="+", default=[100], help="grid resolutions")
+    parser.add_argument("--extent", type=int, default=480, help="grid extent")
+    parser.add_argument("--auto-extent", action="store_true", help="size the grid extent automatically")
+    parser.add_argument("--sf", type=float, default=0.4, help="Bohr radius scale factor")
+    parser.add_argument("--levels", type=int, default=1, help="number of iso levels")
+    parser.add_argument("--probabilities", nargs="+", default=[],
+                        help="enclosed probabilities in percent, like 50 90 99, instead of --levels")
+    parser.add_argument("--evaluation", choices=EVALUATIONS, default='SYMMETRIC', help="density evaluation")
+    parser.add_argument("--target-resolution", type=int, default=1600,
+                        help="effective resolution of the ADAPTIVE evaluation")
+    parser.add_argument("--memory-budget", type=int, default=512, help="scratch memory per slab in MiB")
+    parser.add_argument("--lod", type=int, nargs="+", default=[],
+                        help="face budgets of extra levels of detail written for every iso level")
+    parser.add_argument("--format", nargs="+", choices=("ply", "npz"), default=["npz"], help="output formats")
+    parser.add_argument("--output", default="orbitals", help="output directory")
+    parser.add_argument("--jobs", type=int, default=0, help="worker processes, 0 for one per CPU core")
+    parser.add_argument("--cache", help="density cache directory")
+    parser.add_argument("--cache-size", type=int, default=4096, help="density cache size in MiB")
+    args = parser.parse_args(argv)
+
+    settings = {
+        "sf": args.sf,
+        "grid_extent": args.extent,
+        "auto_extent": args.auto_extent,
+        "levels": args.levels,
+        "evaluation": args.evaluation,
+        "target_resolution": args.target_resolution,
+        "memory_budget_mb": args.memory_budget,
+        "lod_budgets": args.lod,
+    }
+    if args.probabilities:
+        settings["probabilities"] = parse_probabilities(" ".join(args.probabilities))
+    if args.cache:
+        settings["cache_dir"] = args.cache
+        settings["cache_size"] = args.cache_size
+
+    manifest = run_batch(parse_states(args.states), args.resolution, args.output, args.format, args.jobs,
+                         **settings)
+    print("manifest written to", manifest)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from .cache import DensityCache
+from .pipeline import generate_orbital
+from .export import write_result, write_manifest
+
+def parse_states(specs):
+    """ Expand state specifications into quantum states.
+
+    A specification is either "n,l,m" for one state, "n" for every state of shell n
+    or "n1-n2" for every state of the shells n1 to n2.
+
+    Args:
+        specs (list): state specifications
+    Returns:
+        list: unique (n, l, m) tuples in the order they were given
+    """
+    states = []
+    for spec in specs:
+        parts = spec.split(",")
+        if len(parts) == 3:
+            states.append(tuple(int(part) for part in parts))
+        elif len(parts) == 1:
+            first, _, last = spec.partition("-")
+            for n in range(int(first), int(last or first) + 1):
+                states.extend((n, l, m) for l in range(n) for m in range(-l, l + 1))
+        else:
+            raise ValueError("state should be n,l,m or n or n1-n2, not " + repr(spec))
+    return list(dict.fromkeys(states))
+
+def _quiet(*args):
+    pass
+
+def run_job(job):
+    """ Generate the isosurfaces of one quantum state at one resolution and write them.
+
+    Runs in a worker process of run_batch, so it only takes and returns plain data.
+
+    Args:
+        job (dict): keyword arguments of generate_orbital plus 'output', 'formats'
+            and optionally 'cache_dir' and 'cache_size'
+    Returns:
+        dict: manifest entry
+    """
+    job = dict(job)
+    output = job.pop("output")
+    formats = job.pop("formats")
+    cache_dir = job.pop("cache_dir", None)
+    cache_size = job.pop("cache_size", 4096)
+    cache = DensityCache(cache_dir, cache_size * 1024 * 1024) if cache_dir else None
+
+    start = time.perf_counter()
+    result = generate_orbital(cache=cache, log=_quiet, **job)
+    entry = write_result(output, result, formats)
+    entry["seconds"] = time.perf_counter() - start
+    return entry
+
+def run_batch(states, resolutions, output, formats=("npz",), jobs=0, log=print, **settings):
+    """ Generate a library of orbitals on a process pool.
+
+    Every (state, resolution) pair is one job. Results are written by the worker
+    that computed them as soon as they are ready, and the manifest is rewritten
+    after every finished job, so an interrupted run keeps everything done so far.
+
+    Args:
+        states (list): (n, l, m) tuples
+        resolutions (list): grid resolutions
+        output (str): output directory
+        formats (tuple): any of 'ply' and 'npz'
+        jobs (int): worker processes, 0 uses one per CPU core
+        log (callable): receives progress messages like print
+        **settings: further keyword arguments of generate_orbital (sf, grid_extent,
+            levels, evaluation, ...) and 'cache_dir'/'cache_size'
+    Returns:
+        str: path of the manifest
+    """
+    os.makedirs(output, exist_ok=True)
+    manifest = os.path.join(output, "manifest.json")
+    # one isosurface worker per job, the pool already uses every core
+    settings.setdefault("workers", 1)
+    job_list = [dict(settings, n=n, l=l, m=m, grid_resolution=resolution, output=output, formats=list(formats))
+                for (n, l, m) in states for resolution in resolutions]
+
+    entries = []
+    with ProcessPoolExecutor(jobs or os.cpu_count() or 1) as pool:
+        futures = [pool.submit(run_job, job) for job in job_list]
+        for done, future in enumerate(as_completed(futures), start=1):
+            entry = future.result()
+            entries.append(entry)
+            write_manifest(manifest, entries, settings)
+            log("[" + str(done) + "/" + str(len(job_list)) + "]", entry["name"], "in",
+                round(entry["seconds"], 2), "s")
+
+    entries.sort(key=lambda entry: (entry["n"], entry["l"], entry["m"], entry["grid_resolution"]))
+    write_manifest(manifest, entries, settings)
+    return manifest
@@ -0,0 +1,224 @@
+import os
+import json
+import time
+import hashlib
+import numpy as np
+
+# Persistent on-disk cache of probability density volumes.
+#
+# Every volume is stored as a plain .npy file next to a small .json file holding its
+# key, shape, dtype, size, a fingerprint of the data and the time it was last used.
+# A cache hit memory-maps the .npy file read-only, so the volume is paged in from
+# disk on demand instead of being copied into memory or recomputed.
+
+CACHE_FORMAT = 1
+
+# Number of evenly spaced blocks (of FINGERPRINT_BLOCK values each) hashed to
+# fingerprint a volume. Only these pages are read when a cache entry is verified
+FINGERPRINT_BLOCKS = 64
+FINGERPRINT_BLOCK = 1024
+
+def make_key(n, l, m, sf, grid_extent, grid_resolution, dtype):
+    """ Build the cache key of a probability density volume.
+
+    Args:
+        n (int): principal quantum number
+        l (int): azimuthal quantum number
+        m (int): magnetic quantum number
+        sf (float): Bohr radius scale factor
+        grid_extent (int): the grid spans [-grid_extent, grid_extent] along each axis
+        grid_resolution (int): number of grid points along each axis
+        dtype (numpy.dtype): dtype of the volume
+    Returns:
+        dict: cache key
+    """
+    return {
+        "n": int(n),
+        "l": int(l),
+        "m": int(m),
+        # repr keeps every digit of the float, so nearby scale factors never collide
+        "sf": repr(float(sf)),
+        "grid_extent": int(grid_extent),
+        "grid_resolution": int(grid_resolution),
+        "dtype": np.dtype(dtype).str,
+    }
+
+def fingerprint(volume):
+    """ Hash evenly spaced blocks of a volume together with its shape and dtype.
+
+    Args:
+        volume (numpy.ndarray): volume to fingerprint
+    Returns:
+        str: hex digest
+    """
+    flat = volume.reshape(-1)
+    digest = hashlib.sha1()
+    digest.update(repr((volume.shape, volume.dtype.str)).encode())
+    starts = np.linspace(0, max(flat.size - FINGERPRINT_BLOCK, 0), FINGERPRINT_BLOCKS).astype(np.int64)
+    for start in np.unique(starts):
+        digest.update(np.ascontiguousarray(flat[start:start + FINGERPRINT_BLOCK]).tobytes())
+    return digest.hexdigest()
+
+class DensityCache:
+    """ Size capped, least recently used cache of density volumes in a directory.
+
+    Args:
+        directory (str): cache directory, created if missing
+        max_bytes (int): total size of the cached volumes before the least
+            recently used ones are evicted
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _paths(self, key):
+        name = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:24]
+        base = os.path.join(self.directory, name)
+        return base + ".npy", base + ".json"
+
+    def _read_meta(self, meta_path):
+        try:
+            with open(meta_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, meta_path, meta):
+        tmp_path = meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+
+    def _remove(self, data_path, meta_path):
+        for path in (meta_path, data_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                # still memory-mapped somewhere (Windows), leave it for a later eviction
+                return False
+        return True
+
+    def load(self, key):
+        """ Memory-map a cached volume.
+
+        Entries that fail the integrity checks (missing or unreadable files, a
+        different key, shape, dtype or size, or a fingerprint mismatch) are
+        removed and reported as a miss.
+
+        Args:
+            key (dict): cache key from make_key
+        Returns:
+            numpy.memmap: read-only volume, or None on a cache miss
+        """
+        data_path, meta_path = self._paths(key)
+        meta = self._read_meta(meta_path)
+        if meta is None or not os.path.exists(data_path):
+            return None
+
+        try:
+            if meta.get("format") != CACHE_FORMAT or meta.get("key") != key:
+                raise ValueError("cache entry does not belong to this key")
+            volume = np.load(data_path, mmap_mode="r", allow_pickle=False)
+            if (list(volume.shape) != meta["shape"] or volume.dtype.str != meta["dtype"]
+                    or volume.nbytes != meta["nbytes"]):
+                raise ValueError("cache entry has the wrong shape, dtype or size")
+            if fingerprint(volume) != meta["fingerprint"]:
+                raise ValueError("cache entry data is corrupt")
+        except (OSError, ValueError, KeyError) as error:
+            print("density cache: discarding", os.path.basename(data_path), "-", error)
+            self._remove(data_path, meta_path)
+            return None
+
+        meta["last_used"] = time.time()
+        self._write_meta(meta_path, meta)
+        return volume
+
+    def store(self, key, volume):
+        """ Save a volume in the cache and evict least recently used entries
+        until the cache fits its size cap again.
+
+        Volumes larger than the whole cache are not stored.
+
+        Args:
+            key (dict): cache key from make_key
+            volume (numpy.ndarray): probability density volume
+        Returns:
+            bool: True if the volume was stored
+        """
+        if volume.nbytes > self.max_bytes:
+            return False
+
+        data_path, meta_path = self._paths(key)
+        tmp_path = data_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.ascontiguousarray(volume), allow_pickle=False)
+        try:
+            os.replace(tmp_path, data_path)
+        except OSError:
+            # the previous file is memory-mapped (Windows), keep serving that one
+            os.remove(tmp_path)
+            return False
+
+        now = time.time()
+        self._write_meta(meta_path, {
+            "format": CACHE_FORMAT,
+            "key": key,
+            "shape": list(volume.shape),
+            "dtype": volume.dtype.str,
+            "nbytes": int(volume.nbytes),
+            "fingerprint": fingerprint(volume),
+            "created": now,
+            "last_used": now,
+        })
+        self.evict(keep=data_path)
+        return True
+
+    def entries(self):
+        """ List the cache entries, least recently used first.
+
+        Returns:
+            list: (last_used, nbytes, data_path, meta_path) tuples
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            meta_path = os.path.join(self.directory, name)
+            data_path = meta_path[:-len(".json")] + ".npy"
+            meta = self._read_meta(meta_path)
+            if meta is None or not os.path.exists(data_path):
+                self._remove(data_path, meta_path)
+                continue
+            entries.append((meta.get("last_used", 0), os.path.getsize(data_path), data_path, meta_path))
+        entries.sort()
+        return entries
+
+    def evict(self, keep=None):
+        """ Remove least recently used entries until the cache fits its size cap.
+
+        Args:
+            keep (str): data path of an entry that must not be evicted
+        Returns:
+            int: number of bytes freed
+        """
+        entries = self.entries()
+        total = sum(entry[1] for entry in entries)
+        freed = 0
+        for last_used, nbytes, data_path, meta_path in entries:
+            if total <= self.max_bytes:
+                break
+            if data_path == keep:
+                continue
+            if self._remove(data_path, meta_path):
+                total = total - nbytes
+                freed = freed + nbytes
+        return freed
+
+    def clear(self):
+        """ Remove every entry of the cache. """
+        for last_used, nbytes, data_path, meta_path in self.entries():
+            self._remove(data_path, meta_path)
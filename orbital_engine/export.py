@@ -0,0 +1,136 @@
+import os
+import json
+import numpy as np
+
+# Binary output of generated isosurfaces.
+#
+# PLY files hold one iso level each (positions, normals and triangles), NPZ files
+# hold every level of a quantum state together with its iso values and material
+# settings. Both keep the grid index space coordinates marching cubes returns.
+
+def write_ply(path, verts, faces, normals):
+    """ Write one isosurface as a binary little endian PLY file.
+
+    Args:
+        path (str): output file
+        verts (numpy.ndarray): (V, 3) vertices
+        faces (numpy.ndarray): (F, 3) triangles
+        normals (numpy.ndarray): (V, 3) vertex normals
+    """
+    header = ("ply\n"
+              "format binary_little_endian 1.0\n"
+              "element vertex " + str(len(verts)) + "\n"
+              "property float x\nproperty float y\nproperty float z\n"
+              "property float nx\nproperty float ny\nproperty float nz\n"
+              "element face " + str(len(faces)) + "\n"
+              "property list uchar int vertex_indices\n"
+              "end_header\n")
+
+    vertex_data = np.empty(len(verts), dtype=[("co", "<f4", 3), ("no", "<f4", 3)])
+    vertex_data["co"] = verts
+    vertex_data["no"] = normals
+    face_data = np.empty(len(faces), dtype=[("count", "u1"), ("index", "<i4", 3)])
+    face_data["count"] = 3
+    face_data["index"] = faces
+
+    with open(path, "wb") as f:
+        f.write(header.encode("ascii"))
+        f.write(vertex_data.tobytes())
+        f.write(face_data.tobytes())
+
+def write_npz(path, result):
+    """ Write every iso level of an OrbitalResult to one compressed NPZ file.
+
+    The arrays of level k are stored as vertices_k, faces_k and normals_k, next to
+    the isostep, iso, color_value and alpha_value arrays of all levels. Levels of
+    detail are stored the same way with a _lod<j> suffix, j = 0 being the most detailed.
+
+    Args:
+        path (str): output file
+        result (pipeline.OrbitalResult): generated isosurfaces
+    """
+    arrays = {
+        "isostep": np.array([level[0] for level in result.levels], dtype=np.int32),
+        "iso": np.array([level[1] for level in result.levels], dtype=np.float64),
+        "color_value": np.array([level[2] for level in result.levels], dtype=np.float64),
+        "alpha_value": np.array([level[3] for level in result.levels], dtype=np.float64),
+    }
+    for (isostep, iso, color_value, alpha_value), (verts, faces, normals) in zip(result.levels, result.surfaces):
+        arrays["vertices_" + str(isostep)] = np.asarray(verts, dtype=np.float32)
+        arrays["faces_" + str(isostep)] = np.asarray(faces, dtype=np.int32)
+        arrays["normals_" + str(isostep)] = np.asarray(normals, dtype=np.float32)
+    for (isostep, iso, color_value, alpha_value), chain in zip(result.levels, result.lods):
+        for j, (verts, faces, normals) in enumerate(chain):
+            suffix = str(isostep) + "_lod" + str(j)
+            arrays["vertices_" + suffix] = np.asarray(verts, dtype=np.float32)
+            arrays["faces_" + suffix] = np.asarray(faces, dtype=np.int32)
+            arrays["normals_" + suffix] = np.asarray(normals, dtype=np.float32)
+    np.savez_compressed(path, **arrays)
+
+def write_result(directory, result, formats):
+    """ Write the isosurfaces of an OrbitalResult and describe them for the manifest.
+
+    Args:
+        directory (str): output directory
+        result (pipeline.OrbitalResult): generated isosurfaces
+        formats (list): any of 'ply' and 'npz'
+    Returns:
+        dict: manifest entry of the result, file names relative to directory
+    """
+    entry = {
+        "name": result.name,
+        "n": result.n,
+        "l": result.l,
+        "m": result.m,
+        "sf": result.sf,
+        "grid_extent": result.grid_extent,
+        "grid_resolution": result.grid_resolution,
+        # grid points along each axis of the vertex index space, see OrbitalResult.mesh_resolution
+        "mesh_resolution": result.mesh_resolution,
+        "a0": result.a0,
+        "levels": [],
+        "files": [],
+    }
+    if "npz" in formats:
+        file_name = result.name + ".npz"
+        write_npz(os.path.join(directory, file_name), result)
+        entry["files"].append(file_name)
+
+    for k, ((isostep, iso, color_value, alpha_value), (verts, faces, normals)) in enumerate(zip(result.levels,
+                                                                                                result.surfaces)):
+        level = {
+            "isostep": int(isostep),
+            "iso": float(iso),
+            "color_value": float(color_value),
+            "alpha_value": float(alpha_value),
+            "vertices": int(len(verts)),
+            "faces": int(len(faces)),
+        }
+        if "ply" in formats:
+            file_name = result.name + "_" + str(isostep) + ".ply"
+            write_ply(os.path.join(directory, file_name), verts, faces, normals)
+            level["file"] = file_name
+        if result.lods:
+            level["lods"] = []
+            for j, (lod_verts, lod_faces, lod_normals) in enumerate(result.lods[k]):
+                lod = {"vertices": int(len(lod_verts)), "faces": int(len(lod_faces))}
+                if "ply" in formats:
+                    file_name = result.name + "_" + str(isostep) + "_lod" + str(j) + ".ply"
+                    write_ply(os.path.join(directory, file_name), lod_verts, lod_faces, lod_normals)
+                    lod["file"] = file_name
+                level["lods"].append(lod)
+        entry["levels"].append(level)
+    return entry
+
+def write_manifest(path, entries, settings):
+    """ Atomically (re)write the JSON manifest of a batch run.
+
+    Args:
+        path (str): manifest file
+        entries (list): manifest entries from write_result
+        settings (dict): batch settings shared by all entries
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"format": 1, "settings": settings, "orbitals": entries}, f, indent=1)
+    os.replace(tmp_path, path)
@@ -0,0 +1,239 @@
+import numpy as np
+from collections import OrderedDict
+from .wavefunction import (radial_function, legendre_solid, azimuthal_solid, solid_harmonic_constant,
+                           slab_thickness, evaluation_workers, evaluate_slabs, compute_wavefunction_slabs,
+                           SLAB_BYTES_PER_VOXEL)
+from .instrument import maybe_stage
+
+# Factorized evaluation of |Ψ|^2 = |R(r)|^2 * |Y(θ,φ)|^2 on the linspace grid
+#
+# Grid index i has the coordinate (grid_extent / (N - 1)) * u with the integer
+# u = 2i - N + 1, so every voxel has an integer squared radius s = u^2 + v^2 + w^2
+# and r = grid_extent / (N - 1) * sqrt(s). There are at most 3 (N - 1)^2 + 1 distinct s,
+# far fewer than N^3 voxels, so |R|^2 is tabulated once per s and gathered into the grid.
+# The direction of a voxel only depends on (u, v, w), so |Y|^2 depends on (l, m) and the
+# grid resolution but neither on n nor on the grid extent. Both factors are even in every
+# axis (see mirror_octant) and are kept for the octant of non-negative coordinates only.
+#
+# FactorCache keeps both kinds of factors in memory. Sweeping n at fixed (l, m, resolution)
+# reuses the angular octant, and sweeping m at fixed n reuses the radial table, so a new
+# state only evaluates the factor that changed.
+
+# Default size of the in-memory factor cache
+FACTOR_CACHE_BYTES = 1024 * 1024 * 1024
+
+def lattice_coordinates(grid_resolution, half=0):
+    """ Integer lattice coordinates u = 2i - N + 1 of the grid indices i >= half. """
+    return np.arange(2 * half - grid_resolution + 1, grid_resolution, 2)
+
+def squared_radius_index(u, v, w):
+    """ Integer squared radius s = u^2 + v^2 + w^2 of the block spanned by three lattice vectors.
+
+    The axis order is the one of density_block: u runs over x (axis 0), w over z
+    (axis 1) and v over y (axis 2).
+    """
+    dtype = np.int32 if 3 * (max(np.abs(u).max(), np.abs(v).max(), np.abs(w).max()) ** 2) < 2 ** 31 else np.int64
+    u = u.astype(dtype)
+    v = v.astype(dtype)
+    w = w.astype(dtype)
+    return (u * u)[:, None, None] + (w * w)[None, :, None] + (v * v)[None, None, :]
+
+def angular_density_block(l, m, u, v, w):
+    """ Compute |Y_lm|^2 on the directions of a block of lattice points.
+
+    Args:
+        l (int): azimuthal quantum number
+        m (int): magnetic quantum number
+        u (numpy.ndarray): lattice x coordinates (axis 0)
+        v (numpy.ndarray): lattice y coordinates (axis 2)
+        w (numpy.ndarray): lattice z coordinates (axis 1)
+    Returns:
+        numpy.ndarray: float64 |Y|^2 of the block; at s = 0 the value of the direction
+        (0, 0, 0), which only matters for l = 0 where Y is constant
+    """
+    s = squared_radius_index(u, v, w).astype(np.float64)
+    inverse_length = np.sqrt(s, out=s)
+    inverse_length[inverse_length == 0] = 1
+    np.divide(1, inverse_length, out=inverse_length)
+
+    # unit vectors, Y = constant * Pi_l^|m|(z, 1) * C_|m|(x, y) on the unit sphere
+    x = u[:, None, None] * inverse_length
+    z = w[None, :, None] * inverse_length
+    y = v[None, None, :] * inverse_length
+    angular = legendre_solid(l, abs(m), z, np.ones_like(z)) * azimuthal_solid(abs(m), x, y)
+    angular *= solid_harmonic_constant(l, m)
+    return np.square(angular, out=angular)
+
+class FactorCache:
+    """ In-memory LRU cache of the radial and angular factors of |Ψ|^2 and of whole
+    wavefunction volumes.
+
+    Args:
+        max_bytes (int): size limit of all cached factors
+    """
+
+    def __init__(self, max_bytes=FACTOR_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def _put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        self.evict()
+
+    def nbytes(self):
+        """ Total size of the cached factors. """
+        return sum(value.nbytes for value in self.entries.values())
+
+    def evict(self):
+        """ Remove least recently used factors until the cache fits max_bytes. """
+        total = self.nbytes()
+        while total > self.max_bytes and len(self.entries) > 1:
+            key, value = self.entries.popitem(last=False)
+            total = total - value.nbytes
+
+    def clear(self):
+        self.entries.clear()
+
+    def angular_octant(self, l, m, grid_resolution, memory_budget_mb=512, workers=1):
+        """ |Y_lm|^2 on the grid octant of non-negative coordinates, computed on first use.
+
+        Args:
+            l (int): azimuthal quantum number
+            m (int): magnetic quantum number
+            grid_resolution (int): number of grid points along each axis
+            memory_budget_mb (float): scratch memory of the slabs computed at the same time
+            workers (int): slabs computed at the same time by threads
+        Returns:
+            tuple: (numpy.ndarray float32 octant, bool cache hit)
+        """
+        key = ("angular", l, m, grid_resolution)
+        octant = self._get(key)
+        if octant is not None:
+            self.hits = self.hits + 1
+            return octant, True
+        self.misses = self.misses + 1
+
+        lattice = lattice_coordinates(grid_resolution, grid_resolution // 2)
+        octant = np.empty((len(lattice),) * 3, dtype=np.float32)
+        thickness = slab_thickness(grid_resolution, memory_budget_mb, workers, len(lattice))
+
+        def evaluate(start, stop):
+            octant[start:stop] = angular_density_block(l, m, lattice[start:stop], lattice, lattice)
+
+        evaluate_slabs(0, len(lattice), thickness, evaluate, workers)
+        self._put(key, octant)
+        return octant, False
+
+    def radial_table(self, n, l, a0, spacing, size):
+        """ |R_nl|^2 at the radii spacing * sqrt(s) for s = 0 .. size - 1, computed on first use.
+
+        Args:
+            n (int): principal quantum number
+            l (int): azimuthal quantum number
+            a0 (float): scaled Bohr radius
+            spacing (float): grid_extent / (grid_resolution - 1)
+            size (int): number of tabulated squared radii
+        Returns:
+            tuple: (numpy.ndarray float32 table, bool cache hit)
+        """
+        key = ("radial", n, l, float(a0), float(spacing))
+        table = self._get(key)
+        if table is not None and len(table) >= size:
+            self.hits = self.hits + 1
+            return table, True
+        self.misses = self.misses + 1
+
+        radius = spacing * np.sqrt(np.arange(size, dtype=np.float64))
+        table = np.square(radial_function(n, l, radius, a0)).astype(np.float32)
+        self._put(key, table)
+        return table, False
+
+    def density_octant(self, n, l, m, a0, grid_extent, grid_resolution, out, memory_budget_mb=512,
+                       instrument=None, on_slab=None, workers=1):
+        """ Write |Ψ|^2 on the grid octant of non-negative coordinates from the cached factors.
+
+        Args:
+            n (int): principal quantum number
+            l (int): azimuthal quantum number
+            m (int): magnetic quantum number
+            a0 (float): scaled Bohr radius
+            grid_extent (int): the grid spans [-grid_extent, grid_extent] along each axis
+            grid_resolution (int): number of grid points along each axis
+            out (numpy.ndarray): float32 octant to write, shaped like angular_octant
+            memory_budget_mb (float): scratch memory of the slabs computed at the same time
+            instrument (instrument.Instrument): records the angular, radial and gather stages
+            on_slab (callable): called with the gathered fraction of the octant after every slab
+            workers (int): slabs computed and gathered at the same time by threads, 0 for
+                one per CPU core
+        Returns:
+            dict: which factors were cache hits
+        """
+        workers = evaluation_workers(workers)
+        lattice = lattice_coordinates(grid_resolution, grid_resolution // 2)
+        spacing = grid_extent / max(grid_resolution - 1, 1)
+        largest = int(lattice.max(initial=0))
+
+        with maybe_stage(instrument, "angular") as stage:
+            angular, angular_hit = self.angular_octant(l, m, grid_resolution, memory_budget_mb, workers)
+            stage["cache_hit"] = angular_hit
+        with maybe_stage(instrument, "radial") as stage:
+            radial, radial_hit = self.radial_table(n, l, a0, spacing, 3 * largest * largest + 1)
+            stage["cache_hit"] = radial_hit
+
+        # the gather needs about a float32 and an index per voxel besides the output
+        thickness = max(1, slab_thickness(grid_resolution, memory_budget_mb, workers) * SLAB_BYTES_PER_VOXEL // 16)
+        thickness = min(thickness, -(-len(lattice) // workers))
+
+        def gather(start, stop):
+            block = out[start:stop]
+            np.take(radial, squared_radius_index(lattice[start:stop], lattice, lattice), out=block)
+            block *= angular[start:stop]
+
+        with maybe_stage(instrument, "gather", voxels=out.size, workers=workers):
+            evaluate_slabs(0, len(lattice), thickness, gather, workers, on_slab)
+        return {"angular_hit": angular_hit, "radial_hit": radial_hit}
+
+    def wavefunction_volume(self, n, l, m, a0_scale_factor, grid_extent, grid_resolution, memory_budget_mb=512,
+                            instrument=None, on_slab=None, workers=1):
+        """ The float32 wavefunction volume of a state, computed on first use.
+
+        Superpositions combine these volumes frame after frame (see superposition.py),
+        so every basis state is only evaluated once.
+
+        Args:
+            n (int): principal quantum number
+            l (int): azimuthal quantum number
+            m (int): magnetic quantum number
+            a0_scale_factor (float): Bohr radius scale factor
+            grid_extent (int): the grid spans [-grid_extent, grid_extent] along each axis
+            grid_resolution (int): number of grid points along each axis
+            memory_budget_mb (float): scratch memory per slab while the volume is computed
+            instrument (instrument.Instrument): records the stages of every slab
+            on_slab (callable): called with the evaluated fraction after every slab
+            workers (int): slabs evaluated at the same time by threads, 0 for one per CPU core
+        Returns:
+            tuple: (numpy.ndarray float32 volume, bool cache hit)
+        """
+        key = ("psi", n, l, m, float(a0_scale_factor), grid_extent, grid_resolution)
+        volume = self._get(key)
+        if volume is not None:
+            self.hits = self.hits + 1
+            return volume, True
+        self.misses = self.misses + 1
+
+        volume = compute_wavefunction_slabs(n, l, m, a0_scale_factor, grid_extent, grid_resolution,
+                                            memory_budget_mb, instrument, on_slab, workers)
+        self._put(key, volume)
+        return volume, False
+
+# Factor cache shared by all evaluations of this process
+default_factor_cache = FactorCache()
@@ -0,0 +1,204 @@
+import os
+import sys
+import time
+import json
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+# Per-stage timings and memory high-water marks.
+#
+# Every stage records its wall time, the peak of the memory traced by tracemalloc
+# while it ran (numpy reports its buffers to tracemalloc, so this covers the arrays
+# of the stage) and the peak resident set size of the process after it. The process
+# peak never goes down, so it tells which stage first reached it.
+
+def peak_rss_bytes():
+    """ Peak resident set size of this process in bytes, None if it cannot be read. """
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaNonPagedPoolUsage", ctypes.c_size_t), ("PagefileUsage", ctypes.c_size_t),
+                        ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return None
+        return int(counters.PeakWorkingSetSize)
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return int(peak) if sys.platform == "darwin" else int(peak) * 1024
+
+class Instrument:
+    """ Records the stages of one run, see stage().
+
+    Args:
+        trace_memory (bool): trace numpy allocations for the per-stage memory peak
+    """
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.stages = []
+        self.started = time.perf_counter()
+        self._tracing = False
+        # records and traced-memory baselines of the stages that are running
+        self._open = []
+
+    def _fold_peak(self):
+        # tracemalloc has a single peak, so it is credited to every running stage
+        # before a nested stage resets it
+        peak = tracemalloc.get_traced_memory()[1]
+        for record, baseline in self._open:
+            record["peak_traced_bytes"] = max(record.get("peak_traced_bytes", 0), peak - baseline)
+
+    @contextmanager
+    def stage(self, name, **info):
+        """ Time a stage of the run.
+
+        Stages may be nested, a nested stage is recorded with a higher depth and
+        before the stage around it. The yielded dict takes further information about
+        the stage, like array sizes or face counts.
+
+        Args:
+            name (str): stage name
+            **info: information known when the stage starts
+        """
+        record = {"name": name, "depth": len(self._open)}
+        record.update(info)
+
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        baseline = 0
+        if self.trace_memory:
+            self._fold_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self._open.append((record, baseline))
+
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            if self.trace_memory:
+                self._fold_peak()
+            self._open.pop()
+            record["peak_rss_bytes"] = peak_rss_bytes()
+            self.stages.append(record)
+
+    def record(self, name, seconds, **info):
+        """ Add a stage that was timed elsewhere, like an extraction in a worker thread.
+
+        Args:
+            name (str): stage name
+            seconds (float): duration of the stage
+            **info: further information about the stage
+        """
+        record = {"name": name, "depth": len(self._open), "seconds": seconds}
+        record.update(info)
+        self.stages.append(record)
+
+    def stop(self):
+        """ Stop tracing memory if this instrument started it. """
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    def totals(self):
+        """ Wall time summed per stage name, in first-seen order. """
+        totals = {}
+        for record in self.stages:
+            totals[record["name"]] = totals.get(record["name"], 0.0) + record["seconds"]
+        return totals
+
+    def report(self, **info):
+        """ Machine-readable report of all stages.
+
+        Args:
+            **info: run information stored next to the stages, like the parameters
+        Returns:
+            dict: report, JSON serializable as long as info is
+        """
+        report = dict(info)
+        report["total_seconds"] = time.perf_counter() - self.started
+        report["peak_rss_bytes"] = peak_rss_bytes()
+        report["totals"] = self.totals()
+        report["stages"] = self.stages
+        return report
+
+    def summary(self, limit=8):
+        """ One line per stage name with its summed time, the slowest first.
+
+        Args:
+            limit (int): number of stage names listed
+        Returns:
+            list: lines like "marching_cubes 12.31 s (3)"
+        """
+        counts = {}
+        peaks = {}
+        for record in self.stages:
+            counts[record["name"]] = counts.get(record["name"], 0) + 1
+            peaks[record["name"]] = max(peaks.get(record["name"], 0), record.get("peak_traced_bytes") or 0)
+        lines = []
+        for name, seconds in sorted(self.totals().items(), key=lambda item: -item[1])[:limit]:
+            line = name + " " + str(round(seconds, 2)) + " s"
+            if counts[name] > 1:
+                line = line + " (" + str(counts[name]) + ")"
+            if peaks[name]:
+                line = line + ", " + str(round(peaks[name] / (1024 * 1024), 1)) + " MiB"
+            lines.append(line)
+        return lines
+
+def maybe_stage(instrument, name, **info):
+    """ Instrument.stage of instrument, or a stage that records nothing if it is None. """
+    if instrument is None:
+        return nullcontext({})
+    return instrument.stage(name, **info)
+
+def write_report(path, report):
+    """ Write a report of Instrument.report as JSON. """
+    with open(path, "w") as f:
+        json.dump(report, f, indent=1, default=str)
+
+def prune_reports(directory, keep, extensions=(".json", ".prof")):
+    """ Delete all but the newest reports of a directory.
+
+    A report and its profile share their name up to the extension and are kept or
+    deleted together.
+
+    Args:
+        directory (str): directory of the reports
+        keep (int): number of reports to keep
+        extensions (tuple): extensions of the report files
+    Returns:
+        int: number of files deleted
+    """
+    reports = {}
+    for entry in os.scandir(directory):
+        base, extension = os.path.splitext(entry.name)
+        if entry.is_file() and extension in extensions:
+            files, newest = reports.get(base, ([], 0.0))
+            reports[base] = (files + [entry.path], max(newest, entry.stat().st_mtime))
+    deleted = 0
+    for base in sorted(reports, key=lambda base: reports[base][1], reverse=True)[keep:]:
+        for path in reports[base][0]:
+            try:
+                os.remove(path)
+                deleted = deleted + 1
+            except OSError:
+                # still open elsewhere (Windows), it is removed on a later run
+                pass
+    return deleted
@@ -0,0 +1,540 @@
+import os
+import sys
+import time
+import itertools
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import numpy as np
+from skimage import measure
+from .wavefunction import compute_probability_density_slabs, density_block, scaled_bohr_radius
+from .levels import iso_levels, enclosed_probability_isos, probability_levels
+
+# Isosurfaces are returned as (vertices, faces, normals) in grid index space, the
+# way skimage.measure.marching_cubes returns them. See wavefunction.mirror_octant
+# for the mirror symmetry the octant functions below rely on.
+
+def octant_for_marching_cubes(volume):
+    """ Sub-volume of a mirror symmetric volume that marching cubes needs to see.
+
+    For an odd grid the centre planes are grid planes and the octant starts on them.
+    For an even grid the mirror planes lie halfway between two grid planes, so the
+    octant is padded with one extra plane per axis holding the values on the mirror
+    plane (equal to the neighbouring planes by symmetry). That first cell is half a
+    voxel thick, see octant_to_grid.
+
+    Args:
+        volume (numpy.ndarray): mirror symmetric cubic volume
+    Returns:
+        numpy.ndarray: octant sub-volume (a view for odd grids, a copy for even grids)
+    """
+    size = volume.shape[0]
+    half = size // 2
+    if size % 2:
+        return volume[half:, half:, half:]
+
+    octant = np.empty((size - half + 1,) * 3, dtype=volume.dtype)
+    octant[1:, 1:, 1:] = volume[half:, half:, half:]
+    octant[0, 1:, 1:] = octant[1, 1:, 1:]
+    octant[:, 0, 1:] = octant[:, 1, 1:]
+    octant[:, :, 0] = octant[:, :, 1]
+    return octant
+
+def octant_to_grid(verts, normals, size):
+    """ Map marching cubes output of octant_for_marching_cubes back onto the full grid.
+
+    Args:
+        verts (numpy.ndarray): (V, 3) vertices in octant index space
+        normals (numpy.ndarray): (V, 3) vertex normals
+        size (int): grid resolution of the full volume
+    Returns:
+        tuple: (vertices, normals) in full grid index space
+    """
+    half = size // 2
+    if size % 2:
+        return verts + half, normals
+
+    # the first octant cell spans the half voxel from the mirror plane to grid plane `half`
+    in_half_cell = verts < 1
+    verts = np.where(in_half_cell, half - 0.5 + 0.5 * verts, half - 1 + verts)
+    # the gradient along an axis doubles inside the half thick cell
+    normals = np.where(in_half_cell, 2 * normals, normals)
+    normals = normals / np.linalg.norm(normals, axis=1, keepdims=True)
+    return verts.astype(np.float32), normals.astype(np.float32)
+
+def mirror_surface(verts, faces, normals, size):
+    """ Reflect an isosurface extracted from octant_for_marching_cubes into all eight octants.
+
+    Reflections with an odd number of flipped axes reverse the triangle winding so
+    all normals keep pointing outward, and the vertices on the mirror planes are
+    welded so the seams are closed.
+
+    Args:
+        verts (numpy.ndarray): (V, 3) vertices in octant index space
+        faces (numpy.ndarray): (F, 3) triangles
+        normals (numpy.ndarray): (V, 3) vertex normals
+        size (int): grid resolution of the full volume
+    Returns:
+        tuple: (vertices, faces, normals) in full grid index space
+    """
+    if len(verts) == 0:
+        return verts, faces, normals
+    verts, normals = octant_to_grid(verts, normals, size)
+
+    centre = (size - 1) / 2
+    all_verts = []
+    all_faces = []
+    all_normals = []
+    offset = 0
+    for signs in np.array(list(itertools.product((1, -1), repeat=3)), dtype=np.float32):
+        all_verts.append(centre + signs * (verts - centre))
+        all_normals.append(signs * normals)
+        all_faces.append((faces[:, ::-1] if np.prod(signs) < 0 else faces) + offset)
+        offset = offset + len(verts)
+    verts = np.concatenate(all_verts)
+    faces = np.concatenate(all_faces)
+    normals = np.concatenate(all_normals)
+
+    # weld the copies of vertices lying on a mirror plane
+    on_seam = np.flatnonzero(np.any(np.abs(verts - centre) < 1e-4, axis=1))
+    return weld_vertices(verts, faces, normals, 1e-4, on_seam)
+
+def weld_vertices(verts, faces, normals, tolerance=1e-4, candidates=None):
+    """ Merge vertices that snap onto the same point of a grid with the given spacing.
+
+    Faces that collapse are removed, as are vertices no face refers to any more.
+    A merged vertex keeps the position and normal of its first copy.
+
+    Args:
+        verts (numpy.ndarray): (V, 3) vertices
+        faces (numpy.ndarray): (F, 3) triangles
+        normals (numpy.ndarray): (V, 3) vertex normals
+        tolerance (float): snapping grid spacing
+        candidates (numpy.ndarray): indices of the vertices that may be merged,
+            None for all vertices
+    Returns:
+        tuple: (vertices, faces, normals)
+    """
+    if candidates is None:
+        candidates = np.arange(len(verts))
+    if len(candidates) == 0:
+        return verts, faces, normals
+
+    keys = np.floor(verts[candidates] / tolerance + 0.5).astype(np.int64)
+    keys = keys - keys.min(axis=0)
+    spans = keys.max(axis=0) + 1
+    if np.prod(spans.astype(np.float64)) < 2 ** 62:
+        # pack the three snapped coordinates into one integer, sorting 1D keys is much faster
+        keys = (keys[:, 0] * spans[1] + keys[:, 1]) * spans[2] + keys[:, 2]
+        unique_keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    else:
+        unique_keys, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    remap = np.arange(len(verts))
+    remap[candidates] = candidates[first][inverse.ravel()]
+    faces = remap[faces]
+    faces = faces[(faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 2] != faces[:, 0])]
+
+    # drop the vertices no face refers to any more and compact the indices
+    used = np.zeros(len(verts), dtype=bool)
+    used[faces] = True
+    new_index = np.cumsum(used) - 1
+    return verts[used], new_index[faces], normals[used]
+
+def active_box(volume, iso, search=None):
+    """ Bounding box of the marching cubes cells that can contain the isosurface.
+
+    Those are the cells with at least one corner >= iso, so the box is the bounding
+    box of the voxels >= iso grown by one voxel. Isosurfaces of lower values enclose
+    the ones of higher values, so the box of a lower level can be passed as the
+    search region of the next higher level.
+
+    Args:
+        volume (numpy.ndarray): probability density
+        iso (float): isosurface value
+        search (tuple): slices bounding the region to look in, None for the whole volume
+    Returns:
+        tuple: three slices into volume, or None when no voxel reaches iso
+    """
+    if search is None:
+        search = tuple(slice(0, size) for size in volume.shape)
+    inside = volume[search] >= iso
+
+    box = []
+    for axis in range(3):
+        other = tuple(a for a in range(3) if a != axis)
+        hits = np.flatnonzero(inside.any(axis=other))
+        if len(hits) == 0:
+            return None
+        start = search[axis].start + hits[0]
+        stop = search[axis].start + hits[-1] + 1
+        box.append(slice(max(start - 1, 0), min(stop + 1, volume.shape[axis])))
+    return tuple(box)
+
+def nested_boxes(volume, isos):
+    """ Active boxes of several nested isosurfaces.
+
+    The levels are visited from the lowest to the highest iso value, each one
+    searching only inside the box of the level below it.
+
+    Args:
+        volume (numpy.ndarray): probability density
+        isos (list): isosurface values in any order
+    Returns:
+        list: active_box result for every value in isos, in the order of isos
+    """
+    boxes = [None] * len(isos)
+    search = None
+    for index in np.argsort(isos):
+        search = active_box(volume, isos[index], search)
+        boxes[index] = search
+        if search is None:
+            # no voxel reaches this value, so none reaches the higher ones either
+            break
+    return boxes
+
+def marching_cubes_box(volume, iso, box=None, origin=(0, 0, 0)):
+    """ Run marching cubes on the part of a volume inside a box.
+
+    Args:
+        volume (numpy.ndarray): probability density
+        iso (float): isosurface value
+        box (tuple): slices from active_box, None for the whole volume
+        origin (tuple): index of volume[0, 0, 0] in the index space of box, when volume
+            is only a part of the volume box was found in
+    Returns:
+        tuple: (vertices, faces, normals) in the index space of box
+    """
+    if box is None:
+        verts, faces, normals, values = measure.marching_cubes(volume, iso, gradient_direction="ascent")
+        return verts, faces, normals
+
+    local = tuple(slice(axis.start - start, axis.stop - start) for axis, start in zip(box, origin))
+    verts, faces, normals, values = measure.marching_cubes(volume[local], iso, gradient_direction="ascent")
+    verts = verts + np.array([axis.start for axis in box], dtype=verts.dtype)
+    return verts, faces, normals
+
+def empty_surface():
+    return np.zeros((0, 3), dtype=np.float32), np.zeros((0, 3), dtype=np.int32), np.zeros((0, 3), dtype=np.float32)
+
+def extract_isosurface(volume, iso, symmetric=False, crop=True):
+    """ Extract the isosurface of a probability density volume.
+
+    Args:
+        volume (numpy.ndarray): probability density
+        iso (float): isosurface value
+        symmetric (bool): the volume is mirror symmetric, scan only one octant
+        crop (bool): only scan the active box of the isosurface
+    Returns:
+        tuple: (vertices, faces, normals) in grid index space
+    """
+    scan = octant_for_marching_cubes(volume) if symmetric else volume
+    box = active_box(scan, iso) if crop else None
+    if crop and box is None:
+        return empty_surface()
+    verts, faces, normals = marching_cubes_box(scan, iso, box)
+    if symmetric:
+        return mirror_surface(verts, faces, normals, volume.shape[0])
+    return verts, faces, normals
+
+# Adaptive evaluation
+#
+# The density is evaluated on a coarse grid that is cut into blocks of block_cells
+# cells. Blocks whose sample range contains one of the iso values are re-evaluated
+# at twice the resolution and split into blocks again, until the spacing of the
+# target resolution is reached. Marching cubes then runs on those finest blocks
+# only. Every finest block samples the same global lattice, so neighbouring blocks
+# produce identical vertices on their shared faces and are stitched by welding.
+# Surface features that fall entirely between the samples of a coarse block are
+# not detected, just as they would be missed by a dense grid of that resolution.
+
+def adaptive_isosurfaces(n, l, m, a0_scale_factor, grid_extent, coarse_resolution, target_resolution,
+                         levels, block_cells=16, memory_budget_mb=512, probabilities=()):
+    """ Extract the isosurfaces of a quantum state at a high effective resolution
+    by only refining the blocks of a coarse grid the isosurfaces pass through.
+
+    Args:
+        n (int): principal quantum number
+        l (int): azimuthal quantum number
+        m (int): magnetic quantum number
+        a0_scale_factor (float): Bohr radius scale factor
+        grid_extent (int): the grid spans [-grid_extent, grid_extent] along each axis
+        coarse_resolution (int): number of coarse grid points along each axis
+        target_resolution (int): effective resolution to reach, rounded up so that
+            it is the coarse resolution refined a whole number of times
+        levels (int): number of iso levels, chosen from the coarse grid as in iso_levels
+        block_cells (int): cells per block edge, rounded up to an even number
+        memory_budget_mb (float): scratch memory for the coarse slab evaluation
+        probabilities (list): enclosed probabilities of the levels instead of levels,
+            their iso values are taken from the coarse grid and kept in report["thresholds"]
+    Returns:
+        tuple: (iso_levels list, list of (vertices, faces, normals) in effective grid
+        index space, dict report)
+    """
+    # the finest blocks must tile the effective grid in steps of block_cells
+    block_cells = max(2, block_cells + block_cells % 2)
+    coarse, slab_report = compute_probability_density_slabs(n, l, m, a0_scale_factor, grid_extent,
+                                                            coarse_resolution, memory_budget_mb,
+                                                            measure_memory=False, symmetric=True)
+    bohr = scaled_bohr_radius(a0_scale_factor)
+    if probabilities:
+        thresholds = enclosed_probability_isos(coarse, probabilities)
+        level_list = probability_levels(probabilities, thresholds)
+    else:
+        level_list = iso_levels(coarse.min(), coarse.max(), levels)
+    isos = np.array([level[1] for level in level_list])
+
+    depth = 0
+    while (coarse_resolution - 1) * 2 ** depth + 1 < target_resolution:
+        depth = depth + 1
+    effective_resolution = (coarse_resolution - 1) * 2 ** depth + 1
+    step = 2 * grid_extent / (effective_resolution - 1)
+
+    pieces = [[] for iso in isos]
+    report = {
+        "coarse_resolution": coarse_resolution,
+        "effective_resolution": effective_resolution,
+        "refinements": depth,
+        "evaluated_samples": coarse.size,
+        "dense_samples": effective_resolution ** 3,
+        "leaf_blocks": 0,
+    }
+    if probabilities:
+        report["thresholds"] = [[float(p), float(iso)] for p, iso in zip(probabilities, thresholds)]
+
+    def split(cells, size):
+        # cut a run of cells into blocks of at most size cells
+        return [(start, min(start + size, cells)) for start in range(0, cells, size)]
+
+    def active(values):
+        return np.flatnonzero((isos > values.min()) & (isos < values.max()))
+
+    def refine(origin, values, depth_left):
+        # origin: effective grid index of the first sample of the block
+        # values: samples of the block, 2 ** depth_left effective cells apart
+        if depth_left == 0:
+            report["leaf_blocks"] = report["leaf_blocks"] + 1
+            for index in active(values):
+                verts, faces, normals, _ = measure.marching_cubes(values, isos[index], gradient_direction="ascent")
+                pieces[index].append((verts + origin.astype(np.float32), faces, normals))
+            return
+
+        # children cover half as many cells of this block, so they hold block_cells
+        # cells once refined. Children the iso values do not pass through (judged on
+        # the samples of this block) are never evaluated
+        spacing = 2 ** depth_left
+        child_cells = max(block_cells // 2, 1)
+        cells = [size - 1 for size in values.shape]
+        for i0, i1 in split(cells[0], child_cells):
+            for j0, j1 in split(cells[1], child_cells):
+                for k0, k1 in split(cells[2], child_cells):
+                    if len(active(values[i0:i1 + 1, j0:j1 + 1, k0:k1 + 1])) == 0:
+                        continue
+                    child_origin = origin + spacing * np.array([i0, j0, k0])
+                    xs, zs, ys = (-grid_extent + (child_origin[axis] + spacing // 2 * np.arange(2 * (stop - start) + 1)) * step
+                                  for axis, (start, stop) in enumerate(((i0, i1), (j0, j1), (k0, k1))))
+                    finer = density_block(n, l, m, bohr, xs, zs, ys)
+                    report["evaluated_samples"] = report["evaluated_samples"] + finer.size
+                    refine(child_origin, finer, depth_left - 1)
+
+    scale = 2 ** depth
+    coarse_cells = coarse_resolution - 1
+    for i0, i1 in split(coarse_cells, block_cells):
+        for j0, j1 in split(coarse_cells, block_cells):
+            for k0, k1 in split(coarse_cells, block_cells):
+                block = coarse[i0:i1 + 1, j0:j1 + 1, k0:k1 + 1]
+                if len(active(block)):
+                    refine(scale * np.array([i0, j0, k0]), block, depth)
+
+    surfaces = []
+    for blocks in pieces:
+        if not blocks:
+            surfaces.append(empty_surface())
+            continue
+        offsets = np.cumsum([0] + [len(verts) for verts, faces, normals in blocks[:-1]])
+        verts = np.concatenate([block[0] for block in blocks])
+        faces = np.concatenate([block[1] + offset for block, offset in zip(blocks, offsets)])
+        normals = np.concatenate([block[2] for block in blocks])
+        # only vertices on the faces of the finest blocks have copies to weld
+        on_faces = np.flatnonzero(np.any(np.abs(verts - block_cells * np.round(verts / block_cells)) < 1e-4, axis=1))
+        surfaces.append(weld_vertices(verts, faces, normals, 1e-4, on_faces))
+    return level_list, surfaces, report
+
+# Voxels scanned by all levels together below which process workers are not worth it
+# and the levels are extracted in threads: marching cubes scans about 20 million voxels
+# a second, so this is about three seconds of work against the second and a half it
+# takes to spawn the workers
+PROCESS_MIN_VOXELS = 1 << 26
+
+# Source run by every spawned extraction worker before its first level. The pickled
+# initializer and tasks only refer to the builtins exec and eval: inside Blender the
+# engine is a subpackage of the add-on, whose __init__ imports bpy, so the workers
+# import it as the top-level package orbital_engine from its own directory, without
+# touching the sys.path of the parent
+_WORKER_BOOTSTRAP = ("import sys\n"
+                     "sys.path.insert(0, root)\n"
+                     "from orbital_engine.isosurface import _attach_shared\n"
+                     "_attach_shared(name, shape, dtype)\n")
+_WORKER_CALL = "__import__('orbital_engine.isosurface', fromlist=['_extract_shared'])._extract_shared(*arguments)"
+
+# Volume shared with the spawned extraction workers. The parent copies the part of the
+# volume marching cubes has to see into one shared memory block, every worker maps it
+# once when it starts and the levels only send their iso value and box
+_shared_memory = None
+_shared_volume = None
+
+def _attach_shared(name, shape, dtype):
+    global _shared_memory, _shared_volume
+    _shared_memory = shared_memory.SharedMemory(name=name)
+    _shared_volume = np.ndarray(shape, dtype=dtype, buffer=_shared_memory.buf)
+
+def _extract_timed(scan, iso, box, mirror_size, origin=(0, 0, 0)):
+    start = time.thread_time()
+    verts, faces, normals = marching_cubes_box(scan, iso, box, origin)
+    if mirror_size:
+        verts, faces, normals = mirror_surface(verts, faces, normals, mirror_size)
+    return verts, faces, normals, time.thread_time() - start
+
+def _extract_shared(iso, box, mirror_size, origin):
+    return _extract_timed(_shared_volume, iso, box, mirror_size, origin)
+
+def _collect(pool, futures, finished):
+    # hand the results to finished in completion order; if it raises, the levels that
+    # have not started are dropped and only the running ones are waited for
+    positions = {future: position for position, future in enumerate(futures)}
+    try:
+        for future in as_completed(futures):
+            finished(positions[future], future.result())
+    except BaseException:
+        pool.shutdown(wait=True, cancel_futures=True)
+        raise
+
+def _extract_in_processes(scan, tasks, crop, workers, finished, log):
+    # run the extraction tasks in spawned processes, False if no shared memory block
+    # could be created and nothing was extracted
+    shared_part = scan
+    origin = (0, 0, 0)
+    if crop:
+        # the levels are nested, so the box of the lowest level holds all the others
+        outer = tasks[1][int(np.argmin(tasks[0]))]
+        shared_part = scan[outer]
+        origin = tuple(axis.start for axis in outer)
+    try:
+        memory = shared_memory.SharedMemory(create=True, size=max(shared_part.nbytes, 1))
+    except OSError as error:
+        log("no shared memory for the extraction workers (", error, "), extracting with threads")
+        return False
+    try:
+        np.ndarray(shared_part.shape, dtype=shared_part.dtype, buffer=memory.buf)[...] = shared_part
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        bootstrap = {"root": root, "name": memory.name, "shape": shared_part.shape, "dtype": shared_part.dtype.str}
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=exec, initargs=(_WORKER_BOOTSTRAP, bootstrap)) as pool:
+            _collect(pool, [pool.submit(eval, _WORKER_CALL, {"arguments": (iso, box, mirror_size, origin)})
+                            for iso, box, mirror_size in zip(*tasks)], finished)
+    finally:
+        memory.close()
+        memory.unlink()
+    return True
+
+def extract_isosurfaces(volume, isos, symmetric=False, workers=0, backend='PROCESS', crop=True,
+                        measure_serial=False, on_level=None, log=print, process_voxels=PROCESS_MIN_VOXELS):
+    """ Extract several isosurfaces of one volume in parallel.
+
+    skimage's marching cubes holds the GIL, so only worker processes extract levels
+    at the same time. They are spawned, which works on every platform, and read the
+    volume from one shared memory block: the part of it inside the active box of the
+    lowest level, or all of it without cropping. Spawning them takes a second or two,
+    so levels scanning fewer than process_voxels voxels together are extracted in
+    threads. Threads share the volume directly but run the levels one after the
+    other. The surfaces come back in the order of isos, and on_level sees each of
+    them as soon as it is ready.
+
+    Args:
+        volume (numpy.ndarray): probability density
+        isos (list): isosurface values
+        symmetric (bool): the volume is mirror symmetric, scan only one octant
+        workers (int): number of workers, 0 uses one per CPU core
+        backend (str): 'PROCESS' or 'THREAD'. Processes fall back to threads when no
+            shared memory block can be created
+        crop (bool): scan only the nested active box of every isosurface
+        measure_serial (bool): also time the plain serial loop (without cropping)
+            for comparison
+        on_level (callable): called in the calling thread as on_level(index, surface)
+            for every level in the order they finish; an exception raised by it cancels
+            the levels not started yet and is passed on
+        log (callable): receives progress messages like print
+        process_voxels (int): voxels scanned by all levels together from which the
+            'PROCESS' backend starts worker processes
+    Returns:
+        tuple: (list of (vertices, faces, normals), dict extraction report)
+    """
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(isos)))
+
+    start = time.perf_counter()
+
+    # the octant is built once and shared by every level
+    scan = octant_for_marching_cubes(volume) if symmetric else volume
+    mirror_size = volume.shape[0] if symmetric else 0
+    if crop:
+        boxes = nested_boxes(scan, isos)
+        # levels no voxel reaches have no surface and are not scanned at all
+        todo = [index for index, box in enumerate(boxes) if box is not None]
+    else:
+        boxes = [None] * len(isos)
+        todo = list(range(len(isos)))
+
+    surfaces = [empty_surface()] * len(isos)
+    level_seconds = [0.0] * len(isos)
+    if on_level is not None:
+        for index in range(len(isos)):
+            if index not in todo:
+                on_level(index, surfaces[index])
+
+    done = [None] * len(todo)
+
+    def finished(position, result):
+        done[position] = result
+        surfaces[todo[position]] = result[:3]
+        level_seconds[todo[position]] = result[3]
+        if on_level is not None:
+            on_level(todo[position], result[:3])
+
+    scanned = sum(np.prod([axis.stop - axis.start for axis in boxes[index]]) if crop else scan.size
+                  for index in todo)
+    if backend == 'PROCESS' and scanned < process_voxels:
+        backend = 'THREAD'
+
+    tasks = [[isos[index] for index in todo], [boxes[index] for index in todo], [mirror_size] * len(todo)]
+    if workers == 1 or len(todo) < 2:
+        for position, task in enumerate(zip(*tasks)):
+            finished(position, _extract_timed(scan, *task))
+    else:
+        if backend == 'PROCESS' and not _extract_in_processes(scan, tasks, crop, workers, finished, log):
+            backend = 'THREAD'
+        if backend == 'THREAD':
+            with ThreadPoolExecutor(workers) as pool:
+                _collect(pool, [pool.submit(_extract_timed, scan, *task) for task in zip(*tasks)], finished)
+    wall = time.perf_counter() - start
+
+    # the serial loop costs about the CPU time each extraction needed on its own
+    serial = sum(result[3] for result in done)
+    if measure_serial:
+        start = time.perf_counter()
+        for iso in isos:
+            extract_isosurface(volume, iso, symmetric, crop=False)
+        serial = time.perf_counter() - start
+
+    report = {
+        "backend": backend,
+        "workers": workers,
+        "levels": len(isos),
+        "wall_seconds": wall,
+        "serial_seconds": serial,
+        "serial_measured": measure_serial,
+        "level_seconds": level_seconds,
+        "speedup": serial / wall if wall > 0 else 1.0,
+        "scanned_fraction": float(scanned) / (scan.size * len(isos)),
+    }
+    return surfaces, report
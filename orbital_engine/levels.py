@@ -0,0 +1,150 @@
+import numpy as np
+
+def iso_levels(minimum, maximum, levels):
+    """ Choose the isosurface values and their material settings.
+
+    The values are spaced geometrically between the maximum and the minimum of the
+    density. At least 10 values are spaced out; when fewer levels are requested
+    only the lowest of those 10 are kept.
+
+    Args:
+        minimum (float): minimum of the probability density
+        maximum (float): maximum of the probability density
+        levels (int): number of iso levels to generate
+    Returns:
+        list: (isostep, iso, color_value, alpha_value) tuples, highest iso value first
+    """
+    if levels < 10:
+        nivos=10
+    else:
+        nivos=levels
+
+    width=(maximum-minimum)/nivos
+    old_min=minimum+(width/10)
+    old_max=maximum-(width/10)
+
+    result = []
+    isostep = 0
+    for iso in np.geomspace(maximum-(width/10),minimum+(width/20),nivos,endpoint=False):
+
+        isostep = isostep + 1
+
+        # if levels less than 10 -> only create the number of iso mesh levels equal as specified in levels
+        if nivos != levels:
+            if (10 - levels) >= isostep:
+                continue
+
+        color_value = (( (iso - old_min) / (old_max - old_min) ))
+
+        #if last level make alpha value a fixed value for better visualization
+        if isostep == nivos:
+            alpha_value=0.174
+        else:
+            alpha_value=color_value
+
+        result.append((isostep, iso, color_value, alpha_value))
+    return result
+
+# Enclosed probability levels
+#
+# The grid is uniform, so every voxel has the same volume and the probability inside
+# the isosurface of value iso is  P(iso) = Σ_{ρ >= iso} ρ / Σ ρ  over the grid. One
+# pass over the volume bins log ρ into a histogram weighted by ρ; the cumulative sum
+# of the bins from the densest one down gives P at every bin edge, and the iso value
+# of a probability is interpolated inside the bin where P reaches it. Nothing is
+# sorted and only one slab of temporaries is alive at a time.
+
+# Bins of the log density histogram
+PROBABILITY_BINS = 8192
+
+# Decades of density below the maximum covered by the histogram; the densities
+# below fall into the lowest bin, together they hold a negligible probability
+PROBABILITY_DECADES = 16
+
+# Voxels binned at once
+HISTOGRAM_SLAB_VOXELS = 1 << 22
+
+def parse_probabilities(text):
+    """ Parse enclosed probabilities given in percent, like "50 90 99" or "50%, 90%".
+
+    Args:
+        text (str): percentages separated by spaces or commas
+    Returns:
+        list: distinct fractions in (0, 1), ascending
+    Raises:
+        ValueError: a value is not a number strictly between 0 and 100
+    """
+    fractions = set()
+    for value in text.replace(",", " ").replace("%", " ").split():
+        percent = float(value)
+        if not 0 < percent < 100:
+            raise ValueError("enclosed probabilities should be between 0 and 100 %, got " + value)
+        fractions.add(percent / 100)
+    if not fractions:
+        raise ValueError("no enclosed probabilities given")
+    return sorted(fractions)
+
+def enclosed_probability_isos(volume, probabilities, maximum=None, bins=PROBABILITY_BINS,
+                              decades=PROBABILITY_DECADES, slab_voxels=HISTOGRAM_SLAB_VOXELS):
+    """ Iso values whose isosurfaces enclose the given fractions of the probability on the grid.
+
+    Args:
+        volume (numpy.ndarray): probability density on a uniform grid, axis 0 is
+            walked in slabs
+        probabilities (list): fractions in (0, 1)
+        maximum (float): maximum of the volume, None to compute it
+        bins (int): histogram bins, the iso values are accurate to a fraction of a bin
+        decades (float): decades of density below the maximum that are resolved
+        slab_voxels (int): voxels binned at once
+    Returns:
+        numpy.ndarray: float64 iso value per probability, in the order of probabilities
+    """
+    if maximum is None:
+        maximum = volume.max()
+    top = np.log(float(maximum))
+    bottom = top - decades * np.log(10)
+    scale = bins / (top - bottom)
+
+    histogram = np.zeros(bins, dtype=np.float64)
+    planes = max(1, slab_voxels // max(1, volume[0].size))
+    for start in range(0, len(volume), planes):
+        slab = volume[start:start + planes].ravel()
+        with np.errstate(divide='ignore'):
+            index = np.log(slab)
+        index -= bottom
+        index *= scale
+        # log(0) = -inf, like every density below the range, goes to the lowest bin
+        np.clip(index, 0, bins - 1, out=index)
+        histogram += np.bincount(index.astype(np.intp), weights=slab, minlength=bins)
+
+    # enclosed[k] is the probability of the bins k and above, at the lower edge of bin k
+    enclosed = np.cumsum(histogram[::-1])[::-1]
+    enclosed /= enclosed[0]
+    isos = []
+    for probability in probabilities:
+        # the densest bin whose lower edge encloses the probability
+        k = int(np.nonzero(enclosed >= probability)[0][-1])
+        above = enclosed[k + 1] if k + 1 < bins else 0.0
+        fraction = (probability - above) / max(enclosed[k] - above, np.finfo(np.float64).tiny)
+        isos.append(np.exp(bottom + (k + 1 - fraction) / scale))
+    return np.array(isos)
+
+def probability_levels(probabilities, isos):
+    """ Level tuples of enclosed probability iso values, like those of iso_levels.
+
+    The color value is the probability outside the isosurface, so the innermost
+    level is brightest, and the outermost level gets the fixed alpha of iso_levels.
+
+    Args:
+        probabilities (list): fractions in (0, 1)
+        isos (numpy.ndarray): iso value per probability
+    Returns:
+        list: (isostep, iso, color_value, alpha_value) tuples, highest iso value first
+    """
+    order = sorted(range(len(probabilities)), key=lambda index: probabilities[index])
+    result = []
+    for isostep, index in enumerate(order, start=1):
+        color_value = 1 - probabilities[index]
+        alpha_value = 0.174 if isostep == len(order) else color_value
+        result.append((isostep, isos[index], color_value, alpha_value))
+    return result
@@ -0,0 +1,100 @@
+import numpy as np
+
+# Levels of detail of isosurface meshes by vertex clustering.
+#
+# The vertices are snapped into the cells of a uniform grid, every cell is replaced
+# by the mean of its vertices and the triangles that collapse are dropped. For a
+# surface, the number of triangles left is about 2 * area / cell_size^2, which is
+# used to pick the cell size for a face budget.
+
+def _cluster_keys(verts, cell_size):
+    keys = np.floor(verts / cell_size).astype(np.int64)
+    keys = keys - keys.min(axis=0)
+    spans = keys.max(axis=0) + 1
+    if np.prod(spans.astype(np.float64)) < 2 ** 62:
+        return (keys[:, 0] * spans[1] + keys[:, 1]) * spans[2] + keys[:, 2]
+    return np.unique(keys, axis=0, return_inverse=True)[1].ravel()
+
+def decimate_vertex_clustering(verts, faces, normals, cell_size):
+    """ Simplify a triangle mesh by merging all vertices inside each grid cell.
+
+    Args:
+        verts (numpy.ndarray): (V, 3) vertices
+        faces (numpy.ndarray): (F, 3) triangles
+        normals (numpy.ndarray): (V, 3) vertex normals
+        cell_size (float): edge of the clustering grid cells
+    Returns:
+        tuple: simplified (vertices, faces, normals)
+    """
+    if len(faces) == 0:
+        return verts, faces, normals
+
+    clusters, cluster_of = np.unique(_cluster_keys(verts, cell_size), return_inverse=True)
+    cluster_of = cluster_of.ravel()
+    count = np.bincount(cluster_of, minlength=len(clusters)).astype(np.float64)
+
+    new_verts = np.empty((len(clusters), 3), dtype=np.float32)
+    new_normals = np.empty((len(clusters), 3), dtype=np.float32)
+    for axis in range(3):
+        new_verts[:, axis] = np.bincount(cluster_of, verts[:, axis], len(clusters)) / count
+        new_normals[:, axis] = np.bincount(cluster_of, normals[:, axis], len(clusters))
+    length = np.linalg.norm(new_normals, axis=1, keepdims=True)
+    new_normals = new_normals / np.where(length > 0, length, 1)
+
+    new_faces = cluster_of[faces]
+    new_faces = new_faces[(new_faces[:, 0] != new_faces[:, 1]) & (new_faces[:, 1] != new_faces[:, 2])
+                          & (new_faces[:, 2] != new_faces[:, 0])]
+    # triangles collapsing onto the same three clusters are kept once
+    unique_faces, first = np.unique(np.sort(new_faces, axis=1), axis=0, return_index=True)
+    new_faces = new_faces[np.sort(first)]
+    return new_verts, new_faces.astype(np.int32), new_normals
+
+def surface_area(verts, faces):
+    """ Total area of a triangle mesh. """
+    edge1 = verts[faces[:, 1]] - verts[faces[:, 0]]
+    edge2 = verts[faces[:, 2]] - verts[faces[:, 0]]
+    return 0.5 * np.linalg.norm(np.cross(edge1, edge2), axis=1).sum()
+
+def decimate_to_budget(verts, faces, normals, target_faces, attempts=4):
+    """ Simplify a mesh by vertex clustering to at most about target_faces triangles.
+
+    Args:
+        verts (numpy.ndarray): (V, 3) vertices
+        faces (numpy.ndarray): (F, 3) triangles
+        normals (numpy.ndarray): (V, 3) vertex normals
+        target_faces (int): face budget
+        attempts (int): how often the cell size may be enlarged when over budget
+    Returns:
+        tuple: simplified (vertices, faces, normals), the input if it is within budget
+    """
+    if len(faces) <= target_faces:
+        return verts, faces, normals
+
+    cell_size = np.sqrt(2 * surface_area(verts, faces) / max(target_faces, 1))
+    for attempt in range(attempts):
+        lod = decimate_vertex_clustering(verts, faces, normals, cell_size)
+        if len(lod[1]) <= 1.1 * target_faces:
+            break
+        cell_size = cell_size * np.sqrt(len(lod[1]) / target_faces)
+    return lod
+
+def lod_chain(verts, faces, normals, face_budgets):
+    """ Levels of detail of a mesh, one per face budget.
+
+    Args:
+        verts (numpy.ndarray): (V, 3) vertices
+        faces (numpy.ndarray): (F, 3) triangles
+        normals (numpy.ndarray): (V, 3) vertex normals
+        face_budgets (list): face budgets, largest first
+    Returns:
+        list: (vertices, faces, normals) per budget the mesh exceeds, in budget order
+    """
+    chain = []
+    for budget in face_budgets:
+        if len(faces) <= budget:
+            continue
+        # every level is simplified from the previous one, which is cheaper and keeps
+        # the levels consistent
+        source = chain[-1] if chain else (verts, faces, normals)
+        chain.append(decimate_to_budget(*source, budget))
+    return chain
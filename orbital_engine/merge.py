@@ -0,0 +1,115 @@
+import numpy as np
+from dataclasses import dataclass
+from .isosurface import weld_vertices
+from .wavefunction import wavefunction_cartesian
+from .instrument import maybe_stage
+
+# All iso levels of a state packed into one mesh
+#
+# Instead of one object, mesh and material per level, the surfaces are concatenated
+# and every vertex carries its level index, the signed wavefunction and the density
+# as attributes, which one material turns into color and alpha. The wavefunction is
+# evaluated at the vertices themselves with wavefunction_cartesian: that is exact,
+# costs as little as the vertex count, and works whether the density volume was
+# evaluated whole, as one octant, adaptively or came from a cache.
+
+# Vertices evaluated at once by vertex_wavefunction, each needs about 200 bytes of scratch memory
+VERTEX_CHUNK = 1 << 18
+
+@dataclass
+class MergedSurface:
+    """ The iso levels of one state as one mesh with per-vertex attributes. """
+    # (V, 3) float32 vertices in grid index space
+    vertices: np.ndarray
+    # (F, 3) int32 triangles
+    faces: np.ndarray
+    # (V, 3) float32 vertex normals
+    normals: np.ndarray
+    # (V,) int32 index of the level of every vertex in the level list
+    level: np.ndarray
+    # (V,) float32 signed wavefunction at every vertex
+    psi: np.ndarray
+    # (V,) float32 probability density at every vertex
+    density: np.ndarray
+
+def merge_surfaces(surfaces, tolerance=0.01):
+    """ Weld every surface on its own and concatenate them into one mesh.
+
+    The welding is done here rather than on the merged mesh, so vertices of two levels
+    that happen to lie within the tolerance are never joined.
+
+    Args:
+        surfaces (list): (vertices, faces, normals) per level
+        tolerance (float): weld distance in grid spacings
+    Returns:
+        tuple: (vertices, faces, normals, level) numpy arrays, see MergedSurface
+    """
+    welded = []
+    for verts, faces, normals in surfaces:
+        welded.append(weld_vertices(np.asarray(verts, dtype=np.float32), np.asarray(faces, dtype=np.int32),
+                                    np.asarray(normals, dtype=np.float32), tolerance))
+    vertex_count = sum(len(verts) for verts, faces, normals in welded)
+    face_count = sum(len(faces) for verts, faces, normals in welded)
+
+    vertices = np.empty((vertex_count, 3), dtype=np.float32)
+    normals_out = np.empty((vertex_count, 3), dtype=np.float32)
+    faces_out = np.empty((face_count, 3), dtype=np.int32)
+    level = np.empty(vertex_count, dtype=np.int32)
+    vertex_start = 0
+    face_start = 0
+    for index, (verts, faces, normals) in enumerate(welded):
+        vertex_stop = vertex_start + len(verts)
+        face_stop = face_start + len(faces)
+        vertices[vertex_start:vertex_stop] = verts
+        normals_out[vertex_start:vertex_stop] = normals
+        np.add(faces, vertex_start, out=faces_out[face_start:face_stop])
+        level[vertex_start:vertex_stop] = index
+        vertex_start = vertex_stop
+        face_start = face_stop
+    return vertices, faces_out, normals_out, level
+
+def vertex_wavefunction(n, l, m, a0, vertices, grid_extent, grid_resolution, chunk_size=VERTEX_CHUNK):
+    """ Signed wavefunction at mesh vertices in grid index space.
+
+    The vertices run along (x, z, y) like the density volume (see density_block) and
+    grid index i lies at -grid_extent + i * 2 grid_extent / (grid_resolution - 1).
+
+    Args:
+        n (int): principal quantum number
+        l (int): azimuthal quantum number
+        m (int): magnetic quantum number
+        a0 (float): scaled Bohr radius
+        vertices (numpy.ndarray): (V, 3) vertices in grid index space
+        grid_extent (int): the grid spans [-grid_extent, grid_extent] along each axis
+        grid_resolution (int): number of grid points along each axis
+        chunk_size (int): vertices evaluated at once
+    Returns:
+        numpy.ndarray: (V,) float32 wavefunction
+    """
+    psi = np.empty(len(vertices), dtype=np.float32)
+    spacing = 2 * grid_extent / max(grid_resolution - 1, 1)
+    for start in range(0, len(vertices), chunk_size):
+        block = vertices[start:start + chunk_size].astype(np.float64) * spacing - grid_extent
+        psi[start:start + len(block)] = wavefunction_cartesian(n, l, m, a0, block[:, 0], block[:, 2], block[:, 1])
+    return psi
+
+def merge_result(result, surfaces=None, instrument=None):
+    """ Pack the iso levels of an OrbitalResult into one mesh with per-vertex attributes.
+
+    Args:
+        result (pipeline.OrbitalResult): generated isosurfaces
+        surfaces (list): (vertices, faces, normals) per level to merge instead of
+            result.surfaces, like the lightest levels of detail
+        instrument (instrument.Instrument): records the merge stage, None to skip
+    Returns:
+        MergedSurface: the merged mesh
+    """
+    if surfaces is None:
+        surfaces = result.surfaces
+    with maybe_stage(instrument, "merge", levels=len(surfaces)) as stage:
+        vertices, faces, normals, level = merge_surfaces(surfaces)
+        # the vertices of an ADAPTIVE result index its refined grid
+        psi = vertex_wavefunction(result.n, result.l, result.m, result.a0, vertices, result.grid_extent,
+                                  result.mesh_resolution)
+        stage["vertices"] = len(vertices)
+    return MergedSurface(vertices, faces, normals, level, psi, np.square(psi))
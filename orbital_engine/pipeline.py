@@ -0,0 +1,296 @@
+import numpy as np
+from dataclasses import dataclass, field
+from . import cache as density_cache
+from .levels import iso_levels, enclosed_probability_isos, probability_levels
+from .wavefunction import (check_quantum_numbers, scaled_bohr_radius, plot_wf_probability_density,
+                           compute_probability_density, compute_probability_density_slabs, auto_grid_extent)
+from .isosurface import extract_isosurfaces, adaptive_isosurfaces
+from .lod import lod_chain
+from .instrument import maybe_stage
+
+# Evaluation modes of generate_orbital
+EVALUATIONS = ('DENSE', 'SLABS', 'SYMMETRIC', 'ADAPTIVE')
+
+class GenerationCancelled(Exception):
+    """ Raised by generate_orbital when its cancel event is set. """
+
+@dataclass
+class OrbitalResult:
+    """ Isosurfaces of one quantum state, ready to be turned into meshes. """
+    n: int
+    l: int
+    m: int
+    sf: float
+    grid_extent: int
+    grid_resolution: int
+    a0: float
+    # (isostep, iso, color_value, alpha_value) per level, as returned by iso_levels
+    levels: list
+    # (vertices, faces, normals) per level, in grid index space
+    surfaces: list
+    report: dict = field(default_factory=dict)
+    # per level, the lighter (vertices, faces, normals) meshes of lod_chain, most detailed first
+    lods: list = field(default_factory=list)
+
+    @property
+    def mesh_resolution(self):
+        """ Number of grid points along each axis of the index space of the surfaces,
+        the effective resolution of an ADAPTIVE evaluation and grid_resolution otherwise. """
+        if "adaptive" in self.report:
+            return self.report["adaptive"]["effective_resolution"]
+        return self.grid_resolution
+
+    @property
+    def name(self):
+        return orbital_name(self.n, self.l, self.m, self.sf, self.grid_extent, self.grid_resolution)
+
+def orbital_name(n, l, m, sf, grid_extent, grid_resolution):
+    """ Name of the collection holding the iso level meshes of a quantum state. """
+    return "orb_" + str(n) + "_" + str(l) + "_" + str(m) + "_" + str(round(sf,2)) + "_" + str(grid_extent) + "_" + str(grid_resolution)
+
+def generate_orbital(n, l, m, sf, grid_extent, grid_resolution, levels, evaluation='DENSE',
+                     memory_budget_mb=512, target_resolution=1600, auto_extent=False, cache=None,
+                     workers=0, backend='PROCESS', crop=True, lod_budgets=(), factors=None, instrument=None,
+                     log=print, progress=None, on_level=None, cancel=None, session=None, probabilities=()):
+    """ Compute the isosurfaces of the probability density of a quantum state (n,l,m).
+
+    This is the whole numerical pipeline behind the Blender operator: grid sizing,
+    density evaluation (or a cache hit), iso level selection and isosurface extraction.
+
+    It can run in a background thread: progress and on_level are called from the
+    thread running generate_orbital, and cancel is checked between stages, slabs and
+    extracted levels, so a cancelled slab based run stops within one slab or one
+    marching cubes call.
+
+    Args:
+        n (int): principal quantum number
+        l (int): azimuthal quantum number
+        m (int): magnetic quantum number
+        sf (float): Bohr radius scale factor
+        grid_extent (int): the grid spans [-grid_extent, grid_extent] along each axis
+        grid_resolution (int): number of grid points along each axis
+        levels (int): number of iso levels
+        evaluation (str): one of EVALUATIONS
+        memory_budget_mb (float): scratch memory of the slabs evaluated at the same time by
+            the slab based evaluations
+        target_resolution (int): effective resolution of the ADAPTIVE evaluation
+        auto_extent (bool): replace grid_extent by auto_grid_extent, fitted to the
+            lowest iso level or the largest enclosed probability
+        cache (cache.DensityCache): on-disk density cache, None to always compute
+        workers (int): slab evaluation threads and isosurface extraction workers, 0 uses
+            one per CPU core
+        backend (str): 'PROCESS' or 'THREAD' extraction workers, see extract_isosurfaces
+        crop (bool): crop marching cubes to the nested active boxes
+        lod_budgets (list): face budgets of the levels of detail built for every surface
+        factors (factors.FactorCache): in-memory radial/angular factor cache of the
+            SLABS and SYMMETRIC evaluations, None to evaluate psi directly
+        instrument (instrument.Instrument): records the stages of the run, None to skip
+        log (callable): receives progress messages like print
+        progress (callable): called as progress(stage, fraction) with the stage
+            "density", "marching_cubes" or "lod" and the finished fraction of it
+        on_level (callable): called as on_level(index, level, surface) as soon as the
+            surface of a level is extracted, with level the (isostep, iso, color_value,
+            alpha_value) of iso_levels; the levels arrive in the order they finish
+        cancel (threading.Event): stops the run with GenerationCancelled once set
+        session (session.OrbitalSession): results of the previous run, reused where the
+            inputs did not change and updated with the new ones; None to compute everything
+        probabilities (list): fractions of the probability on the grid enclosed by the
+            isosurfaces (see enclosed_probability_isos) instead of levels geometrically
+            spaced iso values; the iso values are in report["thresholds"]
+    Returns:
+        OrbitalResult: levels and surfaces of the state
+    Raises:
+        GenerationCancelled: cancel was set before the run finished
+    """
+    check_quantum_numbers(n, l, m)
+    if evaluation not in EVALUATIONS:
+        raise ValueError('evaluation should be one of ' + ', '.join(EVALUATIONS))
+    report = {"evaluation": evaluation}
+
+    def checkpoint(stage, fraction):
+        if cancel is not None and cancel.is_set():
+            raise GenerationCancelled()
+        if progress is not None:
+            progress(stage, fraction)
+
+    def slab_ready(fraction):
+        checkpoint("density", fraction)
+
+    if auto_extent:
+        with maybe_stage(instrument, "auto_extent"):
+            grid_extent, iso_radius, voxel_size = auto_grid_extent(n, l, m, sf, grid_resolution, levels,
+                                                                   probabilities=probabilities)
+        report["voxel_size"] = voxel_size
+        log("auto grid extent=", grid_extent, " lowest iso level radius=", round(iso_radius, 2),
+            " voxel size=", round(voxel_size, 3))
+    a0 = scaled_bohr_radius(sf)
+
+    checkpoint("density", 0.0)
+    if evaluation == 'ADAPTIVE':
+        adaptive_key = dict(density_cache.make_key(n, l, m, sf, grid_extent, grid_resolution, np.float64),
+                            evaluation=evaluation, target_resolution=int(target_resolution), levels=int(levels),
+                            probabilities=[float(p) for p in probabilities])
+        if session is not None and session.select(adaptive_key) and session.adaptive is not None:
+            level_list, surfaces, adaptive_report = session.adaptive
+            report["session_hit"] = True
+            log("adaptive surfaces reused from the previous run")
+        else:
+            with maybe_stage(instrument, "adaptive", target_resolution=target_resolution) as stage:
+                level_list, surfaces, adaptive_report = adaptive_isosurfaces(n, l, m, sf, grid_extent,
+                                                                             grid_resolution, target_resolution,
+                                                                             levels, memory_budget_mb=memory_budget_mb,
+                                                                             probabilities=probabilities)
+                stage["evaluated_samples"] = adaptive_report["evaluated_samples"]
+                stage["faces"] = [len(faces) for verts, faces, normals in surfaces]
+            if session is not None:
+                session.adaptive = (level_list, surfaces, adaptive_report)
+        report["adaptive"] = adaptive_report
+        if probabilities:
+            report["thresholds"] = adaptive_report["thresholds"]
+        log("a0=",a0)
+        log("effective resolution=", adaptive_report["effective_resolution"],
+            " refinements=", adaptive_report["refinements"], " blocks=", adaptive_report["leaf_blocks"])
+        log("evaluated", adaptive_report["evaluated_samples"], "samples instead of", adaptive_report["dense_samples"])
+        # the adaptive refinement extracts all levels at once
+        for index, surface in enumerate(surfaces):
+            checkpoint("marching_cubes", (index + 1) / len(surfaces))
+            if on_level is not None:
+                on_level(index, level_list[index], surface)
+        return _with_lods(OrbitalResult(n, l, m, sf, grid_extent, grid_resolution, a0, level_list, surfaces, report),
+                          lod_budgets, instrument, log, checkpoint, session)
+
+    symmetric = evaluation == 'SYMMETRIC'
+
+    prob_density = None
+    cache_key = density_cache.make_key(n, l, m, sf, grid_extent, grid_resolution,
+                                       np.float64 if evaluation == 'DENSE' else np.float32)
+    if session is not None:
+        if session.select(cache_key):
+            prob_density = session.density
+        report["session_hit"] = prob_density is not None
+        if prob_density is not None:
+            log("density volume reused from the previous run")
+
+    if prob_density is None and cache is not None:
+        with maybe_stage(instrument, "cache_load"):
+            prob_density = cache.load(cache_key)
+        report["cache_hit"] = prob_density is not None
+        if prob_density is not None:
+            log("density volume loaded from cache")
+
+    if prob_density is None:
+        if evaluation in {'SLABS', 'SYMMETRIC'}:
+            with maybe_stage(instrument, "density", voxels=grid_resolution ** 3) as stage:
+                prob_density, slab_report = compute_probability_density_slabs(n, l, m, sf, grid_extent,
+                                                                              grid_resolution, memory_budget_mb,
+                                                                              symmetric=symmetric, factors=factors,
+                                                                              instrument=instrument,
+                                                                              on_slab=slab_ready, workers=workers)
+                stage["bytes"] = prob_density.nbytes
+            report["slabs"] = slab_report
+            if "factors" in slab_report:
+                log("factor cache: angular", "hit" if slab_report["factors"]["angular_hit"] else "computed",
+                    " radial", "hit" if slab_report["factors"]["radial_hit"] else "computed")
+            else:
+                log("slab thickness=", slab_report["slab_thickness"], " slabs=", slab_report["slabs"],
+                    " workers=", slab_report["workers"])
+            log("peak memory=", round(slab_report["peak_bytes"] / (1024 * 1024), 1), "MiB")
+        else:
+            with maybe_stage(instrument, "wavefunction", voxels=grid_resolution ** 3) as stage:
+                psi = plot_wf_probability_density(n, l, m, sf, grid_extent, grid_resolution, instrument)
+                stage["bytes"] = psi.nbytes
+            with maybe_stage(instrument, "density", voxels=grid_resolution ** 3) as stage:
+                prob_density = compute_probability_density(psi)
+                stage["bytes"] = prob_density.nbytes
+            del psi
+        if cache is not None:
+            with maybe_stage(instrument, "cache_store"):
+                cache.store(cache_key, prob_density)
+    if session is not None:
+        session.density = prob_density
+    checkpoint("density", 1.0)
+
+    min = prob_density.min()
+    max = prob_density.max()
+    report["min"] = float(min)
+    report["max"] = float(max)
+
+    log("min=",min," max=",max)
+    log("a0=",a0)
+
+    if probabilities:
+        with maybe_stage(instrument, "enclosed_probability", voxels=prob_density.size):
+            isos = enclosed_probability_isos(prob_density, probabilities, max)
+        level_list = probability_levels(probabilities, isos)
+        report["thresholds"] = [[float(p), float(iso)] for p, iso in zip(probabilities, isos)]
+        log("enclosed probability iso values=", report["thresholds"])
+    else:
+        level_list = iso_levels(min, max, levels)
+    surfaces = [None] * len(level_list)
+    if session is not None:
+        surfaces = [session.surface(level[1]) for level in level_list]
+    # only the iso values the session does not know yet are extracted
+    todo = [index for index, surface in enumerate(surfaces) if surface is None]
+    report["reused_levels"] = len(level_list) - len(todo)
+    finished = []
+
+    def level_ready(index, surface):
+        finished.append(index)
+        checkpoint("marching_cubes", len(finished) / len(level_list))
+        if on_level is not None:
+            on_level(index, level_list[index], surface)
+
+    checkpoint("marching_cubes", 0.0)
+    for index, surface in enumerate(surfaces):
+        if surface is not None:
+            level_ready(index, surface)
+
+    if todo:
+        def extracted(position, surface):
+            surfaces[todo[position]] = surface
+            if session is not None:
+                session.keep_surface(level_list[todo[position]][1], surface)
+            level_ready(todo[position], surface)
+
+        with maybe_stage(instrument, "marching_cubes", levels=len(todo)) as stage:
+            extracted_surfaces, extraction_report = extract_isosurfaces(prob_density,
+                                                                        [level_list[index][1] for index in todo],
+                                                                        symmetric, workers, backend, crop,
+                                                                        on_level=extracted, log=log)
+            stage["level_seconds"] = extraction_report["level_seconds"]
+            stage["vertices"] = [len(verts) for verts, faces, normals in extracted_surfaces]
+            stage["faces"] = [len(faces) for verts, faces, normals in extracted_surfaces]
+        if instrument is not None:
+            # the levels are extracted concurrently, so their CPU times are recorded afterwards
+            for index, seconds, (verts, faces, normals) in zip(todo, extraction_report["level_seconds"],
+                                                               extracted_surfaces):
+                isostep, iso, color_value, alpha_value = level_list[index]
+                instrument.record("marching_cubes_level", seconds, isostep=int(isostep), iso=float(iso),
+                                  vertices=len(verts), faces=len(faces))
+        report["extraction"] = extraction_report
+        log("isosurfaces extracted with", extraction_report["workers"], extraction_report["backend"].lower(),
+            "workers in", round(extraction_report["wall_seconds"], 2), "s, speedup",
+            round(extraction_report["speedup"], 2), "x over the serial loop")
+        log("marching cubes scanned", round(100 * extraction_report["scanned_fraction"], 1), "% of the volume")
+    if report["reused_levels"]:
+        log(report["reused_levels"], "of", len(level_list), "isosurfaces reused from the previous run")
+
+    return _with_lods(OrbitalResult(n, l, m, sf, grid_extent, grid_resolution, a0, level_list, surfaces, report),
+                      lod_budgets, instrument, log, checkpoint, session)
+
+def _with_lods(result, lod_budgets, instrument, log, checkpoint, session=None):
+    if not lod_budgets:
+        return result
+    budgets = sorted(lod_budgets, reverse=True)
+    with maybe_stage(instrument, "lod", budgets=budgets):
+        for index, (level, surface) in enumerate(zip(result.levels, result.surfaces)):
+            checkpoint("lod", index / len(result.surfaces))
+            chain = None if session is None else session.lod(level[1], budgets)
+            if chain is None:
+                chain = lod_chain(*surface, budgets)
+                if session is not None:
+                    session.keep_lod(level[1], budgets, chain)
+            result.lods.append(chain)
+    result.report["lod_faces"] = [[len(lod[1]) for lod in chain] for chain in result.lods]
+    log("levels of detail (faces)=", result.report["lod_faces"])
+    return result
@@ -0,0 +1,184 @@
+import time
+import numpy as np
+from dataclasses import dataclass, field
+from .wavefunction import (check_quantum_numbers, scaled_bohr_radius, radial_function, legendre_solid,
+                           auto_grid_extent)
+from .pipeline import GenerationCancelled, orbital_name
+from .instrument import maybe_stage
+
+# Monte-Carlo electron positions distributed like |Ψ|^2
+#
+# In spherical coordinates the probability of a volume element is
+#   |Ψ|^2 dV = r^2 R(r)^2 dr * Θ(u)^2 du * cos(m φ)^2 dφ,     u = cos θ
+# with Θ(u) = Pi_l^|m|(u, 1) (1 - u^2)^(|m|/2), the polar part of the real solid
+# harmonic on the unit sphere (see legendre_solid and azimuthal_solid). The three
+# factors are independent distributions, so r, u and φ are drawn separately by
+# inverting their cumulative distributions, tabulated once on fine 1D grids. The
+# cost grows with the number of samples only, not with the cube of a grid resolution.
+
+# Points of the tabulated cumulative distributions
+TABLE_SIZE = 1 << 16
+
+# Samples drawn at once, each needs about 100 bytes of scratch memory
+CHUNK_SIZE = 1 << 20
+
+def _cumulative(x, pdf):
+    # normalized cumulative trapezoid of pdf over x, starting at 0
+    cdf = np.empty_like(x)
+    cdf[0] = 0
+    np.cumsum((pdf[1:] + pdf[:-1]) * np.diff(x) / 2, out=cdf[1:])
+    return cdf / cdf[-1]
+
+def radial_table(n, l, a0, size=TABLE_SIZE, tail=1e-12):
+    """ Cumulative distribution of the radius, r^2 R(r)^2.
+
+    Args:
+        n (int): principal quantum number
+        l (int): azimuthal quantum number
+        a0 (float): scaled Bohr radius
+        size (int): number of tabulated radii
+        tail (float): probability beyond the last tabulated radius at most
+    Returns:
+        tuple: (numpy.ndarray radii, numpy.ndarray cumulative probabilities)
+    """
+    # as in auto_grid_extent, widen the range until the distribution has decayed
+    radius = n * a0 * (n + 10)
+    while True:
+        r = np.linspace(0, radius, size)
+        pdf = np.square(r * radial_function(n, l, r, a0))
+        cdf = _cumulative(r, pdf)
+        if cdf[-size // 64] >= 1 - tail:
+            return r, cdf
+        radius = 2 * radius
+
+def polar_table(l, m, size=TABLE_SIZE):
+    """ Cumulative distribution of u = cos(theta), Pi_l^|m|(u, 1)^2 (1 - u^2)^|m|. """
+    u = np.linspace(-1, 1, size)
+    pdf = np.square(legendre_solid(l, abs(m), u, np.ones_like(u))) * (1 - u * u) ** abs(m)
+    return u, _cumulative(u, pdf)
+
+def azimuthal_table(m, size=TABLE_SIZE):
+    """ Cumulative distribution of phi, cos(m phi)^2. """
+    phi = np.linspace(0, 2 * np.pi, size)
+    return phi, _cumulative(phi, np.square(np.cos(abs(m) * phi)))
+
+def sample_positions(n, l, m, a0, count, out=None, chunk_size=CHUNK_SIZE, seed=None, on_chunk=None):
+    """ Draw electron positions distributed like |Ψ_nlm|^2.
+
+    Args:
+        n (int): principal quantum number
+        l (int): azimuthal quantum number
+        m (int): magnetic quantum number
+        a0 (float): scaled Bohr radius
+        count (int): number of positions
+        out (numpy.ndarray): (count, 3) float32 buffer to fill, None to allocate it
+        chunk_size (int): positions drawn at once, bounds the scratch memory
+        seed (int): seed of the random generator, None for a random one
+        on_chunk (callable): called with the filled fraction of out after every chunk;
+            an exception raised by it stops the sampling
+    Returns:
+        numpy.ndarray: (count, 3) float32 x, y, z positions in the units of a0
+    """
+    if out is None:
+        out = np.empty((count, 3), dtype=np.float32)
+    r_grid, r_cdf = radial_table(n, l, a0)
+    u_grid, u_cdf = polar_table(l, m)
+    phi_grid, phi_cdf = azimuthal_table(m)
+    rng = np.random.default_rng(seed)
+
+    for start in range(0, count, chunk_size):
+        stop = min(start + chunk_size, count)
+        uniform = rng.random((3, stop - start))
+        r = np.interp(uniform[0], r_cdf, r_grid)
+        u = np.interp(uniform[1], u_cdf, u_grid)
+        phi = np.interp(uniform[2], phi_cdf, phi_grid)
+        rho = r * np.sqrt(1 - u * u)
+        block = out[start:stop]
+        block[:, 0] = rho * np.cos(phi)
+        block[:, 1] = rho * np.sin(phi)
+        block[:, 2] = r * u
+        if on_chunk is not None:
+            on_chunk(stop / count)
+    return out
+
+def grid_space(positions, grid_extent, grid_resolution):
+    """ Move positions into the centered grid index space of the isosurface meshes.
+
+    The mesh vertices are grid indices along (x, z, y) (see density_block), centered
+    on the object origin, so the point cloud lines up with the meshes of the same grid.
+
+    Args:
+        positions (numpy.ndarray): (N, 3) x, y, z positions, changed in place
+        grid_extent (int): the grid spans [-grid_extent, grid_extent] along each axis
+        grid_resolution (int): number of grid points along each axis
+    Returns:
+        numpy.ndarray: positions, as (x, z, y) in grid spacings
+    """
+    positions[:, [1, 2]] = positions[:, [2, 1]]
+    positions *= (grid_resolution - 1) / (2 * grid_extent)
+    return positions
+
+@dataclass
+class PointCloudResult:
+    """ Monte-Carlo electron positions of one quantum state, ready to be turned into a mesh. """
+    n: int
+    l: int
+    m: int
+    sf: float
+    grid_extent: int
+    grid_resolution: int
+    a0: float
+    # (N, 3) float32 positions in the centered grid space of the isosurface meshes
+    points: np.ndarray
+    report: dict = field(default_factory=dict)
+
+    @property
+    def name(self):
+        return orbital_name(self.n, self.l, self.m, self.sf, self.grid_extent, self.grid_resolution)
+
+def sample_orbital(n, l, m, sf, grid_extent, grid_resolution, count, levels=1, auto_extent=False, seed=None,
+                   chunk_size=CHUNK_SIZE, instrument=None, log=print, progress=None, cancel=None):
+    """ Draw a point cloud of electron positions of the quantum state (n,l,m).
+
+    The grid extent and resolution only set the scale of the points, so that they
+    line up with the isosurfaces of generate_orbital for the same arguments.
+
+    Args:
+        n (int): principal quantum number
+        l (int): azimuthal quantum number
+        m (int): magnetic quantum number
+        sf (float): Bohr radius scale factor
+        grid_extent (int): the grid spans [-grid_extent, grid_extent] along each axis
+        grid_resolution (int): number of grid points along each axis
+        count (int): number of positions
+        levels (int): number of iso levels, only used by auto_extent
+        auto_extent (bool): replace grid_extent by auto_grid_extent
+        seed (int): seed of the random generator, None for a random one
+        chunk_size (int): positions drawn at once
+        instrument (instrument.Instrument): records the sampling stage, None to skip
+        log (callable): receives progress messages like print
+        progress (callable): called as progress("sampling", fraction)
+        cancel (threading.Event): stops the run with GenerationCancelled once set
+    Returns:
+        PointCloudResult: positions of the state
+    """
+    check_quantum_numbers(n, l, m)
+    if auto_extent:
+        grid_extent = auto_grid_extent(n, l, m, sf, grid_resolution, levels)[0]
+    a0 = scaled_bohr_radius(sf)
+
+    def chunk_ready(fraction):
+        if cancel is not None and cancel.is_set():
+            raise GenerationCancelled()
+        if progress is not None:
+            progress("sampling", fraction)
+
+    start = time.perf_counter()
+    with maybe_stage(instrument, "sampling", points=count) as stage:
+        points = sample_positions(n, l, m, a0, count, chunk_size=chunk_size, seed=seed, on_chunk=chunk_ready)
+        grid_space(points, grid_extent, grid_resolution)
+        stage["bytes"] = points.nbytes
+    seconds = time.perf_counter() - start
+    log(count, "electron positions sampled in", round(seconds, 2), "s")
+    report = {"points": count, "seed": seed, "sampling_seconds": seconds}
+    return PointCloudResult(n, l, m, sf, grid_extent, grid_resolution, a0, points, report)
@@ -0,0 +1,74 @@
+# Results of the last generation, kept in memory for the next one.
+#
+# The results depend on the inputs like this:
+#
+#   density volume  <- n, l, m, sf, grid extent, grid resolution, volume dtype
+#   surface         <- density volume, iso value
+#   levels of detail <- surface, face budgets
+#
+# The iso values of iso_levels only depend on the density and the number of levels,
+# and fewer than 10 levels are always taken from the same 10 values, so adding
+# levels leaves the surfaces of the existing ones valid. The ADAPTIVE evaluation
+# extracts all levels in one go, so its surfaces are kept as a whole.
+
+class OrbitalSession:
+    """ Density volume, surfaces and levels of detail of the last generation.
+
+    generate_orbital reuses whatever is still valid for its inputs and only computes
+    the rest: a new state or grid needs a new density volume, new iso values only
+    need their surfaces and new face budgets only their levels of detail.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        """ Forget all results. """
+        self.key = None
+        self.density = None
+        # surfaces and levels of detail by iso value, of the density of key
+        self.surfaces = {}
+        self.lods = {}
+        # (level list, surfaces, report) of an ADAPTIVE run
+        self.adaptive = None
+
+    def select(self, key):
+        """ Make key the inputs the kept results belong to.
+
+        Args:
+            key (dict): inputs of the density volume (see cache.make_key) or of an
+                ADAPTIVE run
+        Returns:
+            bool: True if the kept results are still valid, False if they were dropped
+        """
+        if key == self.key:
+            return True
+        self.clear()
+        self.key = key
+        return False
+
+    def surface(self, iso):
+        """ Kept (vertices, faces, normals) of an iso value, None if it was not extracted. """
+        return self.surfaces.get(float(iso))
+
+    def keep_surface(self, iso, surface):
+        self.surfaces[float(iso)] = surface
+
+    def lod(self, iso, budgets):
+        """ Kept lod_chain of an iso value for the face budgets, None if it was not built. """
+        return self.lods.get((float(iso), tuple(budgets)))
+
+    def keep_lod(self, iso, budgets, chain):
+        self.lods[(float(iso), tuple(budgets))] = chain
+
+    def nbytes(self):
+        """ Memory held by the kept arrays. """
+        total = 0 if self.density is None else self.density.nbytes
+        surfaces = list(self.surfaces.values())
+        for chain in self.lods.values():
+            surfaces.extend(chain)
+        if self.adaptive is not None:
+            surfaces.extend(self.adaptive[1])
+        for surface in surfaces:
+            total = total + sum(array.nbytes for array in surface)
+        return total
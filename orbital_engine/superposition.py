@@ -0,0 +1,263 @@
+import os
+import time
+import numpy as np
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from .wavefunction import check_quantum_numbers, scaled_bohr_radius, auto_grid_extent
+from .levels import iso_levels
+from .isosurface import extract_isosurfaces, _collect
+from .factors import FactorCache
+from .pipeline import GenerationCancelled
+from .instrument import maybe_stage
+
+# Time evolution of a superposition of stationary states
+#
+#   Ψ(t) = Σ c_i ψ_i e^(-i E_i t),   E_n = -1 / (2 n^2) Hartree, t in atomic time units
+#
+# The orbitals ψ_i of this extension are real, so with a_i(t) = c_i e^(-i E_i t)
+#   |Ψ(t)|^2 = (Σ Re(a_i) ψ_i)^2 + (Σ Im(a_i) ψ_i)^2
+# Every basis volume is evaluated once (see FactorCache.wavefunction_volume) as a
+# float32 volume, and a frame only costs two weighted sums of those volumes and two
+# squares. The density of a mixture of states is generally not even in x, y and z,
+# so the isosurfaces are extracted from the whole volume.
+
+# float32 volumes a frame holds at most while it is worked on: the density, the
+# imaginary sum and the scratch product of superposition_density, then the density
+# and the contiguous box copy and masks of the extraction
+FRAME_VOLUMES = 4
+
+def frame_workers(workers, frames, grid_resolution, memory_budget_mb):
+    """ Number of frame densities the range pass sums at the same time within a memory budget.
+
+    Args:
+        workers (int): requested number of frames at the same time
+        frames (int): number of frames
+        grid_resolution (int): number of grid points along each axis
+        memory_budget_mb (float): scratch memory of all frames summed at the same time
+    Returns:
+        int: at least 1, at most workers and frames
+    """
+    frame_bytes = FRAME_VOLUMES * 4 * grid_resolution ** 3
+    return max(1, min(workers, frames, int(memory_budget_mb * 1024 * 1024 // frame_bytes)))
+
+def parse_superposition(text):
+    """ Parse a superposition like "2,1,0 3,2,1:0.5@90".
+
+    Every term is n,l,m optionally followed by :amplitude (default 1) and @phase in
+    degrees (default 0), terms are separated by spaces or semicolons. The coefficients
+    are normalized so that the squared magnitudes sum to 1.
+
+    Args:
+        text (str): the superposition
+    Returns:
+        list: (n, l, m, complex coefficient) per term
+    Raises:
+        ValueError: a term cannot be parsed or is not a valid state
+    """
+    states = []
+    for term in text.replace(";", " ").split():
+        phase = 0.0
+        amplitude = 1.0
+        if "@" in term:
+            term, phase = term.split("@")
+            phase = float(phase)
+        if ":" in term:
+            term, amplitude = term.split(":")
+            amplitude = float(amplitude)
+        n, l, m = (int(value) for value in term.split(","))
+        check_quantum_numbers(n, l, m)
+        states.append((n, l, m, amplitude * np.exp(1j * np.radians(phase))))
+    if not states:
+        raise ValueError("the superposition has no states")
+    norm = np.sqrt(sum(abs(c) ** 2 for n, l, m, c in states))
+    if norm == 0:
+        raise ValueError("the amplitudes of the superposition are all 0")
+    return [(n, l, m, c / norm) for n, l, m, c in states]
+
+def state_energy(n):
+    """ Energy of the hydrogen level n in Hartree. """
+    return -0.5 / (n * n)
+
+def beat_period(states):
+    """ Period of the fastest beat of a superposition in atomic time units, None if it does not move.
+
+    Args:
+        states (list): (n, l, m, coefficient) per term
+    """
+    energies = [state_energy(n) for n, l, m, c in states]
+    spread = max(energies) - min(energies)
+    if spread == 0:
+        return None
+    return 2 * np.pi / spread
+
+def superposition_density(volumes, amplitudes, out=None):
+    """ |Σ a_i ψ_i|^2 of real basis volumes and complex amplitudes.
+
+    Args:
+        volumes (list): float32 basis volumes ψ_i
+        amplitudes (numpy.ndarray): complex a_i
+        out (numpy.ndarray): float32 volume to write, None to allocate it
+    Returns:
+        numpy.ndarray: float32 probability density
+    """
+    shape = volumes[0].shape
+    if out is None:
+        out = np.empty(shape, dtype=np.float32)
+    imag = np.zeros(shape, dtype=np.float32)
+    scratch = np.empty(shape, dtype=np.float32)
+    out.fill(0)
+    for volume, amplitude in zip(volumes, amplitudes):
+        if amplitude.real != 0:
+            out += np.multiply(volume, np.float32(amplitude.real), out=scratch)
+        if amplitude.imag != 0:
+            imag += np.multiply(volume, np.float32(amplitude.imag), out=scratch)
+    np.square(out, out=out)
+    out += np.square(imag, out=imag)
+    return out
+
+@dataclass
+class SuperpositionResult:
+    """ Isosurfaces of a time-evolving superposition, one set per frame. """
+    # (n, l, m, coefficient) per term
+    states: list
+    sf: float
+    grid_extent: int
+    grid_resolution: int
+    a0: float
+    # time of every frame in atomic units
+    times: list
+    # (isostep, iso, color_value, alpha_value) per level, shared by all frames
+    levels: list
+    # per frame, (vertices, faces, normals) per level in grid index space
+    frames: list
+    report: dict = field(default_factory=dict)
+
+    @property
+    def mesh_resolution(self):
+        """ Number of grid points along each axis of the index space of the surfaces. """
+        return self.grid_resolution
+
+    @property
+    def name(self):
+        return ("orb_sup_" + "_".join(str(n) + str(l) + str(m) for n, l, m, c in self.states) + "_" +
+                str(round(self.sf, 2)) + "_" + str(self.grid_extent) + "_" + str(self.grid_resolution))
+
+def animate_superposition(states, sf, grid_extent, grid_resolution, levels, times, memory_budget_mb=512,
+                          workers=0, crop=True, auto_extent=False, factors=None, instrument=None, log=print,
+                          progress=None, on_frame=None, cancel=None):
+    """ Compute the isosurfaces of a superposition at every frame time.
+
+    The iso values are the same in every frame, chosen from the smallest and largest
+    density over all frames, so a level keeps its meaning while the cloud moves. That
+    needs the densities twice: a first pass only takes their range, the second
+    extracts the isosurfaces. The range pass only runs numpy, which releases the GIL,
+    so its frames are summed in parallel by threads, as many as the memory budget
+    holds (see frame_workers). skimage's marching cubes holds the GIL, so the second
+    pass extracts the frames one after the other while a thread already sums the
+    density of the next frame.
+
+    Args:
+        states (list): (n, l, m, coefficient) per term, see parse_superposition
+        sf (float): Bohr radius scale factor
+        grid_extent (int): the grid spans [-grid_extent, grid_extent] along each axis
+        grid_resolution (int): number of grid points along each axis
+        levels (int): number of iso levels
+        times (list): time of every frame in atomic units
+        memory_budget_mb (float): scratch memory of the slabs of the basis evaluation, and
+            of the frames processed at the same time
+        workers (int): slabs of a basis volume evaluated and frame densities summed at the
+            same time by the range pass, 0 uses one per CPU core; fewer frames are summed
+            at the same time when the memory budget does not hold them
+        crop (bool): crop marching cubes to the nested active boxes
+        auto_extent (bool): replace grid_extent by the largest auto_grid_extent of the states
+        factors (factors.FactorCache): keeps the basis volumes for later runs, None to
+            keep them for this run only
+        instrument (instrument.Instrument): records the stages of the run, None to skip
+        log (callable): receives progress messages like print
+        progress (callable): called as progress(stage, fraction) with the stage
+            "basis", "range" or "marching_cubes"
+        on_frame (callable): called as on_frame(index, surfaces) as soon as a frame is done,
+            in the order of times
+        cancel (threading.Event): stops the run with GenerationCancelled once set
+    Returns:
+        SuperpositionResult: isosurfaces of every frame
+    """
+    if auto_extent:
+        grid_extent = max(auto_grid_extent(n, l, m, sf, grid_resolution, levels)[0] for n, l, m, c in states)
+    if factors is None:
+        factors = FactorCache()
+    if workers == 0:
+        workers = os.cpu_count() or 1
+    frame_count = frame_workers(workers, len(times), grid_resolution, memory_budget_mb)
+    report = {"frames": len(times), "workers": frame_count}
+
+    def checkpoint(stage, fraction):
+        if cancel is not None and cancel.is_set():
+            raise GenerationCancelled()
+        if progress is not None:
+            progress(stage, fraction)
+
+    volumes = []
+    hits = 0
+    with maybe_stage(instrument, "basis", states=len(states)):
+        for index, (n, l, m, c) in enumerate(states):
+            volume, hit = factors.wavefunction_volume(n, l, m, sf, grid_extent, grid_resolution, memory_budget_mb,
+                                                      instrument, workers=workers)
+            volumes.append(volume)
+            hits = hits + hit
+            checkpoint("basis", (index + 1) / len(states))
+    report["basis_hits"] = hits
+    log("basis volumes:", len(states) - hits, "computed,", hits, "reused")
+
+    energies = np.array([state_energy(n) for n, l, m, c in states])
+    coefficients = np.array([c for n, l, m, c in states], dtype=np.complex128)
+
+    def density(time):
+        return superposition_density(volumes, coefficients * np.exp(-1j * energies * time))
+
+    def value_range(time):
+        frame = density(time)
+        return frame.min(), frame.max()
+
+    start = time.perf_counter()
+    ranges = [None] * len(times)
+    frames = [None] * len(times)
+
+    def range_ready(index, value):
+        ranges[index] = value
+        checkpoint("range", sum(value is not None for value in ranges) / len(times))
+
+    def frame_ready(index, surfaces):
+        frames[index] = surfaces
+        checkpoint("marching_cubes", sum(frame is not None for frame in frames) / len(times))
+        if on_frame is not None:
+            on_frame(index, surfaces)
+
+    with ThreadPoolExecutor(frame_count) as pool:
+        with maybe_stage(instrument, "range", frames=len(times)):
+            _collect(pool, [pool.submit(value_range, t) for t in times], range_ready)
+        minimum = min(value[0] for value in ranges)
+        maximum = max(value[1] for value in ranges)
+        level_list = iso_levels(minimum, maximum, levels)
+        isos = [level[1] for level in level_list]
+        with maybe_stage(instrument, "marching_cubes", frames=len(times), levels=len(level_list)):
+            # marching cubes holds the GIL, so the frames are extracted here one after the
+            # other while a pool thread sums the density of the next one
+            upcoming = pool.submit(density, times[0])
+            for index in range(len(times)):
+                frame = upcoming.result()
+                if index + 1 < len(times):
+                    upcoming = pool.submit(density, times[index + 1])
+                if cancel is not None and cancel.is_set():
+                    raise GenerationCancelled()
+                surfaces, extraction_report = extract_isosurfaces(frame, isos, False, 1, 'THREAD', crop)
+                del frame
+                frame_ready(index, surfaces)
+
+    report["min"] = float(minimum)
+    report["max"] = float(maximum)
+    report["frame_seconds"] = time.perf_counter() - start
+    log(len(times), "frames of", len(level_list), "levels in", round(report["frame_seconds"], 2), "s,",
+        frame_count, "range workers")
+    return SuperpositionResult(states, sf, grid_extent, grid_resolution, scaled_bohr_radius(sf), list(times),
+                               level_list, frames, report)
@@ -0,0 +1,786 @@
+import os
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from scipy.constants import physical_constants
+import scipy.special as sp
+import numpy as np
+from .levels import iso_levels, enclosed_probability_isos
+from .instrument import maybe_stage
+
+def scaled_bohr_radius(a0_scale_factor):
+    """ Bohr radius in the grid units (picometres) scaled by a0_scale_factor. """
+    return a0_scale_factor * physical_constants['Bohr radius'][0] * 1e+12
+
+def asSpherical(x,y,z,eps):
+    #takes list xyz (single coord)
+    r       =  np.sqrt(x*x + y*y + z*z)
+    theta   =  np.arccos(z/(r + eps))
+    phi     =  np.arctan2(y,x)
+    return [r,theta,phi]
+
+# Normalized radial function Rnl(r)
+#
+# sp.genlaguerre computes the roots and quadrature weights of the polynomial every
+# time it is built, which dominates the cost on the small blocks of the adaptive
+# evaluation, and sp.factorial(n + l) overflows float64 from n = 86 on.
+# radial_function therefore runs the three-term recurrence
+#   (j + 1) L_{j+1}(p) = (2j + 1 + alpha - p) L_j(p) - (j + alpha) L_{j-1}(p)
+# directly on the grid (see laguerre_recurrence) and combines the normalization,
+# exp(-p/2) and p^l in log space, with gammaln in place of the factorials.
+# For the states the original implementation handles, it is the more accurate one:
+# the recurrence and the log-space factors lose a few more digits, about 5e-14
+# relative error at n, l = 50, 49 against 4e-16 (see benchmarks/bench_radial.py),
+# which is still far below the float32 precision of the density volumes.
+# radial_function_poly1d is the original implementation, kept for reference and for
+# that benchmark.
+
+# |L_j| beyond which the recurrence is rescaled
+LAGUERRE_RESCALE = 1e150
+
+def laguerre_recurrence(k, alpha, p):
+    """ Evaluate the generalized Laguerre polynomial L_k^alpha(p) by its three-term recurrence.
+
+    The values may exceed the float64 range for high k and large p, so they are
+    returned as a scaled polynomial and the log of the scale factor.
+
+    Args:
+        k (int): degree
+        alpha (float): order
+        p (numpy.ndarray): float64 points to evaluate at, p >= 0
+    Returns:
+        tuple: (numpy.ndarray scaled values, log scale), L_k^alpha(p) = values * exp(log scale);
+        the log scale is a float or an array shaped like p
+    """
+    previous = np.ones_like(p)
+    if k == 0:
+        return previous, 0.0
+    current = (1 + alpha) - p
+    scratch = np.empty_like(p)
+
+    # The recurrence runs on M_j = j! L_j, which saves the division by j + 1 per step:
+    #   M_{j+1} = (2j + 1 + alpha - p) M_j - j (j + alpha) M_{j-1}
+    # and 1 / k! goes into the log scale.
+    log_scale = -sp.gammaln(k + 1)
+
+    # |L_j^alpha(p)| <= binom(j + alpha, j) exp(p / 2) for alpha >= 0, so |M_j| is bounded by
+    # (j + alpha)! / alpha! exp(p / 2) and rescaling is only needed when that can leave the float64 range
+    bound = sp.gammaln(k + alpha + 1) - sp.gammaln(alpha + 1) + p.max(initial=0.0) / 2
+    rescale = bound > np.log(LAGUERRE_RESCALE)
+
+    for j in range(1, k):
+        # previous becomes M_{j+1}
+        np.subtract(2 * j + 1 + alpha, p, out=scratch)
+        scratch *= current
+        previous *= -j * (j + alpha)
+        previous += scratch
+        previous, current = current, previous
+
+        if rescale:
+            large = np.abs(current) > LAGUERRE_RESCALE
+            if large.any():
+                current[large] /= LAGUERRE_RESCALE
+                previous[large] /= LAGUERRE_RESCALE
+                log_scale = log_scale + large * np.log(LAGUERRE_RESCALE)
+    return current, log_scale
+
+def radial_function(n, l, r, a0):
+    """ Compute the normalized radial part of the wavefunction with the Laguerre
+    recurrence and a log-space normalization, accurate up to high n.
+
+    Args:
+        n (int): principal quantum number
+        l (int): azimuthal quantum number
+        r (numpy.ndarray): radial coordinate
+        a0 (float): scaled Bohr radius
+    Returns:
+        numpy.ndarray: wavefunction radial component
+    """
+    # Normalized radial distance from the nucleus
+    p = np.asarray(r, dtype=np.float64) * (2 / (n * a0))
+    return scaled_radial_function(n, l, p, a0)
+
+def scaled_radial_function(n, l, p, a0, reduced=False):
+    """ Compute the radial part of the wavefunction at the normalized radial distance p = 2 r / (n a0).
+
+    Args:
+        n (int): principal quantum number
+        l (int): azimuthal quantum number
+        p (numpy.ndarray): float64 normalized radial distance
+        a0 (float): scaled Bohr radius
+        reduced (bool): return R / p^l, which is finite and smooth at p = 0
+    Returns:
+        numpy.ndarray: wavefunction radial component
+    """
+    k = n - l - 1
+    alpha = 2 * l + 1
+
+    # log of the normalization constant of radial_function_poly1d, with gammaln for the factorials
+    log_constant = 0.5 * (3 * np.log(2 / n * a0) + sp.gammaln(k + 1) - np.log(2 * n) - sp.gammaln(n + l + 1))
+
+    laguerre, log_scale = laguerre_recurrence(k, alpha, p)
+
+    # log(constant * exp(-p / 2) * p^l), log(0) = -inf for l > 0 gives the 0 of p^l
+    log_envelope = np.multiply(p, -0.5)
+    if l > 0 and not reduced:
+        with np.errstate(divide='ignore'):
+            log_power = np.log(p)
+        log_power *= l
+        log_envelope += log_power
+    log_envelope += log_constant
+    log_envelope += log_scale
+    np.exp(log_envelope, out=log_envelope)
+    laguerre *= log_envelope
+    return laguerre
+
+def radial_function_poly1d(n, l, r, a0):
+    """ Compute the normalized radial part of the wavefunction using
+    Laguerre polynomials and an exponential decay factor.
+
+    Args:
+        n (int): principal quantum number
+        l (int): azimuthal quantum number
+        r (numpy.ndarray): radial coordinate
+        a0 (float): scaled Bohr radius
+    Returns:
+        numpy.ndarray: wavefunction radial component
+    """
+
+    # Laguerre polynomials describe how the electron density
+    # changes as the distance from the nucleus increases
+    laguerre = sp.genlaguerre(n - l - 1, 2 * l + 1)
+
+    # Normalized radial distance from the nucleus
+    p = 2 * r / (n * a0)
+
+    # This factor ensures the radial wavefunction is normalized
+    constant_factor = np.sqrt(
+        ((2 / n * a0) ** 3 * (sp.factorial(n - l - 1))) /
+        (2 * n * (sp.factorial(n + l)))
+    )
+
+    # The radial part of the wavefunction is constructed by the product of:
+    # - Constant factor:
+    #   Normalizes the radial wavefunction
+
+    # - Exponential decay factor: np.exp(-p / 2)
+    #   Reflects the decrease in probability of finding an
+    #   electron as it moves away from the nucleus
+
+    # - Power-law dependence on radial distance: p ** l
+    #   Introduces a dependency based on the azimuthal quantum number 'l',
+    #   indicating different radial behaviors for different orbitals
+
+    # - Laguerre polynomial: laguerre(p)
+    #   Captures oscillations in the electron density
+    #   as a function of radial distance
+    return constant_factor * np.exp(-p / 2) * (p ** l) * laguerre(p)
+
+
+# Normalized angular function Ylm(θ,φ)
+def angular_function(m, l, theta, phi):
+    """ Compute the normalized angular part of the wavefunction using
+    Legendre polynomials and a phase-shifting exponential factor.
+
+    Args:
+        m (int): magnetic quantum number
+        l (int): azimuthal quantum number
+        theta (numpy.ndarray): polar angle
+        phi (int): azimuthal angle
+    Returns:
+        numpy.ndarray: wavefunction angular component
+    """
+
+    # Legendre polynomials describe the spatial arrangement and directional
+    # characteristics of electron probability densities
+    legendre = sp.lpmv(m, l, np.cos(theta))
+
+    # This factor ensures that the angular wavefunction is normalized
+    constant_factor = ((-1) ** m) * np.sqrt(
+        ((2 * l + 1) * sp.factorial(l - np.abs(m))) /
+        (4 * np.pi * sp.factorial(l + np.abs(m)))
+    )
+
+    # The angular part of the wavefunction is constructed by the product of:
+    # - Constant factor:
+    #   Normalizes the angular wavefunction
+
+    # - Legendre polynomial:
+    #   Describes the angular dependence of the wavefunction based on the quantum numbers.
+    #   Providing insight into the orientation and shape of electron orbitals
+    #   around the nucleus for given quantum numbers
+
+    # - Exponential factor: np.real(np.exp(1.j * m * phi)), evaluated as np.cos(m * phi)
+    #   Introduces a phase shift dependent on the magnetic quantum
+    #   number 'm' and the azimuthal angle 'phi'. Only the real part is used so
+    #   the complex exponential (and its complex128 temporary) is never built
+    return constant_factor * legendre * np.cos(m * phi)
+
+
+# Real solid harmonics
+#
+# r^l P_l^m(cos(theta)) cos(m phi) is a polynomial in x, y and z, so the wavefunction
+# can be evaluated without asSpherical. For m >= 0 it factors into
+#   Pi_l^m(z, r^2) = r^(l-m) (d^m P_l / dt^m)(z / r)     and     C_m(x, y) = Re((x + iy)^m)
+# which follow from recurrences that only multiply and add:
+#   Pi_m^m = (2m - 1)!!,  Pi_{m+1}^m = (2m + 1) z Pi_m^m,
+#   (l - m) Pi_l^m = (2l - 1) z Pi_{l-1}^m - (l + m - 1) r^2 Pi_{l-2}^m
+#   C_{j+1} = x C_j - y S_j,  S_{j+1} = x S_j + y C_j,  S_j = Im((x + iy)^j)
+# Pi_l^m lacks the Condon-Shortley phase of sp.lpmv, which cancels the (-1)^m of
+# angular_function. For m < 0, sp.lpmv returns P_l^-|m| = (-1)^|m| (l-|m|)!/(l+|m|)! P_l^|m|,
+# so the same polynomials are used with that factor. Dividing the radial part by r^l
+# (scaled_radial_function with reduced=True) then gives psi without inverse trigonometry,
+# complex numbers or the eps that keeps theta finite at r = 0.
+#
+# The harmonics are evaluated in units of n a0 / 2, where r is the p of the radial part.
+
+def solid_harmonic_constant(l, m):
+    """ Scalar factor of the angular part in front of Pi_l^|m| * C_|m|.
+
+    Args:
+        l (int): azimuthal quantum number
+        m (int): magnetic quantum number
+    Returns:
+        float: normalization of angular_function including the factor of negative m
+    """
+    am = abs(m)
+    log_ratio = sp.gammaln(l - am + 1) - sp.gammaln(l + am + 1)
+    constant = np.sqrt((2 * l + 1) / (4 * np.pi) * np.exp(log_ratio))
+    if m < 0:
+        constant *= (-1) ** am * np.exp(log_ratio)
+    return constant
+
+def legendre_solid(l, m, z, r2):
+    """ Evaluate Pi_l^m(z, r^2) = r^(l-m) (d^m P_l / dt^m)(z / r) by its recurrence in l.
+
+    Args:
+        l (int): degree
+        m (int): order, 0 <= m <= l
+        z (numpy.ndarray): z coordinates, broadcastable against r2
+        r2 (numpy.ndarray): squared radii
+    Returns:
+        numpy.ndarray: float64 values shaped like r2 (or a float for l == m)
+    """
+    # (2m - 1)!!
+    start = np.prod(np.arange(2 * m - 1, 0, -2, dtype=np.float64))
+    if l == m:
+        return start
+
+    # The recurrence runs on Q_j = Pi_j^m / g_j with g_j = b_j g_{j-2}, b_j = (j + m - 1) / (j - m),
+    # which turns it into Q_j = c_j z Q_{j-1} - r^2 Q_{j-2} and saves a pass over the grid per degree
+    previous = np.ones_like(r2)
+    current = np.broadcast_to((2 * m + 1) * z, r2.shape).astype(np.float64)
+    scratch = np.empty_like(r2)
+    scale = [1.0, 1.0]
+    for j in range(m + 2, l + 1):
+        b = (j + m - 1) / (j - m)
+        scale.append(b * scale[-2])
+        c = (2 * j - 1) / (j - m) * scale[-2] / scale[-1]
+        np.multiply(current, c * z, out=scratch)
+        previous *= r2
+        np.subtract(scratch, previous, out=previous)
+        previous, current = current, previous
+    current *= start * scale[-1]
+    return current
+
+def azimuthal_solid(m, x, y):
+    """ Evaluate C_m(x, y) = Re((x + iy)^m) = rho^m cos(m phi) with real arithmetic.
+
+    Args:
+        m (int): order, m >= 0
+        x (numpy.ndarray): x coordinates
+        y (numpy.ndarray): y coordinates, broadcastable against x
+    Returns:
+        numpy.ndarray: float64 values of the broadcast shape of x and y
+    """
+    real = np.ones(np.broadcast_shapes(np.shape(x), np.shape(y)))
+    imag = np.zeros_like(real)
+    for j in range(m):
+        real, imag = x * real - y * imag, x * imag + y * real
+    return real
+
+def wavefunction_cartesian(n, l, m, a0, x, y, z, instrument=None):
+    """ Compute the wavefunction from Cartesian coordinates with real solid harmonics.
+
+    Matches radial_function * angular_function without converting to spherical
+    coordinates. The coordinates are only broadcast against each other, so 1D axis
+    vectors shaped for broadcasting avoid building full-size grids.
+
+    Args:
+        n (int): principal quantum number
+        l (int): azimuthal quantum number
+        m (int): magnetic quantum number
+        a0 (float): scaled Bohr radius
+        x (numpy.ndarray): x coordinates
+        y (numpy.ndarray): y coordinates
+        z (numpy.ndarray): z coordinates
+        instrument (instrument.Instrument): records the coordinates, radial and angular stages
+    Returns:
+        numpy.ndarray: float64 wavefunction of the broadcast shape of x, y and z
+    """
+    with maybe_stage(instrument, "coordinates") as stage:
+        # coordinates in units of n a0 / 2
+        unit = 2 / (n * a0)
+        x = np.asarray(x, dtype=np.float64) * unit
+        y = np.asarray(y, dtype=np.float64) * unit
+        z = np.asarray(z, dtype=np.float64) * unit
+        p2 = x * x + y * y + z * z
+        stage["voxels"] = p2.size
+
+    with maybe_stage(instrument, "radial"):
+        psi = scaled_radial_function(n, l, np.sqrt(p2), a0, reduced=True)
+
+    with maybe_stage(instrument, "angular"):
+        # x and y span fewer dimensions than the grid, so C_m is cheap and the constant
+        # is folded into it instead of costing another pass over the grid
+        azimuthal = azimuthal_solid(abs(m), x, y)
+        azimuthal *= solid_harmonic_constant(l, m)
+        psi *= azimuthal
+        psi *= legendre_solid(l, abs(m), z, p2)
+    return psi
+
+
+# Normalized wavefunction Ψnlm(r,θ,φ) as a product of Rnl(r).Ylm(θ,φ)
+def compute_wavefunction(n, l, m, a0_scale_factor,grid_extent,grid_resolution,instrument=None):
+    """ Compute the normalized wavefunction as a product
+    of its radial and angular components.
+
+    Args:
+        n (int): principal quantum number
+        l (int): azimuthal quantum number
+        m (int): magnetic quantum number
+        a0_scale_factor (float): Bohr radius scale factor
+        instrument (instrument.Instrument): records the grid, radial and angular stages
+    Returns:
+        numpy.ndarray: wavefunction
+    """
+
+    # The Bohr radius sets the scale of the wavefunction and determines the size of the atom.
+    # By scaling it, we adapt the wavefunction's spatial extent for effective visualization
+    a0 = a0_scale_factor * physical_constants['Bohr radius'][0] * 1e+12
+
+    # Establish a grid in the z-x plane, allowing the wavefunction to assign a probability
+    # value to each point. This grid aids in visualizing the electron's spatial distribution
+    # grid_extent = 480
+    # grid_resolution = 100
+    with maybe_stage(instrument, "grid", voxels=grid_resolution ** 3):
+        z = x = y = np.linspace(-grid_extent, grid_extent, grid_resolution)
+        z, x, y= np.meshgrid(z, x, y)
+
+    # Compute the wavefunction by multiplying the radial and angular parts.
+    # The radial part considers the distance from the nucleus, whereas the angular part
+    # looks into the spatial orientation. Together, they define the electron's behavior
+    # in the atom's vicinity. Both are evaluated on the Cartesian grid directly (see the
+    # real solid harmonics above), without an eps against division by zero at r = 0
+    psi = wavefunction_cartesian(n, l, m, a0, x, y, z, instrument)
+
+    # Return the computed wavefunction, which encapsulates the quantum state
+    # of an electron in a hydrogen atom. The wavefunction contains complex amplitudes
+    # that provide information about the quantum state's magnitude and phase
+    return psi
+
+
+# Probability density |Ψ|^2
+def compute_probability_density(psi):
+    """ Compute the probability density of a given wavefunction.
+    Args:
+        psi (numpy.ndarray): wavefunction
+    Returns:
+        numpy.ndarray: wavefunction probability density
+    """
+
+    # Return the computed probability density, which gives the likelihood of finding
+    # the electron at a specific point in space for the given quantum state. The
+    # values represent the square magnitude of the wavefunction, encapsulating the
+    # probability of the electron's presence in different regions of the atom
+    return np.abs(psi) ** 2
+
+
+# Bytes of float64 scratch memory needed per voxel while one slab is evaluated:
+# r^2, r, the three arrays of each recurrence, the radial envelope, psi and the
+# temporaries numpy creates in between
+SLAB_BYTES_PER_VOXEL = 12 * 8
+
+def check_quantum_numbers(n, l, m):
+    """ Validate the quantum state (n,l,m), raising ValueError if it is not allowed.
+
+    Args:
+        n (int): principal quantum number
+        l (int): azimuthal quantum number
+        m (int): magnetic quantum number
+    """
+    if not isinstance(n, int) or n < 1:
+        raise ValueError('n should be an integer satisfying the condition: n >= 1')
+    if not isinstance(l, int) or not (0 <= l < n):
+        raise ValueError('l should be an integer satisfying the condition: 0 <= l < n')
+    if not isinstance(m, int) or not (-l <= m <= l):
+        raise ValueError('m should be an integer satisfying the condition: -l <= m <= l')
+
+def density_block(n, l, m, a0, xs, zs, ys, instrument=None, out=None):
+    """ Compute |Ψ|^2 on the block spanned by three 1D coordinate vectors.
+
+    The axis order is the one of the meshgrid built in compute_wavefunction:
+    axis 0 runs over x, axis 1 over z and axis 2 over y. The coordinates are
+    only broadcast against each other, so no full-size x/y/z arrays are built.
+
+    Args:
+        n (int): principal quantum number
+        l (int): azimuthal quantum number
+        m (int): magnetic quantum number
+        a0 (float): scaled Bohr radius
+        xs (numpy.ndarray): x coordinates of the block (axis 0)
+        zs (numpy.ndarray): z coordinates of the block (axis 1)
+        ys (numpy.ndarray): y coordinates of the block (axis 2)
+        instrument (instrument.Instrument): records the stages of wavefunction_cartesian
+        out (numpy.ndarray): array to write the density to, like a float32 slab of the
+            output volume, so squaring and rounding take one pass; None for float64
+    Returns:
+        numpy.ndarray: probability density of the block, out if given
+    """
+    x = xs[:, None, None]
+    z = zs[None, :, None]
+    y = ys[None, None, :]
+
+    psi = wavefunction_cartesian(n, l, m, a0, x, y, z, instrument)
+
+    # psi is real, so |psi|^2 is a plain square
+    return np.square(psi, out=psi if out is None else out)
+
+def slab_thickness(grid_resolution, memory_budget_mb, workers=1, planes=None):
+    """ Number of grid planes that can be evaluated at once within a memory budget.
+
+    Args:
+        grid_resolution (int): number of grid points along each axis
+        memory_budget_mb (float): scratch memory allowed for the slabs evaluated at
+            the same time in MiB
+        workers (int): number of slabs evaluated at the same time, they share the budget
+        planes (int): number of planes to split among the workers, None for grid_resolution
+    Returns:
+        int: slab thickness, at least 1 and at most grid_resolution
+    """
+    if planes is None:
+        planes = grid_resolution
+    plane_bytes = grid_resolution * grid_resolution * SLAB_BYTES_PER_VOXEL
+    thickness = int(memory_budget_mb * 1024 * 1024 / workers // plane_bytes)
+    # every worker gets a slab
+    thickness = min(thickness, -(-planes // workers))
+    return max(1, min(grid_resolution, thickness))
+
+def evaluation_workers(workers):
+    """ Number of slab evaluation threads for a workers setting, 0 for one per CPU core. """
+    if workers == 0:
+        return os.cpu_count() or 1
+    return max(1, workers)
+
+def evaluate_slabs(start, stop, thickness, evaluate, workers=1, on_slab=None):
+    """ Call evaluate(begin, end) on the slabs of thickness planes covering [start, stop).
+
+    With several workers the slabs are evaluated by a thread pool. numpy releases the
+    GIL inside its array loops, so the slabs run on separate cores and write to their
+    own part of a shared output without copies. Every voxel goes through the same
+    arithmetic whichever slab it falls in, so the result is bit-identical to the serial
+    loop.
+
+    Args:
+        start (int): first plane
+        stop (int): end of the planes
+        thickness (int): planes per slab
+        evaluate (callable): evaluates the planes [begin, end)
+        workers (int): slabs evaluated at the same time
+        on_slab (callable): called with the evaluated fraction of the planes after every
+            slab, on the calling thread; an exception raised by it stops the evaluation
+    Returns:
+        int: number of slabs
+    """
+    bounds = [(begin, min(begin + thickness, stop)) for begin in range(start, stop, thickness)]
+    if workers <= 1 or len(bounds) <= 1:
+        for begin, end in bounds:
+            evaluate(begin, end)
+            if on_slab is not None:
+                on_slab((end - start) / (stop - start))
+        return len(bounds)
+
+    done = 0
+    with ThreadPoolExecutor(min(workers, len(bounds))) as pool:
+        futures = {pool.submit(evaluate, begin, end): end - begin for begin, end in bounds}
+        try:
+            for future in as_completed(futures):
+                future.result()
+                done = done + futures[future]
+                if on_slab is not None:
+                    on_slab(done / (stop - start))
+        except BaseException:
+            # the slabs that did not start yet are dropped, the running ones finish
+            pool.shutdown(wait=True, cancel_futures=True)
+            raise
+    return len(bounds)
+
+def compute_wavefunction_slabs(n, l, m, a0_scale_factor, grid_extent, grid_resolution, memory_budget_mb=512,
+                               instrument=None, on_slab=None, workers=1):
+    """ Compute the wavefunction slab by slab into one float32 volume.
+
+    Gives compute_wavefunction(...) rounded to float32, without building the full
+    meshgrid or any other full-size float64 array.
+
+    Args:
+        n (int): principal quantum number
+        l (int): azimuthal quantum number
+        m (int): magnetic quantum number
+        a0_scale_factor (float): Bohr radius scale factor
+        grid_extent (int): the grid spans [-grid_extent, grid_extent] along each axis
+        grid_resolution (int): number of grid points along each axis
+        memory_budget_mb (float): scratch memory for one slab in MiB
+        instrument (instrument.Instrument): records the stages of every slab, or the whole
+            evaluation as one stage with several workers
+        on_slab (callable): called with the evaluated fraction of the volume after every slab
+        workers (int): slabs evaluated at the same time by threads, 0 for one per CPU core
+    Returns:
+        numpy.ndarray: float32 wavefunction, real like the orbitals of compute_wavefunction
+    """
+    a0 = scaled_bohr_radius(a0_scale_factor)
+    axis = np.linspace(-grid_extent, grid_extent, grid_resolution)
+    workers = evaluation_workers(workers)
+    thickness = slab_thickness(grid_resolution, memory_budget_mb, workers)
+    psi = np.empty((grid_resolution, grid_resolution, grid_resolution), dtype=np.float32)
+    # an instrument only follows one thread
+    slab_instrument = instrument if workers == 1 else None
+
+    def evaluate(start, stop):
+        psi[start:stop] = wavefunction_cartesian(n, l, m, a0, axis[start:stop, None, None], axis[None, None, :],
+                                                 axis[None, :, None], slab_instrument)
+
+    with maybe_stage(instrument if workers > 1 else None, "parallel_evaluation", workers=workers):
+        evaluate_slabs(0, grid_resolution, thickness, evaluate, workers, on_slab)
+    return psi
+
+def compute_probability_density_slabs(n, l, m, a0_scale_factor, grid_extent, grid_resolution,
+                                      memory_budget_mb=512, measure_memory=True, symmetric=False, factors=None,
+                                      instrument=None, on_slab=None, workers=1):
+    """ Compute the probability density slab by slab into one float32 volume.
+
+    Gives the same volume as compute_probability_density(compute_wavefunction(...)),
+    but never builds the full meshgrid or any other full-size float64 or complex
+    array. Only the float32 output plus the scratch of a single slab are alive.
+
+    Args:
+        n (int): principal quantum number
+        l (int): azimuthal quantum number
+        m (int): magnetic quantum number
+        a0_scale_factor (float): Bohr radius scale factor
+        grid_extent (int): the grid spans [-grid_extent, grid_extent] along each axis
+        grid_resolution (int): number of grid points along each axis
+        memory_budget_mb (float): scratch memory of the slabs evaluated at the same time
+            in MiB, the output volume itself (4 bytes per voxel) comes on top of it
+        measure_memory (bool): trace numpy allocations to report the peak memory
+        symmetric (bool): only evaluate the octant x, y, z >= 0 and fill the
+            rest of the volume by reflection (see mirror_octant)
+        factors (factors.FactorCache): assemble the octant from cached radial and
+            angular factors instead of evaluating psi, always mirrored; None to evaluate
+        instrument (instrument.Instrument): records the stages of every slab, or the
+            whole evaluation as one stage with several workers
+        on_slab (callable): called with the evaluated fraction of the volume after
+            every slab; an exception raised by it stops the evaluation
+        workers (int): slabs evaluated at the same time by threads, 0 for one per CPU
+            core; the result does not depend on it
+    Returns:
+        tuple: (numpy.ndarray float32 probability density, dict evaluation report)
+    """
+    a0 = scaled_bohr_radius(a0_scale_factor)
+
+    axis = np.linspace(-grid_extent, grid_extent, grid_resolution)
+
+    # the factors are kept for one octant only
+    symmetric = symmetric or factors is not None
+
+    # index of the first grid plane on the non-negative side of each axis
+    half = grid_resolution // 2 if symmetric else 0
+    sub_axis = axis[half:]
+
+    workers = evaluation_workers(workers)
+    thickness = slab_thickness(grid_resolution, memory_budget_mb, workers, grid_resolution - half)
+    # an instrument only follows one thread
+    slab_instrument = instrument if workers == 1 else None
+
+    # numpy reports its buffers to tracemalloc, so the traced peak covers the
+    # output volume and every slab temporary
+    started = measure_memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    if measure_memory:
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+
+    density = np.empty((grid_resolution, grid_resolution, grid_resolution), dtype=np.float32)
+    slabs = 0
+    factor_report = None
+
+    def evaluate(start, stop):
+        density_block(n, l, m, a0, axis[start:stop], sub_axis, sub_axis, slab_instrument,
+                      out=density[start:stop, half:, half:])
+
+    try:
+        if factors is not None:
+            factor_report = factors.density_octant(n, l, m, a0, grid_extent, grid_resolution,
+                                                   density[half:, half:, half:], memory_budget_mb, instrument,
+                                                   on_slab, workers)
+        else:
+            with maybe_stage(instrument if workers > 1 else None, "parallel_evaluation", workers=workers):
+                slabs = evaluate_slabs(half, grid_resolution, thickness, evaluate, workers, on_slab)
+
+        if symmetric:
+            with maybe_stage(instrument, "mirror"):
+                mirror_octant(density)
+    except BaseException:
+        if started:
+            tracemalloc.stop()
+        raise
+
+    peak_bytes = None
+    if measure_memory:
+        peak_bytes = tracemalloc.get_traced_memory()[1] - baseline
+    if started:
+        tracemalloc.stop()
+
+    report = {
+        "slab_thickness": thickness,
+        "slabs": slabs,
+        "workers": workers,
+        "evaluated_voxels": (grid_resolution - half) ** 3,
+        "output_bytes": density.nbytes,
+        "peak_bytes": peak_bytes,
+    }
+    if factor_report is not None:
+        report["factors"] = factor_report
+    return density, report
+
+# Mirror symmetry of |Ψ|^2
+#
+# The wavefunction used here is the real orbital R(r) * P_l^m(cos(theta)) * cos(m*phi).
+# Its density is even in every Cartesian axis:
+#   z -> -z : P_l^m(-t) = (-1)^(l+m) P_l^m(t)
+#   y -> -y : phi -> -phi, cos(m*phi) is even
+#   x -> -x : phi -> pi - phi, cos(m*(pi - phi)) = (-1)^m cos(m*phi)
+# The symmetric linspace grid maps index i onto index N-1-i under each reflection,
+# so one octant of the grid determines the whole volume.
+
+def mirror_octant(volume):
+    """ Fill a cubic volume in place from its octant volume[h:, h:, h:] with h = N // 2,
+    by reflecting it through the centre of each axis.
+
+    Args:
+        volume (numpy.ndarray): cubic volume whose upper octant is already computed
+    """
+    size = volume.shape[0]
+    half = size // 2
+    # indices >= size - half map onto the indices below half (the centre plane of an
+    # odd grid maps onto itself and is left alone)
+    upper = size - half
+    volume[half:, half:, :half] = volume[half:, half:, upper:][:, :, ::-1]
+    volume[half:, :half, :] = volume[half:, upper:, :][:, ::-1, :]
+    volume[:half] = volume[upper:][::-1]
+
+def plot_wf_probability_density(n, l, m, a0_scale_factor,grid_extent,grid_resolution,instrument=None):
+    """ Plot the probability density of the hydrogen
+    atom's wavefunction for a given quantum state (n,l,m).
+
+    Args:
+        n (int): principal quantum number, determines the energy level and size of the orbital
+        l (int): azimuthal quantum number, defines the shape of the orbital
+        m (int): magnetic quantum number, defines the orientation of the orbital
+        a0_scale_factor (float): Bohr radius scale factor
+    """
+
+    # Quantum numbers validation
+    check_quantum_numbers(n, l, m)
+
+    psi = compute_wavefunction(n, l, m, a0_scale_factor,grid_extent,grid_resolution,instrument)
+    # print("psi shape: ",psi.shape)
+
+    return psi
+
+# grid resolution on which probability_iso estimates an enclosed probability iso value
+PROBABILITY_FIT_RESOLUTION = 129
+
+def probability_iso(n, l, m, a0_scale_factor, probability, resolution=PROBABILITY_FIT_RESOLUTION, samples=4096,
+                    tail=1e-6):
+    """ Iso value whose isosurface encloses a fraction of the whole probability.
+
+    The value is estimated with enclosed_probability_isos on a coarse mirror symmetric
+    grid, just large enough to hold all but tail of the probability according to the
+    radial distribution r^2 R(r)^2.
+
+    Args:
+        n (int): principal quantum number
+        l (int): azimuthal quantum number
+        m (int): magnetic quantum number
+        a0_scale_factor (float): Bohr radius scale factor
+        probability (float): enclosed fraction in (0, 1)
+        resolution (int): number of grid points along each axis of the estimate
+        samples (int): number of radial samples
+        tail (float): probability left outside the grid of the estimate at most
+    Returns:
+        float: iso value
+    """
+    bohr = scaled_bohr_radius(a0_scale_factor)
+    # as in auto_grid_extent, widen the radial range until the distribution has decayed
+    radius = n * bohr * (n + 10)
+    while True:
+        r = np.linspace(0, radius, samples)
+        cdf = np.cumsum(np.square(r * radial_function(n, l, r, bohr)))
+        cdf = cdf / cdf[-1]
+        if cdf[-samples // 64] >= 1 - tail:
+            break
+        radius = 2 * radius
+    extent = max(1, int(np.ceil(r[np.searchsorted(cdf, 1 - tail)])))
+    volume, report = compute_probability_density_slabs(n, l, m, a0_scale_factor, extent, resolution, 64,
+                                                       measure_memory=False, symmetric=True)
+    return float(enclosed_probability_isos(volume, [probability])[0])
+
+def auto_grid_extent(n, l, m, a0_scale_factor, grid_resolution, levels, samples=4096, probabilities=()):
+    """ Size the grid so that it just holds the lowest requested isosurface.
+
+    The density is bounded by the radial envelope R(r)^2 * max |Y|^2, which only needs
+    1D evaluations. The iso values are chosen as in iso_levels, from a maximum estimated
+    with that envelope, and the grid extent is the radius beyond which the envelope stays
+    below the lowest of them, plus two voxels of margin. With probabilities, the lowest
+    iso value is the one enclosing the largest of them (see probability_iso).
+
+    Args:
+        n (int): principal quantum number
+        l (int): azimuthal quantum number
+        m (int): magnetic quantum number
+        a0_scale_factor (float): Bohr radius scale factor
+        grid_resolution (int): number of grid points along each axis
+        levels (int): number of iso levels
+        samples (int): number of radial samples
+        probabilities (list): enclosed probabilities of the levels instead of levels
+    Returns:
+        tuple: (int grid extent, float radius of the lowest isosurface, float voxel size)
+    """
+    bohr = scaled_bohr_radius(a0_scale_factor)
+    if probabilities:
+        lowest = probability_iso(n, l, m, a0_scale_factor, max(probabilities), samples=samples)
+
+    # largest value of the angular part over all directions (|cos(m*phi)| reaches 1)
+    theta = np.linspace(0, np.pi, samples)
+    angular_max = np.max(angular_function(m, l, theta, 0.0) ** 2)
+
+    # widen the radial range until the envelope has decayed at its end
+    radius = n * bohr * (n + 10)
+    while True:
+        r = np.linspace(0, radius, samples)
+        envelope = radial_function(n, l, r, bohr) ** 2 * angular_max
+        if not probabilities:
+            lowest = iso_levels(0.0, envelope.max(), levels)[-1][1]
+        if envelope[-1] < lowest:
+            break
+        radius = 2 * radius
+
+    outside = np.flatnonzero(envelope >= lowest)[-1] + 1
+    iso_radius = r[min(outside, samples - 1)]
+
+    # the isosurface must stay two voxels inside the grid:
+    # extent = iso_radius + 2 * voxel with voxel = 2 * extent / (grid_resolution - 1)
+    margin = 4 / max(grid_resolution - 1, 5)
+    extent = max(1, int(np.ceil(iso_radius / (1 - margin))))
+    voxel_size = 2 * extent / max(grid_resolution - 1, 1)
+    return extent, iso_radius, voxel_size